@@ -0,0 +1,479 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "paper-qa",
+#     "pyzmq",
+# ]
+# ///
+"""
+Load test for the PaperQA server against a local stub LLM.
+
+Generates a synthetic paper corpus, starts the stub LLM (see stub_llm.py) and
+the server, and measures the index build time, the time of settings updates,
+the throughput and latency percentiles of `ask` and `get_status` at each
+concurrency level, and the memory high-water mark of the server. No network
+calls are made and nothing is written outside a temporary directory:
+
+    uv run benchmarks/load.py --papers 50 --concurrency 1,4,8 --json load.json
+
+Compare the JSON output across releases to catch performance regressions.
+"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import zmq
+
+from startup import BACKEND_DIR, SERVER_SCRIPT, free_port
+
+STUB_SCRIPT = Path(__file__).resolve().parent / "stub_llm.py"
+
+LLM = "gpt-4o-mini"
+EMBEDDING = "text-embedding-3-small"
+
+WORDS = (
+    "catalyst yield synthesis reaction temperature pressure solvent ligand "
+    "substrate kinetics spectroscopy polymer membrane enzyme protein binding "
+    "affinity assay sample model dataset training accuracy baseline method "
+    "result analysis measurement error variance sensor signal frequency "
+    "material structure surface interface layer thickness conductivity"
+).split()
+
+
+class Client:
+    """Blocking client of the server, one per thread."""
+
+    def __init__(self, context: zmq.Context, port: int, timeout: float):
+        self.socket = context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(f"tcp://127.0.0.1:{port}")
+        self.timeout = timeout
+
+    def call(self, method: str, **params) -> Dict[str, Any]:
+        self.socket.send_string(json.dumps({"method": method, "params": params}))
+        if not self.socket.poll(self.timeout * 1000):
+            raise TimeoutError(f"No reply to {method} within {self.timeout}s")
+        return json.loads(self.socket.recv_string())
+
+    def close(self):
+        self.socket.close()
+
+
+class MemorySampler:
+    """Tracks the peak resident memory of a process."""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss(self) -> Optional[int]:
+        try:
+            import psutil
+
+            return psutil.Process(self.pid).memory_info().rss
+        except ImportError:
+            pass
+        try:
+            with open(f"/proc/{self.pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return None
+
+    def high_water_mark(self) -> Optional[int]:
+        """Peak resident memory as recorded by the kernel, on Linux."""
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss() or 0)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Optional[float]:
+        """Stop sampling and return the peak in MB."""
+        peak = max(self.peak, self.high_water_mark() or 0)
+        self._stop.set()
+        self._thread.join()
+        return round(peak / 2**20, 1) if peak else None
+
+
+def make_corpus(directory: Path, papers: int, size: int, seed: int = 0):
+    """
+    Write synthetic text papers.
+
+    Args:
+        directory: Directory to write the papers to
+        papers: Number of papers
+        size: Approximate number of characters per paper
+        seed: Seed of the random text
+    """
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    for i in range(papers):
+        sentences = [f"Paper {i}: a study of {rng.choice(WORDS)} {rng.choice(WORDS)}."]
+        length = len(sentences[0])
+        while length < size:
+            words = rng.choices(WORDS, k=rng.randint(8, 20))
+            sentence = " ".join(words).capitalize() + f" was {rng.randint(1, 99)}%."
+            sentences.append(sentence)
+            length += len(sentence) + 1
+        (directory / f"paper_{i:04d}.txt").write_text(" ".join(sentences))
+
+
+def percentiles(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """Nearest-rank percentiles and maximum of latencies, in seconds."""
+    values = sorted(latencies)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    summary = {}
+    for quantile in (50, 95, 99):
+        rank = max(math.ceil(quantile / 100 * len(values)), 1)
+        summary[f"p{quantile}"] = round(values[rank - 1], 4)
+    summary["max"] = round(values[-1], 4)
+    return summary
+
+
+def drive(
+    context: zmq.Context,
+    port: int,
+    request: Callable[[int], Dict[str, Any]],
+    concurrency: int,
+    requests: int,
+    timeout: float,
+    succeeded: Tuple[str, ...] = ("success",),
+) -> Dict[str, Any]:
+    """
+    Send requests from concurrent clients and time them.
+
+    Args:
+        context: ZMQ context
+        port: Server port
+        request: Function giving the method and params of the i-th request
+        concurrency: Number of clients sending requests at the same time
+        requests: Total number of requests
+        timeout: Seconds to wait for a reply
+        succeeded: Reply statuses that count as a successful request
+
+    Returns:
+        Dict with the successful requests/sec and their latency percentiles,
+        and the number of failed requests per status ("timeout" when no reply
+        came within the timeout)
+    """
+    counter = iter(range(requests))
+    lock = threading.Lock()
+    latencies: List[float] = []
+    failures: collections.Counter = collections.Counter()
+    first_failure: Optional[str] = None
+
+    def client_loop():
+        nonlocal first_failure
+        client = Client(context, port, timeout)
+        try:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                call = request(i)
+                start = time.perf_counter()
+                try:
+                    result = client.call(call["method"], **call.get("params", {}))
+                    status = result.get("status")
+                    message = result.get("message")
+                except TimeoutError as e:
+                    status, message = "timeout", str(e)
+                    # A REQ socket can't send again before it got its reply
+                    client.close()
+                    client = Client(context, port, timeout)
+                with lock:
+                    if status in succeeded:
+                        latencies.append(time.perf_counter() - start)
+                    else:
+                        failures[status or "unknown"] += 1
+                        if first_failure is None:
+                            first_failure = f"{status}: {message}"
+        finally:
+            client.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client_loop) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "failed": sum(failures.values()),
+        "failures": dict(failures),
+        "first_failure": first_failure,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(latencies) / seconds, 2),
+        **percentiles(latencies),
+    }
+
+
+def poll_status(
+    context: zmq.Context, port: int, stop: threading.Event, timeout: float
+) -> List[float]:
+    """Time get_status every 50ms until stopped, to check it stays responsive."""
+    client = Client(context, port, timeout)
+    latencies = []
+    try:
+        while not stop.wait(0.05):
+            start = time.perf_counter()
+            client.call("get_status")
+            latencies.append(time.perf_counter() - start)
+    finally:
+        client.close()
+    return latencies
+
+
+def timed(call: Callable[[], Dict[str, Any]]) -> float:
+    """Seconds a successful call takes."""
+    start = time.perf_counter()
+    result = call()
+    if result.get("status") == "error":
+        raise RuntimeError(result.get("message"))
+    return time.perf_counter() - start
+
+
+def run(args: argparse.Namespace, workdir: Path) -> Dict[str, Any]:
+    """Run the benchmark with its files in a working directory."""
+    corpus = workdir / "papers"
+    make_corpus(corpus, args.papers, args.paper_size)
+
+    port = free_port()
+    stub_port = free_port()
+    while stub_port in (port, port + 1):
+        stub_port = free_port()
+    env = {
+        **os.environ,
+        "OPENAI_API_BASE": f"http://127.0.0.1:{stub_port}/v1",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{stub_port}/v1",
+        # Keep indexes and caches out of the user's ~/.pqa
+        "PQA_HOME": str(workdir),
+        "PAPERQA_SERVER_PORT": str(port),
+        "PAPERQA_SERVER_WORKERS": str(args.workers or max(args.concurrency)),
+    }
+    stub = subprocess.Popen(
+        [sys.executable, str(STUB_SCRIPT), "--port", str(stub_port)]
+        + ["--latency", str(args.latency)],
+        stdout=subprocess.DEVNULL,
+    )
+    log = open(workdir / "server.log", "w")
+    server = subprocess.Popen(
+        [sys.executable, str(SERVER_SCRIPT)],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    memory = MemorySampler(server.pid)
+    memory.start()
+    context = zmq.Context()
+    client = Client(context, port, args.timeout)
+    results: Dict[str, Any] = {}
+    try:
+        client.call("get_status")
+        initialize = {
+            "paper_dir": str(corpus),
+            "llm": LLM,
+            "summary_llm": LLM,
+            "agent_llm": LLM,
+            "embedding": EMBEDDING,
+            "api_key": "sk-stub",
+            "provider_type": "openai",
+            "preset": args.preset,
+            "use_tier1_limits": False,
+            "use_answer_cache": args.answer_cache,
+        }
+        results["initialize_seconds"] = round(
+            timed(lambda: client.call("initialize", **initialize)), 3
+        )
+
+        index = client.call("index", wait=True)
+        if index.get("status") == "error":
+            raise RuntimeError(index.get("message"))
+        results["index"] = {
+            "papers": index["papers"],
+            "seconds": index["seconds"],
+            "papers_per_second": round(index["papers"] / index["seconds"], 2),
+        }
+        results["first_ask_seconds"] = round(
+            timed(lambda: client.call("ask", question="What was measured?")), 3
+        )
+
+        patched = [
+            timed(lambda: client.call("update_settings", temperature=i % 2 / 10))
+            for i in range(args.settings_updates)
+        ]
+        rebuilt = [
+            timed(lambda: client.call("update_settings", llm=llm))
+            for llm in ["gpt-4o", LLM] * (args.settings_updates // 2)
+        ]
+        results["update_settings"] = {
+            "patched": percentiles(patched),
+            "rebuilt": percentiles(rebuilt),
+        }
+
+        results["ask"] = []
+        results["get_status"] = []
+        for concurrency in args.concurrency:
+            stop = threading.Event()
+            status_latencies: List[float] = []
+            poller = threading.Thread(
+                target=lambda: status_latencies.extend(
+                    poll_status(context, port, stop, args.timeout)
+                )
+            )
+            poller.start()
+            offset = len(results["ask"]) * args.requests
+            results["ask"].append(
+                drive(
+                    context,
+                    port,
+                    lambda i: {
+                        "method": "ask",
+                        "params": {
+                            "question": f"What yield does paper {offset + i} report?"
+                        },
+                    },
+                    concurrency,
+                    args.requests,
+                    args.timeout,
+                )
+            )
+            stop.set()
+            poller.join()
+            results["get_status"].append(
+                {
+                    "concurrency": concurrency,
+                    "requests": len(status_latencies),
+                    **percentiles(status_latencies),
+                }
+            )
+
+        results["status_only"] = drive(
+            context,
+            port,
+            lambda i: {"method": "get_status"},
+            max(args.concurrency),
+            args.requests * 10,
+            args.timeout,
+            succeeded=("initialized",),
+        )
+        results["server_metrics"] = client.call("get_metrics").get("metrics")
+    finally:
+        results["memory_peak_mb"] = memory.stop()
+        client.close()
+        context.destroy(linger=0)
+        for process in (server, stub):
+            process.terminate()
+            process.wait()
+        log.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--papers", type=int, default=50, help="papers in the corpus")
+    parser.add_argument(
+        "--paper-size", type=int, default=20000, help="characters per paper"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds per stub LLM call"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 4, 8],
+        help="comma-separated numbers of concurrent clients",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=40, help="ask requests per concurrency level"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="server workers (default: highest concurrency)"
+    )
+    parser.add_argument("--settings-updates", type=int, default=20)
+    parser.add_argument("--preset", help="preset to initialize the server with")
+    parser.add_argument(
+        "--answer-cache", action="store_true", help="enable the answer cache"
+    )
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--keep", action="store_true", help="keep the working files")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="paperqa-load-"))
+    try:
+        results = {
+            "python": sys.version.split()[0],
+            "options": {
+                key: value for key, value in vars(args).items() if key != "json"
+            },
+            **run(args, workdir),
+        }
+    finally:
+        if args.keep:
+            print(f"Working files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    index = results["index"]
+    print(
+        f"index build: {index['papers']} papers in {index['seconds']:.3f}s"
+        f" ({index['papers_per_second']} papers/s)"
+    )
+    print(f"initialize: {results['initialize_seconds']:.3f}s")
+    print(f"first ask: {results['first_ask_seconds']:.3f}s")
+    for kind, timing in results["update_settings"].items():
+        print(f"update_settings ({kind}): p50 {timing['p50']}s, max {timing['max']}s")
+    print(f"{'':<22}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'failed':>8}")
+    rows = [(f"ask x{ask['concurrency']}", ask) for ask in results["ask"]] + [
+        (f"get_status (ask x{status['concurrency']})", status)
+        for status in results["get_status"]
+    ]
+    rows.append(("get_status only", results["status_only"]))
+    for label, row in rows:
+        print(
+            f"{label:<22}{row.get('requests_per_second', ''):>8}"
+            f"{row['p50'] or 0:>9.4f}{row['p95'] or 0:>9.4f}{row['p99'] or 0:>9.4f}"
+            f"{row.get('failed', ''):>8}"
+        )
+        if row.get("failures"):
+            counts = ", ".join(f"{n} {s}" for s, n in row["failures"].items())
+            print(f"{'':<22}failed: {counts}; first: {row['first_failure']}")
+    print(f"memory high-water mark: {results['memory_peak_mb']} MB")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "paper-qa",
+#     "pyzmq",
+# ]
+# ///
+"""
+Startup benchmark for the PaperQA server.
+
+Measures how long the server takes to answer its first request, how long
+until PaperQA is loaded in the background, and which imports the time goes
+to (from `python -X importtime`). Run it from anywhere:
+
+    uv run benchmarks/startup.py --runs 5 --json startup.json
+
+Compare the JSON output across releases to catch startup regressions.
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import zmq
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+SERVER_SCRIPT = BACKEND_DIR / "paperqa_server.py"
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def free_port() -> int:
+    """Find a port that is free for the server and the one above it."""
+    while True:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        with socket.socket() as s:
+            try:
+                s.bind(("127.0.0.1", port + 1))
+                return port
+            except OSError:
+                continue
+
+
+def import_times(module: str, top: int) -> Dict[str, Any]:
+    """
+    Break the import time of a backend module down.
+
+    Args:
+        module: Module to import, e.g. "paperqa_api"
+        top: Number of slowest packages to report
+
+    Returns:
+        Dict with the total seconds and the packages taking the most time,
+        counting the time spent in each of their modules
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Imports are listed before the module importing them, nested ones
+    # indented, so everything since the last top-level import belongs to it
+    subtree: Dict[str, float] = {}
+    packages: Dict[str, float] = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        own, cumulative, indent, name = match.groups()
+        package = name.split(".")[0]
+        subtree[package] = subtree.get(package, 0.0) + int(own) / 1e6
+        if not indent:
+            if name == module:
+                total, packages = int(cumulative) / 1e6, subtree
+            subtree = {}
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "seconds": round(total, 3),
+        "slowest": [
+            {"package": package, "seconds": round(seconds, 3)}
+            for package, seconds in slowest[:top]
+        ],
+    }
+
+
+def server_startup(timeout: float) -> Dict[str, float]:
+    """
+    Start the server and time its first responses.
+
+    Args:
+        timeout: Seconds to wait for the server before giving up
+
+    Returns:
+        Dict with the seconds until the first reply to get_status and
+        get_preset_names, and until PaperQA was loaded
+    """
+    port = free_port()
+    env = {**os.environ, "PAPERQA_SERVER_PORT": str(port)}
+    context = zmq.Context()
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, str(SERVER_SCRIPT)],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    socket_ = context.socket(zmq.REQ)
+    socket_.setsockopt(zmq.LINGER, 0)
+    socket_.connect(f"tcp://127.0.0.1:{port}")
+
+    def call(method: str) -> Dict[str, Any]:
+        socket_.send_string(json.dumps({"method": method, "params": {}}))
+        remaining = timeout - (time.perf_counter() - start)
+        if not socket_.poll(max(remaining, 0) * 1000):
+            raise TimeoutError(f"No reply to {method} within {timeout}s")
+        return json.loads(socket_.recv_string())
+
+    try:
+        call("get_status")
+        timings = {"first_status": time.perf_counter() - start}
+        call("get_preset_names")
+        timings["first_presets"] = time.perf_counter() - start
+        while not call("get_status").get("paperqa_loaded"):
+            time.sleep(0.05)
+        timings["paperqa_loaded"] = time.perf_counter() - start
+        return timings
+    finally:
+        socket_.close()
+        context.term()
+        server.terminate()
+        server.wait()
+
+
+def summarize(runs: List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Median, minimum and maximum of each timing across runs."""
+    return {
+        key: {
+            "median": round(statistics.median(run[key] for run in runs), 3),
+            "min": round(min(run[key] for run in runs), 3),
+            "max": round(max(run[key] for run in runs), 3),
+        }
+        for key in runs[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=3, help="server starts to time")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports shown")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {
+        "python": sys.version.split()[0],
+        "imports": {
+            module: import_times(module, args.top)
+            for module in ("paperqa_server", "paperqa_api")
+        },
+        "startup": summarize([server_startup(args.timeout) for _ in range(args.runs)]),
+    }
+
+    for module, imports in results["imports"].items():
+        print(f"import {module}: {imports['seconds']:.3f}s")
+        for entry in imports["slowest"]:
+            print(f"    {entry['package']:<30} {entry['seconds']:.3f}s")
+    print(f"server startup ({args.runs} runs):")
+    for key, timing in results["startup"].items():
+        print(
+            f"    {key:<30} {timing['median']:.3f}s"
+            f" (min {timing['min']:.3f}s, max {timing['max']:.3f}s)"
+        )
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = []
+# ///
+"""
+Stub OpenAI-compatible LLM and embedding endpoint for benchmarks.
+
+Answers chat completions (including tool calls and streaming) and embedding
+requests instantly after a configurable artificial latency, so the PaperQA
+backend can be benchmarked without network calls or API costs:
+
+    uv run benchmarks/stub_llm.py --port 8765 --latency 0.05
+
+Point the server at it with OPENAI_API_BASE=http://127.0.0.1:8765/v1 and use
+OpenAI model names, e.g. gpt-4o-mini and text-embedding-3-small. Embeddings
+are deterministic hashes of the text, so similar texts aren't close. With
+--rpm, requests to a model over that many per minute are answered with 429
+and a Retry-After header, like a provider enforcing its quota.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+# Order in which the stub agent calls the PaperQA tools
+TOOL_ORDER = ("paper_search", "gather_evidence", "gen_answer", "complete")
+
+ANSWER = "Based on the retrieved papers, the measured yield is 42 percent."
+
+
+def embed(text: str, dimensions: int) -> List[float]:
+    """Deterministic unit vector for a text."""
+    digest = b""
+    counter = 0
+    while len(digest) < dimensions:
+        digest += hashlib.sha256(f"{counter}:{text}".encode()).digest()
+        counter += 1
+    vector = [byte / 255 - 0.5 for byte in digest[:dimensions]]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def tool_arguments(schema: Dict[str, Any], question: str) -> Dict[str, Any]:
+    """Fill the arguments of a tool call from its JSON schema."""
+    arguments = {}
+    for name, prop in (schema.get("properties") or {}).items():
+        if prop.get("type") == "boolean" or name == "has_successful_answer":
+            arguments[name] = True
+        elif prop.get("type") == "string" or name in ("query", "question"):
+            arguments[name] = question
+        else:
+            arguments[name] = None
+    return arguments
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Handles /chat/completions and /embeddings requests."""
+
+    latency = 0.05
+    dimensions = 256
+    rpm = None
+    requests: Dict[str, deque] = {}
+    lock = threading.Lock()
+    counts = {"ok": 0, "rate_limited": 0}
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload: Dict[str, Any]):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        retry_after = self.over_quota(body.get("model", ""))
+        if retry_after is not None:
+            self.send_rate_limited(retry_after)
+            return
+        time.sleep(self.latency)
+        if self.path.endswith("/embeddings"):
+            self.send_embeddings(body)
+        else:
+            self.send_completion(body)
+
+    def over_quota(self, model: str):
+        """Seconds until the next request fits in --rpm, None if this one does."""
+        with self.lock:
+            if self.rpm is None:
+                self.counts["ok"] += 1
+                return None
+            now = time.monotonic()
+            requests = self.requests.setdefault(model, deque())
+            while requests and now - requests[0] >= 60:
+                requests.popleft()
+            if len(requests) >= self.rpm:
+                self.counts["rate_limited"] += 1
+                return 60 - (now - requests[0])
+            requests.append(now)
+            self.counts["ok"] += 1
+            return None
+
+    def send_rate_limited(self, retry_after: float):
+        data = json.dumps(
+            {"error": {"message": "Rate limit reached", "type": "rate_limit"}}
+        ).encode()
+        self.send_response(429)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Retry-After", f"{retry_after:.3f}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # Request counts, to check how many calls were rate limited
+        self.send_json(dict(self.counts))
+
+    def send_embeddings(self, body: Dict[str, Any]):
+        texts = body["input"]
+        texts = [texts] if isinstance(texts, str) else texts
+        tokens = sum(len(str(text)) for text in texts) // 4
+        self.send_json(
+            {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": i,
+                        "embedding": embed(str(text), self.dimensions),
+                    }
+                    for i, text in enumerate(texts)
+                ],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    def send_completion(self, body: Dict[str, Any]):
+        messages = body.get("messages", [])
+        text = " ".join(str(m.get("content") or "") for m in messages)
+        prompt_tokens = len(text) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": 20,
+            "total_tokens": prompt_tokens + 20,
+        }
+        message: Dict[str, Any] = {"role": "assistant", "content": None}
+        finish_reason = "stop"
+        if body.get("tools"):
+            message["tool_calls"] = [self.tool_call(body, messages)]
+            finish_reason = "tool_calls"
+        elif "relevance_score" in text:
+            # Evidence summary, as JSON
+            message["content"] = json.dumps({"summary": ANSWER, "relevance_score": 8})
+        elif "keyword searches" in text:
+            message["content"] = "1. yield, 2000-2024\n2. synthesis\n3. catalyst"
+        else:
+            message["content"] = ANSWER
+
+        if body.get("stream"):
+            self.stream_completion(body, message["content"] or "", usage)
+            return
+        self.send_json(
+            {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {"index": 0, "message": message, "finish_reason": finish_reason}
+                ],
+                "usage": usage,
+            }
+        )
+
+    def tool_call(self, body: Dict[str, Any], messages: List[Dict]) -> Dict:
+        """Call the requested tool, or the next PaperQA tool not called yet."""
+        tools = {tool["function"]["name"]: tool["function"] for tool in body["tools"]}
+        called = {m.get("name") for m in messages if m.get("role") == "tool"}
+        choice = body.get("tool_choice")
+        if isinstance(choice, dict):
+            name = choice["function"]["name"]
+        else:
+            name = next(
+                (n for n in TOOL_ORDER if n in tools and n not in called),
+                "complete" if "complete" in tools else next(iter(tools)),
+            )
+        question = next(
+            (str(m["content"]) for m in messages if m.get("role") == "user"),
+            "question",
+        )
+        return {
+            "id": f"call_{uuid.uuid4().hex[:8]}",
+            "type": "function",
+            "function": {
+                "name": name,
+                "arguments": json.dumps(
+                    tool_arguments(tools[name].get("parameters", {}), question[:80])
+                ),
+            },
+        }
+
+    def stream_completion(self, body: Dict[str, Any], content: str, usage: Dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i in range(0, len(content), 8):
+            self.send_chunk(body, {"content": content[i : i + 8]}, None)
+        self.send_chunk(body, {}, "stop", usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def send_chunk(self, body, delta, finish_reason, usage=None):
+        chunk = {
+            "id": "stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage:
+            chunk["usage"] = usage
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds added to each request"
+    )
+    parser.add_argument("--dimensions", type=int, default=256, help="embedding size")
+    parser.add_argument(
+        "--rpm", type=int, default=None, help="requests per minute before 429s"
+    )
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    StubHandler.dimensions = args.dimensions
+    StubHandler.rpm = args.rpm
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"Stub LLM listening on http://{args.host}:{args.port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,480 @@ PaperQA API - A class-based wrapper for the PaperQA library.
 This module provides a simple class to interact with PaperQA in your projects.
 """
 
+import asyncio
+import contextlib
+import contextvars
+import functools
+import importlib
+import logging
 import os
+import sqlite3
+import statistics
+import time
 from pathlib import Path
-from typing import Dict, List, Optional, Literal
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Literal,
+    Sequence,
+    Tuple,
+)
 
-from paperqa import Settings, ask
-from paperqa.settings import AgentSettings, AnswerSettings, IndexSettings
+import litellm
+import numpy as np
+import paperqa.docs
+from litellm.integrations.custom_logger import CustomLogger
+from lmi import EmbeddingModes
+from paperqa import Docs, Settings
+from paperqa.agents import agent_query, configure_cli_logging
+from paperqa.agents.main import FAKE_AGENT_TYPE
+from paperqa.agents.models import AgentStatus
+from paperqa.agents.search import get_directory_index
+from paperqa.agents.tools import EnvironmentState, GatherEvidence, PaperSearch
+from paperqa.settings import AgentSettings, AnswerSettings, IndexSettings, get_settings
+from paperqa.types import Context, LLMResult, PQASession, Text
+from paperqa.utils import get_loop, pqa_directory
+
+from paperqa_cache import (
+    AnswerCache,
+    EvidenceCache,
+    SemanticCache,
+    fingerprint,
+    normalize_question,
+    paper_dir_fingerprint,
+)
+from paperqa_indexing import PaperIndexer
+from paperqa_metrics import (
+    METRICS,
+    RequestMetrics,
+    current_request,
+    record_llm_call,
+    track_request,
+)
+from paperqa_prefetch import Prefetched, PrefetchStore
+from paperqa_presets import PRESET_NAMES
+from paperqa_ratelimit import LLM_SCHEDULER
+from paperqa_vectors import EmbeddingStore, mmr
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_FILENAME = "answers.sqlite"
+EVIDENCE_CACHE_FILENAME = "evidence.sqlite"
+
+# Version of how chunks are summarized, part of the evidence cache scope. Bump
+# it when summaries change in a way the models and prompts don't capture.
+EVIDENCE_PROMPT_VERSION = 1
+
+# Number of search queries the fake agent generates for a question, see
+# `paperqa.agents.main.run_fake_agent`
+FAKE_AGENT_SEARCH_QUERIES = 3
+
+# Settings that change the answer to a question, part of the answer cache key
+ANSWER_CACHE_FIELDS = (
+    "llm",
+    "summary_llm",
+    "agent_llm",
+    "embedding",
+    "evidence_k",
+    "max_sources",
+    "chunk_size",
+    "preset",
+)
+
+# Settings that only change how questions are answered, by the path of the
+# field they set in `Settings`
+PATCHABLE_SETTINGS = {
+    "temperature": ("temperature",),
+    "verbosity": ("verbosity",),
+    "evidence_k": ("answer", "evidence_k"),
+    "max_sources": ("answer", "answer_max_sources"),
+    "summary_llm": ("summary_llm",),
+    "agent_llm": ("agent", "agent_llm"),
+}
+
+# Options of the indexer and the answer cache, which `Settings` doesn't hold
+INDEXER_OPTIONS = {
+    "paper_dir",
+    "index_workers",
+    "embedding_batch_size",
+    "embedding_concurrency",
+    "use_embedding_store",
+    "embedding_store_dtype",
+    "ivf_lists",
+}
+ANSWER_CACHE_OPTIONS = {
+    "use_answer_cache",
+    "answer_cache_ttl",
+    "answer_cache_max_entries",
+    "use_semantic_cache",
+    "semantic_cache_threshold",
+}
+EVIDENCE_CACHE_OPTIONS = {
+    "use_evidence_cache",
+    "evidence_cache_max_entries",
+    "evidence_cache_threshold",
+}
+# Options that can change without recreating `Settings`
+RUNTIME_OPTIONS = {
+    "api_key",
+    "provider_type",
+    *(INDEXER_OPTIONS - {"paper_dir"}),
+    *ANSWER_CACHE_OPTIONS,
+    *EVIDENCE_CACHE_OPTIONS,
+    "library_retrieval",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _load_preset(name: str) -> Settings:
+    return Settings.from_name(name)
+
+
+def preset_settings(name: str) -> Settings:
+    """
+    Get the settings of a preset configuration.
+
+    Presets are read from disk once per process.
+
+    Args:
+        name: Preset name, see `PaperQA.get_preset_names`
+
+    Returns:
+        A copy of the preset settings, safe to modify
+    """
+    return _load_preset(name).model_copy(deep=True)
+
+
+# Receives progress events while a question is answered, see `PaperQA.aask`
+EventCallback = Callable[[str, Dict[str, Any]], None]
+
+# Questions of a batch answered at the same time, see `PaperQA.aask_batch`
+DEFAULT_BATCH_CONCURRENCY = 4
+
+
+class LLMUsageLogger(CustomLogger):
+    """
+    Records the duration, tokens and cost of every LLM call made through
+    litellm, see `paperqa_metrics.record_llm_call`.
+    """
+
+    async def async_log_success_event(self, kwargs, response_obj, start_time, end_time):
+        usage = getattr(response_obj, "usage", None)
+        is_embedding = "embedding" in kwargs.get("call_type", "")
+        record_llm_call(
+            model=kwargs.get("model") or "unknown",
+            call_type="embedding" if is_embedding else "completion",
+            seconds=(end_time - start_time).total_seconds(),
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            cost=kwargs.get("response_cost") or 0.0,
+        )
+
+    async def async_log_failure_event(self, kwargs, response_obj, start_time, end_time):
+        METRICS.increment(
+            "paperqa_llm_errors_total", model=kwargs.get("model") or "unknown"
+        )
+
+
+class EvidenceLookup:
+    """
+    Evidence cache of the question being answered, see `_summarize_chunk`.
+    """
+
+    def __init__(
+        self,
+        cache: EvidenceCache,
+        scope: Dict[str, Any],
+        embed: Optional[Callable[[str], Awaitable[Optional[List[float]]]]] = None,
+        embeddings: Optional[Dict[str, Sequence[float]]] = None,
+    ):
+        """
+        Args:
+            cache: The evidence cache
+            scope: Settings the summaries depend on besides the summary model
+                and prompts, e.g. the temperature
+            embed: Embeds a question, to reuse summaries of similar questions
+            embeddings: Embeddings of the normalized questions already known,
+                by question, e.g. embedded with the rest of a batch
+        """
+        self.cache = cache
+        self.scope = scope
+        self._embed = embed
+        self._embeddings: Dict[str, asyncio.Future] = {}
+        for question, embedding in (embeddings or {}).items():
+            known = asyncio.get_running_loop().create_future()
+            known.set_result(embedding)
+            self._embeddings[normalize_question(question)] = known
+
+    async def embedding(self, question: str) -> Optional[List[float]]:
+        """Embed a question, once per question the agent gathers evidence for."""
+        if self._embed is None or self.cache.threshold is None:
+            return None
+        key = normalize_question(question)
+        if key not in self._embeddings:
+            self._embeddings[key] = asyncio.ensure_future(self._embed(question))
+        return await self._embeddings[key]
+
+
+_evidence_lookup: contextvars.ContextVar[Optional[EvidenceLookup]] = (
+    contextvars.ContextVar("paperqa_evidence_lookup", default=None)
+)
+
+_map_fxn_summary = paperqa.docs.map_fxn_summary
+
+
+async def _summarize_chunk(
+    text: Text,
+    question: str,
+    summary_llm_model,
+    prompt_templates: Optional[Tuple[str, str]],
+    extra_prompt_data: Optional[Dict[str, str]] = None,
+    parser: Optional[Callable[[str], Dict[str, Any]]] = None,
+    callbacks: Optional[Sequence[Callable[[str], None]]] = None,
+) -> Tuple[Context, LLMResult]:
+    """
+    Summarize a chunk for a question like `paperqa.core.map_fxn_summary`,
+    reusing the summary from the evidence cache of the current question.
+    """
+    lookup = _evidence_lookup.get()
+    if lookup is None or not (summary_llm_model and prompt_templates):
+        return await _map_fxn_summary(
+            text,
+            question,
+            summary_llm_model,
+            prompt_templates,
+            extra_prompt_data,
+            parser,
+            callbacks,
+        )
+
+    chunk = fingerprint(
+        {
+            "name": text.name,
+            "text": text.text,
+            "citation": text.doc.formatted_citation,
+        }
+    )
+    scope = fingerprint(
+        {
+            **lookup.scope,
+            "summary_llm": summary_llm_model.name,
+            "prompts": prompt_templates,
+            # The citation is part of the chunk
+            "prompt_data": {
+                key: value
+                for key, value in (extra_prompt_data or {}).items()
+                if key != "citation"
+            },
+            "parser": getattr(parser, "__name__", None),
+            "version": EVIDENCE_PROMPT_VERSION,
+        }
+    )
+    embedding = await lookup.embedding(question)
+    cached = lookup.cache.get(chunk, scope, question, embedding)
+    request = current_request()
+    if cached:
+        summary, similarity = cached
+        METRICS.increment(
+            "paperqa_evidence_cache_total",
+            result="hit" if similarity is None else "similar",
+        )
+        if request:
+            request.evidence_cache_hits += 1
+        context = Context(
+            context=summary["context"],
+            question=question,
+            text=Text(
+                text=text.text,
+                name=text.name,
+                doc=text.doc.model_dump(exclude={"embedding"}),
+            ),
+            score=summary["score"],
+            **summary["extras"],
+        )
+        return context, LLMResult(model="", date="")
+
+    METRICS.increment("paperqa_evidence_cache_total", result="miss")
+    context, llm_result = await _map_fxn_summary(
+        text,
+        question,
+        summary_llm_model,
+        prompt_templates,
+        extra_prompt_data,
+        parser,
+        callbacks,
+    )
+    if llm_result.text:
+        lookup.cache.put(
+            chunk,
+            scope,
+            question,
+            {
+                "context": context.context,
+                "score": context.score,
+                "extras": context.model_extra or {},
+            },
+            embedding,
+        )
+    return context, llm_result
+
+
+# Embedding store chunks are retrieved from for the current question, and
+# whether to retrieve them from the whole library, see `_retrieve_texts`
+_chunk_retrieval: contextvars.ContextVar[Optional[Tuple[EmbeddingStore, bool]]] = (
+    contextvars.ContextVar("paperqa_chunk_retrieval", default=None)
+)
+
+_docs_retrieve_texts = Docs.retrieve_texts
+_store_retrieval_installed = False
+
+
+def _install_store_retrieval():
+    """
+    Route `Docs.retrieve_texts` through `_retrieve_texts`, once an instance
+    uses the embedding store. Questions without a store in `_chunk_retrieval`
+    are still retrieved by PaperQA.
+    """
+    global _store_retrieval_installed
+    if not _store_retrieval_installed:
+        Docs.retrieve_texts = _retrieve_texts
+        _store_retrieval_installed = True
+
+
+async def _retrieve_texts(
+    self: Docs,
+    query: str,
+    k: int,
+    settings: Optional[Settings] = None,
+    embedding_model=None,
+    partitioning_fn: Optional[Callable] = None,
+) -> List[Text]:
+    """
+    Retrieve the chunks of `Docs` most relevant to a query like
+    `Docs.retrieve_texts`, scoring them in the embedding store.
+
+    With library retrieval, the papers of the most relevant chunks of the
+    whole library are added to the documents first. Falls back to PaperQA
+    when chunks of the documents aren't in the store.
+    """
+    retrieval = _chunk_retrieval.get()
+    if retrieval is None or partitioning_fn is not None:
+        return await _docs_retrieve_texts(
+            self, query, k, settings, embedding_model, partitioning_fn
+        )
+    store, library = retrieval
+    if any(
+        store.paper_chunks(dockey) != len(texts)
+        for dockey, texts in _texts_by_dockey(self).items()
+    ):
+        logger.debug("Papers missing from the embedding store, using PaperQA")
+        return await _docs_retrieve_texts(
+            self, query, k, settings, embedding_model, partitioning_fn
+        )
+
+    settings = get_settings(settings)
+    if embedding_model is None:
+        embedding_model = settings.get_embedding_model()
+    prefetched = _prefetched.get()
+    if prefetched and prefetched.query_embedding and prefetched.matches(query):
+        embedding = prefetched.query_embedding
+    else:
+        embedding_model.set_mode(EmbeddingModes.QUERY)
+        try:
+            (embedding,) = await embedding_model.embed_documents([query])
+        finally:
+            embedding_model.set_mode(EmbeddingModes.DOCUMENT)
+
+    _k = k + len(self.deleted_dockeys)
+    if library:
+        await _add_library_papers(
+            self, store, embedding, 2 * _k, settings, embedding_model
+        )
+    texts_by_dockey = _texts_by_dockey(self)
+    hits = store.search(embedding, 2 * _k, dockeys=texts_by_dockey)
+    selected = mmr(
+        np.array([hit.score for hit in hits]),
+        store.vectors([hit.row for hit in hits]),
+        _k,
+        settings.texts_index_mmr_lambda,
+    )
+    matches = [texts_by_dockey[hits[i].dockey][hits[i].index] for i in selected]
+    matches = [m for m in matches if m.doc.dockey not in self.deleted_dockeys]
+    return matches[:k]
+
+
+def _texts_by_dockey(docs: Docs) -> Dict[str, List[Text]]:
+    """Group the chunks of `Docs` by document, in order."""
+    texts_by_dockey: Dict[str, List[Text]] = {}
+    for text in docs.texts:
+        texts_by_dockey.setdefault(text.doc.dockey, []).append(text)
+    return texts_by_dockey
+
+
+async def _add_library_papers(
+    docs: Docs,
+    store: EmbeddingStore,
+    embedding: Sequence[float],
+    k: int,
+    settings: Settings,
+    embedding_model,
+):
+    """Add the papers of the chunks most similar to a query in the store to `docs`."""
+    hits = store.search(embedding, k)
+    missing = dict.fromkeys(h.file_location for h in hits if h.dockey not in docs.docs)
+    if not missing:
+        return
+    search_index = await get_directory_index(settings=settings, build=False)
+    for file_location in missing:
+        saved = await search_index.get_saved_object(file_location)
+        if saved and saved.texts:
+            await docs.aadd_texts(
+                texts=saved.texts,
+                doc=next(iter(saved.docs.values())),
+                settings=settings,
+                embedding_model=embedding_model,
+            )
+
+
+# Retrieval results prefetched for the current question, see `PaperQA.aprefetch`
+_prefetched: contextvars.ContextVar[Optional[Prefetched]] = contextvars.ContextVar(
+    "paperqa_prefetched", default=None
+)
+
+# `paperqa.agents.main` is shadowed by the `main` function of `paperqa.agents`
+_agents_main = importlib.import_module("paperqa.agents.main")
+_litellm_get_search_query = _agents_main.litellm_get_search_query
+
+
+async def _get_search_query(question: str, count: int, **kwargs) -> List[str]:
+    """
+    Generate paper search queries for a question like
+    `litellm_get_search_query`, reusing those prefetched for it.
+    """
+    prefetched = _prefetched.get()
+    if (
+        prefetched
+        and prefetched.search_queries is not None
+        and prefetched.search_count == count
+        and kwargs.get("template") is None
+        and prefetched.matches(question)
+    ):
+        return prefetched.search_queries
+    return await _litellm_get_search_query(question, count, **kwargs)
+
+
+litellm.callbacks.append(LLMUsageLogger())
+LLM_SCHEDULER.install()
+# Evidence is gathered by `Docs.aget_evidence`, which summarizes each chunk
+# with `map_fxn_summary`
+paperqa.docs.map_fxn_summary = _summarize_chunk
+# The fake agent starts by generating search queries for the question
+_agents_main.litellm_get_search_query = _get_search_query
 
 
 class PaperQA:
@@ -35,6 +503,21 @@ class PaperQA:
         index_name: Optional[str] = None,
         api_key: Optional[str] = None,
         provider_type: Literal["openai", "anthropic", "gemini"] = "gemini",
+        use_answer_cache: bool = False,
+        answer_cache_ttl: Optional[float] = 7 * 24 * 3600,
+        answer_cache_max_entries: int = 1000,
+        use_semantic_cache: bool = False,
+        semantic_cache_threshold: float = 0.92,
+        use_evidence_cache: bool = True,
+        evidence_cache_max_entries: int = 20000,
+        evidence_cache_threshold: Optional[float] = None,
+        index_workers: Optional[int] = None,
+        embedding_batch_size: int = 32,
+        embedding_concurrency: int = 4,
+        use_embedding_store: bool = False,
+        embedding_store_dtype: str = "float16",
+        ivf_lists: Optional[int] = None,
+        library_retrieval: bool = False,
     ):
         """
         Initialize the PaperQA wrapper.
@@ -56,6 +539,30 @@ class PaperQA:
             index_name: Custom name for the index
             api_key: API key for the LLM provider
             provider_type: Type of provider (openai, anthropic, or gemini)
+            use_answer_cache: Reuse answers to previously asked questions
+            answer_cache_ttl: Seconds after which cached answers expire
+            answer_cache_max_entries: Maximum number of cached answers
+            use_semantic_cache: Also reuse answers to paraphrased questions,
+                matched by embedding similarity (requires use_answer_cache)
+            semantic_cache_threshold: Minimum cosine similarity for a match
+            use_evidence_cache: Reuse summaries of the same chunks made for
+                earlier questions
+            evidence_cache_max_entries: Maximum number of cached summaries
+            evidence_cache_threshold: Minimum cosine similarity between two
+                questions for the summaries of one to be reused for the other,
+                None to only reuse summaries of the same question
+            index_workers: Number of processes parsing papers when indexing,
+                defaults to the number of CPUs
+            embedding_batch_size: Chunks per embedding request when indexing
+            embedding_concurrency: Maximum number of embedding requests in flight
+                when indexing
+            use_embedding_store: Keep chunk embeddings in a memory-mapped store
+                and retrieve evidence from it
+            embedding_store_dtype: "float16" or "float32"
+            ivf_lists: Number of IVF lists of the embedding store, None to
+                partition large stores automatically, 0 to never partition
+            library_retrieval: Retrieve evidence from the chunks of the whole
+                library, not only of the papers found by the paper search
         """
         # Check if paper directory exists
         paper_dir = Path(paper_dir).expanduser()
@@ -78,6 +585,29 @@ class PaperQA:
         self.index_name = index_name
         self.api_key = api_key
         self.provider_type = provider_type
+        self.use_answer_cache = use_answer_cache
+        self.answer_cache_ttl = answer_cache_ttl
+        self.answer_cache_max_entries = answer_cache_max_entries
+        self.use_semantic_cache = use_semantic_cache
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self.use_evidence_cache = use_evidence_cache
+        self.evidence_cache_max_entries = evidence_cache_max_entries
+        self.evidence_cache_threshold = evidence_cache_threshold
+        self.index_workers = index_workers
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_concurrency = embedding_concurrency
+        self.use_embedding_store = use_embedding_store
+        self.embedding_store_dtype = embedding_store_dtype
+        self.ivf_lists = ivf_lists
+        self.library_retrieval = library_retrieval
+        self.answer_cache = None
+        self.semantic_cache = None
+        self.evidence_cache = None
+        self.prefetches = PrefetchStore()
+        self.indexer = None
+        self._create_indexer()
+        self.warmup_status: Dict[str, Any] = {}
+        self._mark_cold()
 
         # Set the appropriate API key in environment
         if self.api_key:
@@ -85,6 +615,8 @@ class PaperQA:
 
         # Create settings
         self._create_settings()
+        self._create_answer_cache()
+        self._create_evidence_cache()
 
     def _set_provider_api_key(self):
         """Set the appropriate API key in environment based on provider type."""
@@ -102,6 +634,12 @@ class PaperQA:
 
     def _create_settings(self):
         """Create the settings object."""
+        agent_settings = {
+            "agent_llm": self.agent_llm,
+            "index": IndexSettings(
+                paper_directory=self.paper_dir, name=self.index_name
+            ),
+        }
         # Build settings dictionary
         settings_dict = {
             "paper_directory": self.paper_dir,
@@ -113,113 +651,991 @@ class PaperQA:
             "answer": AnswerSettings(
                 evidence_k=self.evidence_k, answer_max_sources=self.max_sources
             ),
-            "agent": AgentSettings(
-                agent_llm=self.agent_llm,
-                index=IndexSettings(
-                    paper_directory=self.paper_dir, name=self.index_name
-                ),
-            ),
             "parsing": {"chunk_size": self.chunk_size},
         }
 
+        self._set_rate_limits()
+        settings_dict["agent"] = AgentSettings(**agent_settings)
+
         # Use preset if specified
         if self.preset:
-            preset_settings = Settings.from_name(self.preset)
-            preset_dict = preset_settings.model_dump()
+            preset_dict = preset_settings(self.preset).model_dump()
             # Override preset with our specific settings
-            for key, value in settings_dict.items():
-                preset_dict[key] = value
+            preset_dict.update(settings_dict)
             self.settings = Settings(**preset_dict)
         else:
             self.settings = Settings(**settings_dict)
 
-        # Configure rate limits
+    def _set_rate_limits(self):
+        """
+        Register the rate limits of the instance's models with the scheduler.
+
+        They are enforced by the process-wide LLM scheduler rather than per
+        settings object, so that all questions and instances share the provider
+        quota. Limits this instance no longer sets are dropped, and where
+        instances disagree the strictest limit applies.
+        """
+        limits: Dict[str, str] = {}
         if self.use_tier1_limits:
-            tier1_settings = Settings.from_name("tier1_limits")
-            self.settings = Settings(
-                **{
-                    **self.settings.model_dump(),
-                    "llm_config": tier1_settings.llm_config,
-                    "summary_llm_config": tier1_settings.summary_llm_config,
-                    "agent": AgentSettings(
-                        **{
-                            **self.settings.agent.model_dump(),
-                            "agent_llm_config": tier1_settings.agent.agent_llm_config,
-                        }
-                    ),
-                }
-            )
+            tier1_settings = preset_settings("tier1_limits")
+            for config in (
+                tier1_settings.llm_config,
+                tier1_settings.summary_llm_config,
+                tier1_settings.agent.agent_llm_config,
+            ):
+                limits.update(((config or {}).get("rate_limit") or {}).items())
+            embedding_config = tier1_settings.embedding_config or {}
+            if embedding_config.get("rate_limit"):
+                limits[self.embedding] = embedding_config["rate_limit"]
         elif self.rate_limit:
-            rate_limit_config = {"rate_limit": {self.llm: self.rate_limit}}
-            self.settings = Settings(
-                **{
-                    **self.settings.model_dump(),
-                    "llm_config": rate_limit_config,
-                    "summary_llm_config": rate_limit_config,
-                    "agent": AgentSettings(
-                        **{
-                            **self.settings.agent.model_dump(),
-                            "agent_llm_config": rate_limit_config,
-                        }
-                    ),
-                }
+            for model in {self.llm, self.summary_llm, self.agent_llm, self.embedding}:
+                limits[model] = self.rate_limit
+        LLM_SCHEDULER.set_limits(id(self), limits)
+
+    def _patch_settings(self, values: Dict[str, Any]):
+        """
+        Apply answer-only settings to a copy of the current settings object.
+
+        Questions in flight keep the settings they started with.
+
+        Args:
+            values: New values, keyed by the names in `PATCHABLE_SETTINGS`
+        """
+        updates: Dict[str, Any] = {}
+        nested: Dict[str, Dict[str, Any]] = {}
+        for key, value in values.items():
+            path = PATCHABLE_SETTINGS[key]
+            if len(path) == 1:
+                updates[path[0]] = value
+            else:
+                nested.setdefault(path[0], {})[path[1]] = value
+        for name, fields in nested.items():
+            updates[name] = getattr(self.settings, name).model_copy(update=fields)
+        self.settings = self.settings.model_copy(update=updates)
+        if values.keys() & {"summary_llm", "agent_llm"}:
+            # The models the limits apply to changed
+            self._set_rate_limits()
+
+    def _create_indexer(self):
+        """Create the indexer of the paper directory, replacing the previous one."""
+        if self.indexer:
+            self.indexer.close()
+        if self.use_embedding_store:
+            _install_store_retrieval()
+        self.indexer = PaperIndexer(
+            self.paper_dir,
+            workers=self.index_workers,
+            embedding_batch_size=self.embedding_batch_size,
+            embedding_concurrency=self.embedding_concurrency,
+            use_embedding_store=self.use_embedding_store,
+            embedding_store_dtype=self.embedding_store_dtype,
+            ivf_lists=self.ivf_lists,
+        )
+
+    def close(self):
+        """Release the indexing worker processes, the caches and rate limits."""
+        LLM_SCHEDULER.set_limits(id(self), {})
+        self.indexer.close()
+        if self.answer_cache:
+            self.answer_cache.close()
+        if self.semantic_cache:
+            self.semantic_cache.close()
+        if self.evidence_cache:
+            self.evidence_cache.close()
+
+    def _create_answer_cache(self):
+        """Open the answer caches, or close them if caching was turned off."""
+        if not self.use_answer_cache:
+            if self.answer_cache:
+                self.answer_cache.close()
+            if self.semantic_cache:
+                self.semantic_cache.close()
+            self.answer_cache = None
+            self.semantic_cache = None
+            return
+
+        if self.answer_cache is None:
+            self.answer_cache = AnswerCache(
+                pqa_directory("cache") / ANSWER_CACHE_FILENAME,
+                max_entries=self.answer_cache_max_entries,
+                ttl=self.answer_cache_ttl,
+            )
+        else:
+            self.answer_cache.max_entries = self.answer_cache_max_entries
+            self.answer_cache.ttl = self.answer_cache_ttl
+
+        if not self.use_semantic_cache:
+            if self.semantic_cache:
+                self.semantic_cache.close()
+            self.semantic_cache = None
+        elif self.semantic_cache is None:
+            # Questions are indexed in the database of the answers they point to
+            self.semantic_cache = SemanticCache(
+                pqa_directory("cache") / ANSWER_CACHE_FILENAME,
+                threshold=self.semantic_cache_threshold,
+                max_entries=self.answer_cache_max_entries,
             )
+        else:
+            self.semantic_cache.threshold = self.semantic_cache_threshold
+            self.semantic_cache.max_entries = self.answer_cache_max_entries
+
+    def _create_evidence_cache(self):
+        """Open the evidence cache, or close it if caching was turned off."""
+        if not self.use_evidence_cache:
+            if self.evidence_cache:
+                self.evidence_cache.close()
+            self.evidence_cache = None
+        elif self.evidence_cache is None:
+            self.evidence_cache = EvidenceCache(
+                pqa_directory("cache") / EVIDENCE_CACHE_FILENAME,
+                max_entries=self.evidence_cache_max_entries,
+                threshold=self.evidence_cache_threshold,
+            )
+        else:
+            self.evidence_cache.max_entries = self.evidence_cache_max_entries
+            self.evidence_cache.threshold = self.evidence_cache_threshold
+
+    def _evidence_lookup(
+        self,
+        settings: Settings,
+        embeddings: Optional[Dict[str, Sequence[float]]] = None,
+    ) -> Optional[EvidenceLookup]:
+        """Set up the evidence cache for a question, None if caching is off."""
+        if not self.evidence_cache:
+            return None
+
+        async def embed(question: str) -> Optional[List[float]]:
+            (embedding,) = await self._embed_questions([question])
+            return embedding
+
+        return EvidenceLookup(
+            self.evidence_cache,
+            {"temperature": settings.temperature},
+            embed,
+            embeddings,
+        )
+
+    def _needs_question_embeddings(self) -> bool:
+        """Whether the caches compare questions by embedding."""
+        return bool(
+            self.semantic_cache
+            or (self.evidence_cache and self.evidence_cache.threshold is not None)
+        )
 
-    def ask(self, question: str) -> Dict:
+    @contextlib.contextmanager
+    def _retrieval_context(
+        self,
+        settings: Settings,
+        prefetched: Optional[Prefetched] = None,
+        embeddings: Optional[Dict[str, Sequence[float]]] = None,
+    ) -> Iterator[None]:
+        """
+        Route the retrieval of the enclosed question through the evidence
+        cache, the embedding store and the prefetched results.
+
+        Args:
+            settings: Settings the question is answered with
+            prefetched: Results prefetched for the question
+            embeddings: Embeddings of normalized questions already known, by
+                question
+        """
+        store = self.indexer.embedding_store(settings)
+        lookup = self._evidence_lookup(settings, embeddings)
+        tokens = (
+            (_evidence_lookup, _evidence_lookup.set(lookup)),
+            (
+                _chunk_retrieval,
+                _chunk_retrieval.set(
+                    (store, self.library_retrieval) if store else None
+                ),
+            ),
+            (_prefetched, _prefetched.set(prefetched)),
+        )
+        try:
+            yield
+        finally:
+            for var, token in tokens:
+                var.reset(token)
+
+    def _settings_fingerprint(self) -> str:
+        """Fingerprint the settings that influence answers."""
+        return fingerprint({key: getattr(self, key) for key in ANSWER_CACHE_FIELDS})
+
+    async def _lookup_answer_cache(
+        self, question: str, embedding: Optional[Sequence[float]] = None
+    ) -> Tuple[Optional[Dict], Optional[Dict[str, Any]]]:
+        """
+        Look a question up in the answer caches.
+
+        Args:
+            question: The question to ask
+            embedding: Embedding of the normalized question, if already known
+
+        Returns:
+            Tuple of the cached result (None on a miss) and the cache entry to
+            store a fresh answer under (None if caching is disabled)
+        """
+        answer_cache, semantic_cache = self.answer_cache, self.semantic_cache
+        if not answer_cache:
+            return None, None
+
+        paper_fingerprint = paper_dir_fingerprint(self.paper_dir)
+        settings_fingerprint = self._settings_fingerprint()
+        if answer_cache.invalidate(self.paper_dir, paper_fingerprint):
+            logger.info(f"Papers in {self.paper_dir} changed, dropped old answers")
+        entry = {
+            "key": AnswerCache.make_key(
+                question, settings_fingerprint, paper_fingerprint
+            ),
+            "paper_fingerprint": paper_fingerprint,
+            "settings_fingerprint": settings_fingerprint,
+            "scope": fingerprint(
+                {"settings": settings_fingerprint, "papers": paper_fingerprint}
+            ),
+            "embedding": embedding,
+        }
+        cached = answer_cache.get(entry["key"])
+        if cached:
+            return {**cached, "cached": True, "cache_match": "exact"}, entry
+        if not semantic_cache:
+            return None, entry
+
+        if entry["embedding"] is None:
+            (entry["embedding"],) = await self._embed_questions([question])
+            if entry["embedding"] is None:
+                return None, entry
+        match = semantic_cache.lookup(entry["embedding"], entry["scope"])
+        if match:
+            key, similarity = match
+            cached = answer_cache.get(key)
+            if cached:
+                return {
+                    **cached,
+                    "cached": True,
+                    "cache_match": "semantic",
+                    "similarity": similarity,
+                    "cached_question": cached["question"],
+                }, entry
+        return None, entry
+
+    async def _embed_questions(
+        self, questions: List[str]
+    ) -> List[Optional[List[float]]]:
+        """
+        Embed normalized questions for the semantic cache, in a single request.
+
+        Args:
+            questions: Questions to embed
+
+        Returns:
+            Embeddings of the questions, all None if they couldn't be embedded
+        """
+        try:
+            embedding_model = self.settings.get_embedding_model()
+            return await embedding_model.embed_documents(
+                [normalize_question(question) for question in questions],
+                batch_size=max(len(questions), 1),
+            )
+        except Exception as e:
+            # The semantic cache is best effort, just answer the questions
+            logger.warning(f"Could not embed questions for the semantic cache: {e}")
+            return [None] * len(questions)
+
+    def _store_answer(self, entry: Dict[str, Any], question: str, result: Dict):
+        """Store a fresh answer in the answer caches, on a best effort basis."""
+        answer_cache, semantic_cache = self.answer_cache, self.semantic_cache
+        if not answer_cache:
+            return
+        try:
+            answer_cache.put(
+                entry["key"],
+                result,
+                question=question,
+                paper_dir=self.paper_dir,
+                paper_fingerprint=entry["paper_fingerprint"],
+                settings_fingerprint=entry["settings_fingerprint"],
+            )
+            if semantic_cache and entry["embedding"] is not None:
+                semantic_cache.add(entry["key"], entry["scope"], entry["embedding"])
+        except (sqlite3.Error, OSError) as e:
+            # The answer is there already, a failed write only costs cache hits
+            logger.warning(f"Could not cache the answer to {question!r}: {e}")
+
+    def ask(
+        self,
+        question: str,
+        on_event: Optional[EventCallback] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict:
         """
         Ask a question to PaperQA.
 
         Args:
             question: The question to ask
+            on_event: Optional callback receiving progress events, see `aask`
+            timeout: Seconds after which to stop and return the evidence
+                gathered so far, see `aask`
 
         Returns:
             Dict containing the response with answer, formatted_answer, references, etc.
         """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        return get_loop().run_until_complete(
+            self.aask(question, on_event=on_event, deadline=deadline)
+        )
+
+    async def aask(
+        self,
+        question: str,
+        on_event: Optional[EventCallback] = None,
+        question_embedding: Optional[Sequence[float]] = None,
+        deadline: Optional[float] = None,
+    ) -> Dict:
+        """
+        Ask a question to PaperQA on the running event loop.
+
+        Unlike `ask`, this does not create an event loop per question, so
+        clients, rate limiters and index handles stay warm across questions
+        sharing the same loop.
+
+        Args:
+            question: The question to ask
+            on_event: Optional callback called as ``on_event(event, data)`` while
+                the question is being answered. Events are "index_search" (papers
+                found), "evidence" (contexts gathered, with scores), "token"
+                (answer text as it is generated) and "answer" (final result).
+            question_embedding: Embedding of the normalized question for the
+                semantic and evidence caches, if already known
+            deadline: `time.monotonic()` time at which to stop the agent. The
+                result then has status "timeout" and holds the evidence
+                gathered so far, and the answer if it was already generated.
+
+        Returns:
+            Dict containing the response with answer, formatted_answer, references,
+            etc., and the `metrics` of the question (time per stage, LLM calls,
+            tokens and cost)
+        """
         # Check if API key is set
         if not self.is_api_key_configured():
             return {
                 "status": "error",
                 "message": "API key not configured. Please set it in Settings.",
             }
-        # Run PaperQA
-        response = ask(question, settings=self.settings)
+
+        request = RequestMetrics()
+        with track_request(request):
+            # Answer from the cache when the papers and settings are unchanged
+            with request.stage("cache_lookup"):
+                cached, cache_entry = await self._lookup_answer_cache(
+                    question, question_embedding
+                )
+            if cached:
+                result = {**cached, "question": question}
+            else:
+                result = await self._run_agent(
+                    question,
+                    cache_entry,
+                    request,
+                    on_event,
+                    deadline,
+                    # The semantic cache lookup may have embedded the question
+                    cache_entry["embedding"] if cache_entry else question_embedding,
+                )
+
+        request.record(
+            preset=self.preset or "none", cached="true" if cached else "false"
+        )
+        result["metrics"] = request.as_dict()
+        if on_event:
+            on_event("answer", result)
+        return result
+
+    async def _run_agent(
+        self,
+        question: str,
+        cache_entry: Optional[Dict[str, Any]],
+        request: RequestMetrics,
+        on_event: Optional[EventCallback],
+        deadline: Optional[float] = None,
+        question_embedding: Optional[Sequence[float]] = None,
+    ) -> Dict:
+        """
+        Answer a question with the PaperQA agent and cache the answer.
+
+        Args:
+            question: The question to ask
+            cache_entry: Answer cache entry to store the answer in, if caching
+            request: Metrics of the question, receiving the time per stage
+            on_event: Optional callback receiving progress events, see `aask`
+            deadline: `time.monotonic()` time at which to stop the agent
+            question_embedding: Embedding of the normalized question, reused
+                by the evidence cache
+
+        Returns:
+            Dict containing the response with answer, formatted_answer, references, etc.
+        """
+        configure_cli_logging(self.settings)
+        settings = self.settings
+        if self.indexer.is_built(settings):
+            # The index is kept up to date by `aindex`, don't rescan the papers
+            settings = settings.model_copy(
+                update={
+                    "agent": settings.agent.model_copy(update={"rebuild_index": False})
+                }
+            )
+        state_holder: Dict[str, Any] = {}
+        settings, runner_kwargs = self._with_callbacks(
+            settings, request, state_holder, on_event
+        )
+        timeout = deadline - time.monotonic() if deadline is not None else None
+        try:
+            async with asyncio.timeout(timeout):
+                with request.stage("prefetch_wait"):
+                    prefetched = await self.prefetches.take(question)
+                request.prefetched = prefetched is not None
+                embeddings = (
+                    {question: question_embedding}
+                    if question_embedding is not None
+                    else None
+                )
+                with self._retrieval_context(settings, prefetched, embeddings):
+                    response = await agent_query(
+                        question,
+                        settings,
+                        docs=prefetched.docs if prefetched else None,
+                        agent_type=settings.agent.agent_type,
+                        **runner_kwargs,
+                    )
+        except TimeoutError:
+            logger.warning(
+                f"Deadline reached for {question!r}, returning the evidence"
+                " gathered so far"
+            )
+            state = state_holder.get("state")
+            return {
+                "status": "timeout",
+                "message": "Deadline reached, returning the evidence gathered so far",
+                **self._format_session(question, state.session if state else None),
+            }
 
         # Return result as a dictionary
+        result = self._format_session(question, response.session)
+        if cache_entry and response.status == AgentStatus.SUCCESS:
+            self._store_answer(cache_entry, question, result)
+        return result
+
+    async def aprefetch(self, question: str, gather_evidence: bool = False) -> Dict:
+        """
+        Run the retrieval steps of a question before it is asked.
+
+        Generates the paper search queries, searches the papers and embeds
+        the question, and with `gather_evidence` summarizes the most relevant
+        chunks into the evidence cache. Asking the question within
+        `prefetches.ttl` seconds starts from these results. Prefetches of
+        earlier or later versions of the question are cancelled.
+
+        Args:
+            question: The question as typed so far
+            gather_evidence: Also summarize the most relevant chunks, which
+                takes LLM calls that are wasted if the question changes
+
+        Returns:
+            Dict with a summary of what was prefetched, status "cancelled" if
+            a newer version of the question was prefetched or asked meanwhile
+        """
+        if not question.strip():
+            return {"status": "error", "message": "No question to prefetch"}
+        if not self.is_api_key_configured():
+            return {
+                "status": "error",
+                "message": "API key not configured. Please set it in Settings.",
+            }
+        cached, _ = await self._lookup_answer_cache(question)
+        if cached:
+            return {"status": "success", "message": "Answer already cached"}
+        if not self.indexer.is_built(self.settings):
+            return {"status": "error", "message": "Papers not indexed yet"}
+
+        task = self.prefetches.start(
+            question,
+            functools.partial(
+                self._prefetch, settings=self.settings, gather_evidence=gather_evidence
+            ),
+        )
+        try:
+            prefetched = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            return {
+                "status": "cancelled",
+                "message": "A newer version of the question was prefetched or asked",
+            }
+        return {"status": "success", "prefetched": prefetched.summary()}
+
+    async def _prefetch(
+        self, prefetched: Prefetched, settings: Settings, gather_evidence: bool
+    ):
+        """Fill in the retrieval results of a question, see `aprefetch`."""
+        question = prefetched.question
+        embedding_model = settings.get_embedding_model()
+        if settings.agent.agent_type == FAKE_AGENT_TYPE:
+            prefetched.search_count = FAKE_AGENT_SEARCH_QUERIES
+            prefetched.search_queries = await _litellm_get_search_query(
+                question, count=prefetched.search_count, llm=settings.get_llm()
+            )
+            queries = prefetched.search_queries
+        else:
+            # The agent picks its own queries, search for the question itself
+            queries = [question]
+
+        state = EnvironmentState(docs=Docs(), session=PQASession(question=question))
+        search = PaperSearch(settings=settings, embedding_model=embedding_model)
+        await asyncio.gather(
+            *(
+                search.paper_search(query, min_year=None, max_year=None, state=state)
+                for query in queries
+            )
+        )
+
+        embedding_model.set_mode(EmbeddingModes.QUERY)
+        try:
+            (prefetched.query_embedding,) = await embedding_model.embed_documents(
+                [question]
+            )
+        finally:
+            embedding_model.set_mode(EmbeddingModes.DOCUMENT)
+
+        if gather_evidence and state.docs.docs and self.evidence_cache:
+            # Summaries land in the evidence cache, where the question finds them
+            gather = GatherEvidence(
+                settings=settings,
+                summary_llm_model=settings.get_summary_llm(),
+                embedding_model=embedding_model,
+            )
+            with self._retrieval_context(settings, prefetched):
+                await gather.gather_evidence(question, state)
+            prefetched.evidence = True
+        prefetched.docs = state.docs
+
+    def ask_batch(
+        self,
+        questions: List[str],
+        concurrency: int = DEFAULT_BATCH_CONCURRENCY,
+        on_result: Optional[Callable[[int, Dict], None]] = None,
+    ) -> Dict:
+        """
+        Ask many questions to PaperQA.
+
+        Args:
+            questions: The questions to ask
+            concurrency: Maximum number of questions answered at the same time
+            on_result: Optional callback receiving each result, see `aask_batch`
+
+        Returns:
+            Dict with the results and the timing of the batch
+        """
+        return get_loop().run_until_complete(
+            self.aask_batch(questions, concurrency=concurrency, on_result=on_result)
+        )
+
+    async def aask_batch(
+        self,
+        questions: List[str],
+        concurrency: int = DEFAULT_BATCH_CONCURRENCY,
+        on_result: Optional[Callable[[int, Dict], None]] = None,
+        on_event: Optional[EventCallback] = None,
+        deadline: Optional[float] = None,
+    ) -> Dict:
+        """
+        Ask many questions to PaperQA on the running event loop.
+
+        The index is built up front if needed and shared by all questions, and
+        the questions are embedded in a single request when the semantic or
+        evidence cache compares them by embedding.
+        The LLM calls of all questions go through the same rate limiters, so
+        the configured rate limits hold for the batch as a whole.
+
+        Args:
+            questions: The questions to ask
+            concurrency: Maximum number of questions answered at the same time
+            on_result: Optional callback called as ``on_result(index, result)``
+                as soon as the question at that index is answered
+            on_event: Optional callback receiving the progress events of all
+                questions, see `aask`, with the `index` of the question added
+            deadline: `time.monotonic()` time at which to stop all questions,
+                see `aask`
+
+        Returns:
+            Dict with the results ("status" and the fields returned by `aask`)
+            in the order of the questions, and the timing of the batch
+        """
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+        if not self.is_api_key_configured():
+            return {
+                "status": "error",
+                "message": "API key not configured. Please set it in Settings.",
+            }
+        start = time.perf_counter()
+        if not self.indexer.is_built(self.settings):
+            # Otherwise every question would scan the paper directory at once.
+            # At the deadline the build goes on for later questions, but the
+            # batch stops waiting for it.
+            build = asyncio.ensure_future(self.aindex())
+            timeout = deadline - time.monotonic() if deadline is not None else None
+            try:
+                async with asyncio.timeout(timeout):
+                    await asyncio.shield(build)
+            except TimeoutError:
+                logger.warning("Deadline reached while building the index")
+                results = [
+                    {
+                        "status": "timeout",
+                        "question": question,
+                        "message": "Deadline reached while building the index",
+                    }
+                    for question in questions
+                ]
+                if on_result:
+                    for index, result in enumerate(results):
+                        on_result(index, result)
+                return {
+                    "results": results,
+                    "timing": self._batch_timing(results, [], start),
+                }
+        if self._needs_question_embeddings():
+            embeddings = await self._embed_questions(questions)
+        else:
+            embeddings = [None] * len(questions)
+
+        slots = asyncio.Semaphore(concurrency)
+        results: List[Optional[Dict]] = [None] * len(questions)
+        durations = [0.0] * len(questions)
+
+        async def ask_one(index: int, question: str):
+            question_event = None
+            if on_event:
+
+                def question_event(event: str, data: Dict[str, Any]):
+                    on_event(event, {**data, "index": index})
+
+            async with slots:
+                question_start = time.perf_counter()
+                try:
+                    result = await self.aask(
+                        question,
+                        on_event=question_event,
+                        question_embedding=embeddings[index],
+                        deadline=deadline,
+                    )
+                    result = {"status": "success", **result}
+                except Exception as e:
+                    logger.error(f"Error asking question {question!r}: {str(e)}")
+                    result = {
+                        "status": "error",
+                        "question": question,
+                        "message": str(e),
+                    }
+                durations[index] = time.perf_counter() - question_start
+            results[index] = result
+            if on_result:
+                on_result(index, result)
+
+        await asyncio.gather(
+            *(ask_one(index, question) for index, question in enumerate(questions))
+        )
+        return {
+            "results": results,
+            "timing": self._batch_timing(results, durations, start),
+        }
+
+    @staticmethod
+    def _batch_timing(
+        results: List[Dict], durations: List[float], start: float
+    ) -> Dict[str, Any]:
+        """Summarize how long a batch of questions took."""
+        seconds = time.perf_counter() - start
+        timing = {
+            "seconds": round(seconds, 3),
+            "questions": len(results),
+            "succeeded": sum(r["status"] == "success" for r in results),
+            "timed_out": sum(r["status"] == "timeout" for r in results),
+            "cached": sum(bool(r.get("cached")) for r in results),
+            "questions_per_minute": round(len(results) * 60 / seconds, 2),
+        }
+        if durations:
+            timing["question_seconds"] = {
+                "mean": round(statistics.mean(durations), 3),
+                "median": round(statistics.median(durations), 3),
+                "p95": round(
+                    (
+                        statistics.quantiles(durations, n=20, method="inclusive")[-1]
+                        if len(durations) > 1
+                        else durations[0]
+                    ),
+                    3,
+                ),
+                "max": round(max(durations), 3),
+            }
+        return timing
+
+    @staticmethod
+    def _with_callbacks(
+        settings: Settings,
+        request: RequestMetrics,
+        state_holder: Dict[str, Any],
+        on_event: Optional[EventCallback] = None,
+    ) -> Tuple[Settings, Dict[str, Any]]:
+        """
+        Hook stage timings and progress events into the run of a single question.
+
+        Time until the agent starts is recorded as the "setup" stage, time
+        spent by the agent choosing tools as "agent", and the time of each tool
+        call under the tool's name (e.g. "paper_search", "gather_evidence" or
+        "gen_answer"). The environment state of the agent is put in
+        `state_holder` under "state" once the agent starts.
+
+        Returns:
+            Tuple of the per-question settings and the agent runner kwargs
+        """
+        clock = {"mark": time.perf_counter(), "tools": ""}
+
+        def lap(stage: str):
+            now = time.perf_counter()
+            request.add_stage(stage, now - clock["mark"])
+            clock["mark"] = now
+
+        async def on_evidence(state) -> None:
+            contexts = sorted(
+                state.session.contexts, key=lambda ctx: ctx.score, reverse=True
+            )
+            on_event(
+                "evidence",
+                {"contexts": [PaperQA._format_context(ctx) for ctx in contexts]},
+            )
+
+        def on_token(text: str) -> None:
+            on_event("token", {"text": text})
+
+        async def on_env_reset(state) -> None:
+            state_holder["state"] = state
+            lap("setup")
+
+        async def on_agent_action(action, *args) -> None:
+            lap("agent")
+            # LDP agents pass the tool request wrapped in an OpResult
+            message = getattr(action, "value", action)
+            names = {call.function.name for call in getattr(message, "tool_calls", [])}
+            clock["tools"] = "+".join(sorted(names))
+
+        async def on_env_step(obs, reward, done, truncated) -> None:
+            lap(clock["tools"] or "tools")
+            if not on_event:
+                return
+            state = state_holder.get("state")
+            for message in obs:
+                if getattr(message, "name", None) == "paper_search" and state:
+                    on_event(
+                        "index_search",
+                        {
+                            "papers": [
+                                doc.formatted_citation or doc.docname
+                                for doc in state.docs.docs.values()
+                            ]
+                        },
+                    )
+
+        runner_kwargs = {
+            "on_env_reset_callback": on_env_reset,
+            "on_agent_action_callback": on_agent_action,
+            "on_env_step_callback": on_env_step,
+        }
+        if not on_event:
+            return settings, runner_kwargs
+
+        callbacks = {
+            **settings.agent.callbacks,
+            "gather_evidence_completed": [
+                *settings.agent.callbacks.get("gather_evidence_completed", []),
+                on_evidence,
+            ],
+            "gen_answer_aget_query": [
+                *settings.agent.callbacks.get("gen_answer_aget_query", []),
+                on_token,
+            ],
+        }
+        settings = settings.model_copy(
+            update={"agent": settings.agent.model_copy(update={"callbacks": callbacks})}
+        )
+        return settings, runner_kwargs
+
+    @staticmethod
+    def _format_context(ctx) -> Dict:
+        """Convert a PaperQA context into a plain dictionary."""
+        return {
+            "context": ctx.context,
+            "text_name": ctx.text.name
+            if hasattr(ctx, "text") and hasattr(ctx.text, "name")
+            else "",
+            "score": float(ctx.score) if hasattr(ctx, "score") else None,
+        }
+
+    @staticmethod
+    def _format_session(question: str, session) -> Dict:
+        """Convert a PaperQA session, if any, into a plain dictionary."""
+        if session is None:
+            return {
+                "question": question,
+                "answer": "",
+                "formatted_answer": "",
+                "references": "",
+                "contexts": [],
+            }
         return {
             "question": question,
-            "answer": response.session.answer,
-            "formatted_answer": response.session.formatted_answer,
-            "references": response.session.references,
-            "contexts": [
-                {
-                    "context": ctx.context,
-                    "text_name": ctx.text.name
-                    if hasattr(ctx, "text") and hasattr(ctx.text, "name")
-                    else "",
-                    "score": float(ctx.score) if hasattr(ctx, "score") else None,
-                }
-                for ctx in response.session.contexts
-            ]
-            if hasattr(response.session, "contexts")
+            "answer": session.answer,
+            "formatted_answer": session.formatted_answer,
+            "references": session.references,
+            "contexts": [PaperQA._format_context(ctx) for ctx in session.contexts]
+            if hasattr(session, "contexts")
             else [],
         }
 
-    def update_settings(self, **kwargs):
+    def index(self, rebuild: bool = False) -> Dict:
+        """
+        Bring the index of the paper directory up to date.
+
+        Args:
+            rebuild: Drop the index and build it from scratch
+
+        Returns:
+            Dict with the processed delta and timing
+        """
+        return get_loop().run_until_complete(self.aindex(rebuild=rebuild))
+
+    async def aindex(self, rebuild: bool = False) -> Dict:
+        """
+        Bring the index of the paper directory up to date, asynchronously.
+
+        Only papers added, changed or removed since the last update are
+        processed. Once the index was built this way, questions use it as is
+        instead of rescanning the paper directory first.
+
+        Args:
+            rebuild: Drop the index and build it from scratch
+
+        Returns:
+            Dict with the processed delta and timing
+        """
+        if rebuild:
+            # The index loaded by the warm-up is dropped
+            self._mark_cold()
+        return await self.indexer.update(self.settings, rebuild=rebuild)
+
+    def _mark_cold(self):
+        """Record that the next question has to load everything itself."""
+        self.warmup_status = {"state": "cold", "timings": None, "error": None}
+
+    def warmup(self) -> Dict:
+        """
+        Load what the first question needs ahead of time.
+
+        Returns:
+            Dict with the seconds spent per step
+        """
+        return get_loop().run_until_complete(self.awarmup())
+
+    async def awarmup(self, build_index: bool = True) -> Dict:
+        """
+        Load what the first question needs ahead of time, asynchronously.
+
+        Builds the index if it doesn't exist yet, opens it and its searcher,
+        and makes an embedding request so that the model client is set up.
+        Progress is reported in `warmup_status`.
+
+        Args:
+            build_index: Build the index if it doesn't exist yet, False when
+                another process builds it
+
+        Returns:
+            Dict with the seconds spent per step
+        """
+        self.warmup_status = {"state": "warming", "timings": None, "error": None}
+        timings = {}
+        start = step = time.perf_counter()
+        try:
+            if build_index and not self.indexer.is_built(self.settings):
+                await self.aindex()
+                timings["index_build"] = round(time.perf_counter() - step, 3)
+                step = time.perf_counter()
+
+            try:
+                search_index = await get_directory_index(
+                    settings=self.settings, build=False
+                )
+                await search_index.searcher
+                self.indexer.embedding_store(self.settings)
+            except RuntimeError as e:
+                # No papers to search yet, nothing to load
+                logger.warning(f"Skipping index warm-up: {str(e)}")
+            timings["index_load"] = round(time.perf_counter() - step, 3)
+            step = time.perf_counter()
+
+            await self.settings.get_embedding_model().embed_documents(["warmup"])
+            timings["embedding"] = round(time.perf_counter() - step, 3)
+        except Exception as e:
+            self.warmup_status = {"state": "error", "timings": timings, "error": str(e)}
+            raise
+
+        timings["total"] = round(time.perf_counter() - start, 3)
+        self.warmup_status = {"state": "ready", "timings": timings, "error": None}
+        return timings
+
+    def update_settings(self, **kwargs) -> bool:
         """
         Update settings with new values.
 
+        Only what the new values affect is rebuilt. Settings that only change
+        how questions are answered (e.g. temperature or evidence_k) are patched
+        into the current settings, so the index and the model clients stay
+        loaded.
+
         Args:
             **kwargs: Key-value pairs of settings to update
+
+        Returns:
+            True if the index or the models may have changed, and the index has
+            to be checked and loaded again
         """
         for key, value in kwargs.items():
             setattr(self, key, value)
+        changed = kwargs.keys()
 
         # Update API key in environment if it was changed
-        if "api_key" in kwargs or "provider_type" in kwargs:
+        if changed & {"api_key", "provider_type"}:
             self._set_provider_api_key()
 
-        # Recreate settings with new values
-        self._create_settings()
+        if "paper_dir" in changed:
+            self.paper_dir = str(Path(self.paper_dir).expanduser())
+        if changed & INDEXER_OPTIONS:
+            self._create_indexer()
+        if changed & ANSWER_CACHE_OPTIONS:
+            self._create_answer_cache()
+        if changed & EVIDENCE_CACHE_OPTIONS:
+            self._create_evidence_cache()
+        # Prefetched results were retrieved with the old settings
+        self.prefetches.clear()
+
+        # Recreate settings with new values, unless they can be patched in
+        if changed - PATCHABLE_SETTINGS.keys() - RUNTIME_OPTIONS:
+            self._create_settings()
+            self._mark_cold()
+            return True
+        patchable = changed & PATCHABLE_SETTINGS.keys()
+        if patchable:
+            self._patch_settings({key: kwargs[key] for key in patchable})
+        return False
 
     def is_api_key_configured(self) -> bool:
         """
@@ -248,11 +1664,4 @@ class PaperQA:
         Returns:
             List of preset names
         """
-        return [
-            "high_quality",
-            "fast",
-            "wikicrow",
-            "contracrow",
-            "debug",
-            "tier1_limits",
-        ]
+        return list(PRESET_NAMES)
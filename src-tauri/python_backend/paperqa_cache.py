@@ -0,0 +1,677 @@
+"""
+PaperQA Cache - Persistent caches for PaperQA answers.
+
+This module provides an on-disk answer cache so that repeated questions
+against an unchanged paper directory do not go through the agent again, and
+a semantic index over cached questions to also catch paraphrases. Chunk
+summaries are cached as well, so follow-up questions on the same topic reuse
+the evidence gathered for earlier ones instead of summarizing it again.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# File types PaperQA picks up when indexing a paper directory
+PAPER_SUFFIXES = {".txt", ".pdf", ".html", ".md"}
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalize a question so that trivially different spellings match.
+
+    Args:
+        question: The question as asked
+
+    Returns:
+        Lowercased question with collapsed whitespace and no trailing punctuation
+    """
+    question = re.sub(r"\s+", " ", question).strip().lower()
+    return question.rstrip("?!. ")
+
+
+def fingerprint(values: Dict[str, Any]) -> str:
+    """
+    Hash a dictionary of JSON serializable values.
+
+    Args:
+        values: Values to hash, e.g. the settings an answer depends on
+
+    Returns:
+        Hex digest identifying the values
+    """
+    payload = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def paper_dir_fingerprint(paper_dir: str) -> str:
+    """
+    Fingerprint the contents of a paper directory.
+
+    Only file names, sizes and modification times are used, so this is cheap
+    even for large libraries, but still changes whenever a paper is added,
+    modified or removed.
+
+    Args:
+        paper_dir: Directory containing papers
+
+    Returns:
+        Hex digest identifying the directory contents
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(paper_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if Path(name).suffix not in PAPER_SUFFIXES:
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            rel_path = os.path.relpath(path, paper_dir)
+            digest.update(f"{rel_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class AnswerCache:
+    """
+    On-disk cache of answers, backed by SQLite.
+
+    Entries expire after `ttl` seconds and the least recently used entries are
+    evicted once the cache holds more than `max_entries` answers.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_entries: int = 1000,
+        ttl: Optional[float] = 7 * 24 * 3600,
+    ):
+        """
+        Open (or create) the cache.
+
+        Args:
+            path: SQLite database file
+            max_entries: Maximum number of cached answers
+            ttl: Seconds after which an answer expires, None to never expire
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    paper_dir TEXT NOT NULL,
+                    paper_fingerprint TEXT NOT NULL,
+                    settings_fingerprint TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS answers_accessed_at ON answers (accessed_at)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS answers_paper_dir ON answers (paper_dir)"
+            )
+
+    @staticmethod
+    def make_key(
+        question: str, settings_fingerprint: str, paper_fingerprint: str
+    ) -> str:
+        """
+        Build the cache key of a question.
+
+        Args:
+            question: The question as asked
+            settings_fingerprint: Fingerprint of the answer-relevant settings
+            paper_fingerprint: Fingerprint of the paper directory contents
+
+        Returns:
+            Cache key
+        """
+        return fingerprint(
+            {
+                "question": normalize_question(question),
+                "settings": settings_fingerprint,
+                "papers": paper_fingerprint,
+            }
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached answer.
+
+        Args:
+            key: Cache key, see `make_key`
+
+        Returns:
+            The cached result, or None if missing or expired
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT result, created_at FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE answers SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(
+        self,
+        key: str,
+        result: Dict[str, Any],
+        question: str,
+        paper_dir: str,
+        paper_fingerprint: str,
+        settings_fingerprint: str,
+    ):
+        """
+        Store an answer.
+
+        Args:
+            key: Cache key, see `make_key`
+            result: Answer to cache
+            question: The question as asked
+            paper_dir: Directory the answer was generated from
+            paper_fingerprint: Fingerprint of the paper directory contents
+            settings_fingerprint: Fingerprint of the answer-relevant settings
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    paper_dir,
+                    paper_fingerprint,
+                    settings_fingerprint,
+                    question,
+                    json.dumps(result),
+                    now,
+                    now,
+                ),
+            )
+            self._evict(now)
+
+    def invalidate(self, paper_dir: str, paper_fingerprint: str) -> int:
+        """
+        Drop answers generated from an older version of a paper directory.
+
+        Args:
+            paper_dir: Directory whose answers to check
+            paper_fingerprint: Current fingerprint of the directory contents
+
+        Returns:
+            Number of dropped answers
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM answers WHERE paper_dir = ? AND paper_fingerprint != ?",
+                (paper_dir, paper_fingerprint),
+            )
+        return cursor.rowcount
+
+    def clear(self):
+        """Drop all cached answers."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM answers")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache statistics.
+
+        Returns:
+            Dict with the number of entries, hits and misses
+        """
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self, now: float):
+        """Drop expired answers and the least recently used ones over the cap."""
+        if self.ttl is not None:
+            self._conn.execute(
+                "DELETE FROM answers WHERE created_at < ?", (now - self.ttl,)
+            )
+        self._conn.execute(
+            """
+            DELETE FROM answers WHERE key IN (
+                SELECT key FROM answers ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+
+
+class SemanticCache:
+    """
+    Embedding-similarity index over cached questions.
+
+    Question embeddings are stored as rows of a SQLite table, so that every
+    instance and worker process sharing the file sees the questions the
+    others indexed. Each process keeps a normalized float32 matrix of the
+    rows, so a lookup is one matrix-vector product, and only reads the rows
+    added since its last lookup once another connection changed the table.
+    Each row points to an `AnswerCache` key and belongs to a scope (the
+    settings and paper fingerprints), and only rows of the same scope can
+    match.
+    """
+
+    def __init__(self, path: Path, threshold: float = 0.92, max_entries: int = 1000):
+        """
+        Open (or create) the index.
+
+        Args:
+            path: SQLite database file, can be shared with an `AnswerCache`
+            threshold: Minimum cosine similarity for a match
+            max_entries: Maximum number of indexed questions, oldest are dropped
+        """
+        self.path = Path(path)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS questions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    embedding BLOB NOT NULL
+                )
+                """)
+
+        # Rows loaded so far, in id order
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._keys: List[str] = []
+        self._scopes = np.zeros(0, dtype=object)
+        self._vectors: Optional[np.ndarray] = None
+        # `PRAGMA data_version` when the rows were loaded, None to reload
+        self._version: Optional[int] = None
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self, embedding: Sequence[float], scope: str
+    ) -> Optional[Tuple[str, float]]:
+        """
+        Find the most similar cached question.
+
+        Args:
+            embedding: Embedding of the incoming question
+            scope: Fingerprint the match must have been cached under
+
+        Returns:
+            Tuple of the answer cache key and the similarity, or None
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._refresh()
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None
+            similarities = self._vectors @ vector
+            similarities[self._scopes != scope] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._keys[best], similarity
+
+    def add(self, key: str, scope: str, embedding: Sequence[float]):
+        """
+        Index a cached question.
+
+        Args:
+            key: Answer cache key of the question
+            scope: Fingerprint the answer was cached under
+            embedding: Embedding of the question
+        """
+        blob = self._normalize(embedding).tobytes()
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO questions (key, scope, embedding) VALUES (?, ?, ?)",
+                    (key, scope, blob),
+                )
+                self._conn.execute(
+                    """
+                    DELETE FROM questions WHERE id IN (
+                        SELECT id FROM questions ORDER BY id DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+            # Changes of our own connection don't bump the data version
+            self._version = None
+
+    def clear(self):
+        """Drop all indexed questions."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM questions")
+            self._version = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get index statistics.
+
+        Returns:
+            Dict with the number of entries, hits and misses
+        """
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM questions").fetchone()
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+    def _refresh(self):
+        """Bring the loaded rows up to date with the table, if it changed."""
+        (version,) = self._conn.execute("PRAGMA data_version").fetchone()
+        if version == self._version:
+            return
+        # Rows are only ever dropped oldest first, so the rows still in the
+        # table are the loaded ones from the oldest remaining id on, followed
+        # by the rows added since the last load
+        (first,) = self._conn.execute("SELECT MIN(id) FROM questions").fetchone()
+        last = int(self._ids[-1]) if len(self._ids) else 0
+        rows = self._conn.execute(
+            "SELECT id, key, scope, embedding FROM questions WHERE id > ?"
+            " ORDER BY id",
+            (last,),
+        ).fetchall()
+        self._version = version
+
+        keep = self._ids >= first if first is not None else self._ids < 0
+        ids = self._ids[keep]
+        keys = [key for key, kept in zip(self._keys, keep) if kept]
+        scopes = self._scopes[keep]
+        vectors = self._vectors[keep] if self._vectors is not None else None
+        if rows:
+            # Only keep the dimension of the newest embeddings, older ones
+            # are from an embedding model that is no longer used
+            size = len(rows[-1][3])
+            if vectors is not None and vectors.shape[1] * 4 != size:
+                ids, keys, scopes, vectors = ids[:0], [], scopes[:0], None
+            rows = [row for row in rows if len(row[3]) == size]
+            new = np.frombuffer(b"".join(row[3] for row in rows), dtype=np.float32)
+            new = new.reshape(len(rows), -1)
+            ids = np.concatenate([ids, [row[0] for row in rows]]).astype(np.int64)
+            keys += [row[1] for row in rows]
+            scopes = np.concatenate(
+                [scopes, np.array([row[2] for row in rows], dtype=object)]
+            )
+            vectors = new if vectors is None else np.concatenate([vectors, new])
+        self._ids, self._keys, self._scopes = ids, keys, scopes
+        self._vectors = vectors if len(ids) else None
+
+
+class EvidenceCache:
+    """
+    On-disk cache of chunk summaries, backed by SQLite.
+
+    A summary depends on the chunk, the question and how it was summarized
+    (model, prompts, prompt version), together the scope. Summaries are found
+    by exact (normalized) question, or, if a `threshold` is set, by question
+    embedding: among the summaries of the same chunk and scope, the one of the
+    most similar question at or above `threshold` matches. The least recently used
+    summaries are evicted once the cache holds more than `max_entries`.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_entries: int = 20000,
+        threshold: Optional[float] = None,
+    ):
+        """
+        Open (or create) the cache.
+
+        Args:
+            path: SQLite database file
+            max_entries: Maximum number of cached summaries
+            threshold: Minimum cosine similarity between questions for a
+                summary to be reused, None to only reuse summaries of the same
+                question
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS evidence (
+                    key TEXT PRIMARY KEY,
+                    chunk TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    embedding BLOB,
+                    summary TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS evidence_chunk ON evidence (chunk, scope)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS evidence_accessed_at"
+                " ON evidence (accessed_at)"
+            )
+
+    @staticmethod
+    def make_key(chunk: str, scope: str, question: str) -> str:
+        """
+        Build the cache key of a chunk summary.
+
+        Args:
+            chunk: Fingerprint of the chunk
+            scope: Fingerprint of how the chunk is summarized
+            question: The question the chunk is summarized for
+
+        Returns:
+            Cache key
+        """
+        return fingerprint(
+            {
+                "chunk": chunk,
+                "scope": scope,
+                "question": normalize_question(question),
+            }
+        )
+
+    def get(
+        self,
+        chunk: str,
+        scope: str,
+        question: str,
+        embedding: Optional[Sequence[float]] = None,
+    ) -> Optional[Tuple[Dict[str, Any], Optional[float]]]:
+        """
+        Look up a cached summary.
+
+        Args:
+            chunk: Fingerprint of the chunk
+            scope: Fingerprint of how the chunk is summarized
+            question: The question the chunk is summarized for
+            embedding: Embedding of the normalized question, to also match
+                summaries of similar questions
+
+        Returns:
+            Tuple of the cached summary and the similarity of the questions
+            (None for the same question), or None on a miss
+        """
+        key = self.make_key(chunk, scope, question)
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT key, summary FROM evidence WHERE key = ?", (key,)
+            ).fetchone()
+            similarity = None
+            if row is None and embedding is not None and self.threshold is not None:
+                row, similarity = self._most_similar(chunk, scope, embedding)
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE evidence SET accessed_at = ? WHERE key = ?",
+                (time.time(), row[0]),
+            )
+        if similarity is None:
+            self.hits += 1
+        else:
+            self.semantic_hits += 1
+        return json.loads(row[1]), similarity
+
+    def _most_similar(
+        self, chunk: str, scope: str, embedding: Sequence[float]
+    ) -> Tuple[Optional[Tuple[str, str]], Optional[float]]:
+        """Find the summary of the chunk for the most similar question."""
+        rows = self._conn.execute(
+            "SELECT key, summary, embedding FROM evidence"
+            " WHERE chunk = ? AND scope = ? AND embedding IS NOT NULL",
+            (chunk, scope),
+        ).fetchall()
+        vector = SemanticCache._normalize(embedding)
+        # Skip embeddings of another embedding model
+        rows = [row for row in rows if len(row[2]) == vector.nbytes]
+        if not rows:
+            return None, None
+        vectors = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.float32)
+        similarities = vectors.reshape(len(rows), -1) @ vector
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < self.threshold:
+            return None, None
+        return rows[best][:2], similarity
+
+    def put(
+        self,
+        chunk: str,
+        scope: str,
+        question: str,
+        summary: Dict[str, Any],
+        embedding: Optional[Sequence[float]] = None,
+    ):
+        """
+        Store a chunk summary.
+
+        Args:
+            chunk: Fingerprint of the chunk
+            scope: Fingerprint of how the chunk is summarized
+            question: The question the chunk was summarized for
+            summary: Summary to cache, e.g. the text and relevance score
+            embedding: Embedding of the normalized question
+        """
+        now = time.time()
+        blob = (
+            SemanticCache._normalize(embedding).tobytes()
+            if embedding is not None
+            else None
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO evidence VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.make_key(chunk, scope, question),
+                    chunk,
+                    scope,
+                    normalize_question(question),
+                    blob,
+                    json.dumps(summary),
+                    now,
+                    now,
+                ),
+            )
+            self._conn.execute(
+                """
+                DELETE FROM evidence WHERE key IN (
+                    SELECT key FROM evidence ORDER BY accessed_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        """Drop all cached summaries."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM evidence")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache statistics.
+
+        Returns:
+            Dict with the number of entries, hits by exact and similar
+            question, misses and the hit rate
+        """
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM evidence").fetchone()
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                round((self.hits + self.semantic_hits) / lookups, 3)
+                if lookups
+                else None
+            ),
+        }
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,418 @@
+"""
+PaperQA History - Persistent record of the answers given by the server.
+
+Every answer is stored with its references and the contexts it was based on,
+in a SQLite database shared by all instances and worker processes. Past
+answers can be listed, searched by question and answer text, and filtered by
+the paper (text name) they cite, so that they can be shown and reused instead
+of asking again. Full-text search uses SQLite's FTS5 extension when it is
+available, and falls back to substring matching otherwise.
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILENAME = "history.sqlite"
+
+# Maximum number of answers kept, the oldest are dropped
+DEFAULT_MAX_HISTORY = 10000
+# Page size of listings and searches, and its maximum
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Statuses of the results worth keeping, errors and cancellations aren't
+RECORDED_STATUSES = ("success", "timeout")
+
+# Markers around the matched words of search snippets
+SNIPPET_START = "<mark>"
+SNIPPET_END = "</mark>"
+
+# Columns of the answer summaries returned by listings and searches
+SUMMARY_COLUMNS = (
+    "a.id, a.instance, a.paper_dir, a.question, a.answer, a.status, a.cached,"
+    " a.created_at"
+)
+
+
+def default_history_path() -> Path:
+    """
+    Get the path of the history in the PaperQA directory.
+
+    Resolved like `paperqa.utils.pqa_directory`, without importing paperqa, so
+    the history can be read while the server is still loading it.
+
+    Returns:
+        Path of the SQLite database
+    """
+    home = os.environ.get("PQA_HOME")
+    base = Path(home) if home else Path.home()
+    return base / ".pqa" / "history" / HISTORY_FILENAME
+
+
+def escape_like(text: str) -> str:
+    """Escape the wildcards of a LIKE pattern, with backslash as escape."""
+    return re.sub(r"([\\%_])", r"\\\1", text)
+
+
+def match_expression(query: str) -> Optional[str]:
+    """
+    Turn a search typed by the user into an FTS5 query.
+
+    Every word has to match, the last one as a prefix so that results show
+    while typing. Words are quoted, so FTS5 operators have no effect.
+
+    Args:
+        query: The search as typed
+
+    Returns:
+        FTS5 match expression, None if the search has no words
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+class AnswerHistory:
+    """
+    On-disk history of answers, backed by SQLite.
+
+    Once it holds more than `max_entries` answers, the oldest are dropped.
+    """
+
+    def __init__(self, path: Path, max_entries: int = DEFAULT_MAX_HISTORY):
+        """
+        Open (or create) the history.
+
+        Args:
+            path: SQLite database file
+            max_entries: Maximum number of answers kept
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    instance TEXT NOT NULL,
+                    paper_dir TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    cached INTEGER NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS answer_sources (
+                    answer_id INTEGER NOT NULL,
+                    text_name TEXT NOT NULL,
+                    score REAL
+                )
+                """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS answer_sources_text_name"
+                " ON answer_sources (text_name)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS answer_sources_answer_id"
+                " ON answer_sources (answer_id)"
+            )
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS answers_delete_sources
+                AFTER DELETE ON answers BEGIN
+                    DELETE FROM answer_sources WHERE answer_id = old.id;
+                END
+                """)
+            self.full_text = self._create_full_text_index()
+
+    def _create_full_text_index(self) -> bool:
+        """Index questions and answers for full-text search, if FTS5 is there."""
+        try:
+            self._conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS answers_fts USING fts5(
+                    question, answer, content='answers', content_rowid='id'
+                )
+                """)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Full-text search unavailable, using substrings: {e}")
+            return False
+        self._conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS answers_fts_insert
+            AFTER INSERT ON answers BEGIN
+                INSERT INTO answers_fts (rowid, question, answer)
+                VALUES (new.id, new.question, new.answer);
+            END
+            """)
+        self._conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS answers_fts_delete
+            AFTER DELETE ON answers BEGIN
+                INSERT INTO answers_fts (answers_fts, rowid, question, answer)
+                VALUES ('delete', old.id, old.question, old.answer);
+            END
+            """)
+        return True
+
+    def add(
+        self, result: Dict[str, Any], instance: str, paper_dir: str
+    ) -> Optional[int]:
+        """
+        Store an answer.
+
+        Args:
+            result: Result of `ask`, with the question, answer, references
+                and contexts
+            instance: Name of the instance that answered
+            paper_dir: Directory the answer was generated from
+
+        Returns:
+            Id of the answer in the history, None if the result isn't an
+            answer worth keeping
+        """
+        status = result.get("status", "success")
+        if status not in RECORDED_STATUSES or not result.get("question"):
+            return None
+        if not result.get("answer") and not result.get("contexts"):
+            # Stopped before any evidence was gathered
+            return None
+        sources = [
+            (context["text_name"], context.get("score"))
+            for context in result.get("contexts") or []
+            if context.get("text_name")
+        ]
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO answers (instance, paper_dir, question, answer, status,"
+                " cached, result, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    instance,
+                    paper_dir,
+                    result["question"],
+                    result.get("answer") or "",
+                    status,
+                    bool(result.get("cached")),
+                    json.dumps(result),
+                    time.time(),
+                ),
+            )
+            answer_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO answer_sources VALUES (?, ?, ?)",
+                [(answer_id, name, score) for name, score in sources],
+            )
+            self._conn.execute(
+                """
+                DELETE FROM answers WHERE id IN (
+                    SELECT id FROM answers ORDER BY id DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+        return answer_id
+
+    def get(self, answer_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Look up an answer.
+
+        Args:
+            answer_id: Id of the answer in the history
+
+        Returns:
+            The stored result with its `history_id`, `instance`, `paper_dir`
+            and `created_at`, or None if there is no such answer
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, instance, paper_dir, result, created_at FROM answers"
+                " WHERE id = ?",
+                (answer_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            **json.loads(row[3]),
+            "history_id": row[0],
+            "instance": row[1],
+            "paper_dir": row[2],
+            "created_at": row[4],
+        }
+
+    def recent(
+        self,
+        offset: int = 0,
+        limit: int = DEFAULT_PAGE_SIZE,
+        paper: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        List answers, newest first.
+
+        Args:
+            offset: Number of answers to skip
+            limit: Maximum number of answers to return
+            paper: Only answers citing this paper, see `_paper_filter`
+
+        Returns:
+            Tuple of the page of answers and the number of matching answers
+        """
+        return self._page(*self._paper_filter(paper), offset, limit)
+
+    def search(
+        self,
+        query: str,
+        offset: int = 0,
+        limit: int = DEFAULT_PAGE_SIZE,
+        paper: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Search questions and answers, best matches first.
+
+        Without FTS5, answers containing every word are returned newest first.
+
+        Args:
+            query: Words to look for, the last one can be incomplete
+            offset: Number of answers to skip
+            limit: Maximum number of answers to return
+            paper: Only answers citing this paper, see `_paper_filter`
+
+        Returns:
+            Tuple of the page of answers, each with a `snippet` of the
+            matching text when full-text search is available, and the number
+            of matching answers
+        """
+        conditions, params = self._paper_filter(paper)
+        if not self.full_text:
+            words = re.findall(r"\w+", query)
+            if not words:
+                return [], 0
+            for word in words:
+                conditions.append(
+                    "(a.question LIKE ? ESCAPE '\\' OR a.answer LIKE ? ESCAPE '\\')"
+                )
+                params += [f"%{escape_like(word)}%"] * 2
+            return self._page(conditions, params, offset, limit)
+
+        expression = match_expression(query)
+        if expression is None:
+            return [], 0
+        where = "".join(f" AND {condition}" for condition in conditions)
+        with self._lock:
+            (total,) = self._conn.execute(
+                "SELECT COUNT(*) FROM answers_fts"
+                " JOIN answers a ON a.id = answers_fts.rowid"
+                f" WHERE answers_fts MATCH ?{where}",
+                (expression, *params),
+            ).fetchone()
+            rows = self._conn.execute(
+                f"SELECT {SUMMARY_COLUMNS},"
+                " snippet(answers_fts, -1, ?, ?, '...', 16) FROM answers_fts"
+                " JOIN answers a ON a.id = answers_fts.rowid"
+                f" WHERE answers_fts MATCH ?{where}"
+                " ORDER BY answers_fts.rank LIMIT ? OFFSET ?",
+                (SNIPPET_START, SNIPPET_END, expression, *params, limit, offset),
+            ).fetchall()
+            return self._summaries(rows), total
+
+    def _page(
+        self, conditions: List[str], params: List[Any], offset: int, limit: int
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """Get a page of the answers matching all conditions, newest first."""
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        with self._lock:
+            (total,) = self._conn.execute(
+                f"SELECT COUNT(*) FROM answers a{where}", params
+            ).fetchone()
+            rows = self._conn.execute(
+                f"SELECT {SUMMARY_COLUMNS}, NULL FROM answers a{where}"
+                " ORDER BY a.id DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+            return self._summaries(rows), total
+
+    @staticmethod
+    def _paper_filter(paper: Optional[str]) -> Tuple[List[str], List[Any]]:
+        """
+        Build the condition for answers citing a paper.
+
+        A paper matches the text names of the contexts of an answer either
+        exactly ("Smith2020 pages 1-2") or as their document name ("Smith2020").
+        """
+        if not paper:
+            return [], []
+        return (
+            [
+                "a.id IN (SELECT answer_id FROM answer_sources"
+                " WHERE text_name = ? OR text_name LIKE ? ESCAPE '\\')"
+            ],
+            [paper, f"{escape_like(paper)} %"],
+        )
+
+    def _summaries(self, rows: List[Tuple]) -> List[Dict[str, Any]]:
+        """Convert answer rows to summaries with the papers they cite."""
+        ids = [row[0] for row in rows]
+        sources: Dict[int, List[str]] = {answer_id: [] for answer_id in ids}
+        if ids:
+            placeholders = ", ".join("?" * len(ids))
+            for answer_id, text_name in self._conn.execute(
+                "SELECT answer_id, text_name FROM answer_sources"
+                f" WHERE answer_id IN ({placeholders})"
+                " ORDER BY answer_id, score DESC",
+                ids,
+            ):
+                if text_name not in sources[answer_id]:
+                    sources[answer_id].append(text_name)
+        summaries = []
+        for row in rows:
+            summary = {
+                "history_id": row[0],
+                "instance": row[1],
+                "paper_dir": row[2],
+                "question": row[3],
+                "answer": row[4],
+                "status": row[5],
+                "cached": bool(row[6]),
+                "created_at": row[7],
+                "sources": sources[row[0]],
+            }
+            if row[8] is not None:
+                summary["snippet"] = row[8]
+            summaries.append(summary)
+        return summaries
+
+    def clear(self):
+        """Drop all answers."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM answers")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get history statistics.
+
+        Returns:
+            Dict with the number of answers and whether full-text search is
+            available
+        """
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+        return {"entries": entries, "full_text": self.full_text}
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,761 @@
+"""
+PaperQA Indexing - Incremental, background index builds for a paper directory.
+
+This module keeps track of the papers that went into a PaperQA index, so that
+only added, changed or removed papers are processed when the paper directory
+changes, and provides a polling watcher to trigger such updates. Papers are
+parsed and chunked in worker processes and embedded in batches. The chunk
+embeddings of the index are also kept in a memory-mapped store, see
+`paperqa_vectors`.
+"""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from aviary.core import Message
+from lmi import EmbeddingModel, LLMModel
+from paperqa import Docs, Settings
+from paperqa.agents import search
+from paperqa.agents.search import (
+    FAILED_DOCUMENT_ADD_ID,
+    SearchIndex,
+    get_directory_index,
+)
+from paperqa.clients import DocMetadataClient
+from paperqa.readers import read_doc
+from paperqa.types import Doc, DocDetails, Text
+from paperqa.utils import (
+    ImpossibleParsingError,
+    citation_to_docname,
+    maybe_is_text,
+    md5sum,
+)
+
+from paperqa_cache import PAPER_SUFFIXES
+from paperqa_vectors import EmbeddingStore
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "nova_manifest.json"
+
+# Snapshot of a paper directory: relative path -> {"size", "mtime_ns", "hash"}
+Snapshot = Dict[str, Dict[str, Any]]
+
+
+def scan_paper_directory(paper_dir: str, recurse: bool = True) -> Snapshot:
+    """
+    Stat every paper in a directory.
+
+    Args:
+        paper_dir: Directory containing papers
+        recurse: Whether to include papers in subdirectories
+
+    Returns:
+        Snapshot of the directory, without content hashes
+    """
+    snapshot = {}
+    for root, dirs, files in os.walk(paper_dir):
+        if not recurse:
+            dirs.clear()
+        for name in files:
+            if Path(name).suffix not in PAPER_SUFFIXES:
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[os.path.relpath(path, paper_dir)] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "hash": None,
+            }
+    return snapshot
+
+
+def file_hash(path: str) -> str:
+    """Hash the contents of a file."""
+    digest = hashlib.md5(usedforsecurity=False)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_paper(
+    path: str, chunk_size: int, overlap: int, page_size_limit: Optional[int]
+) -> List[Text]:
+    """
+    Parse and chunk a paper, meant to run in a worker process.
+
+    The chunks belong to a placeholder document without a name, since the
+    citation is only known once the first chunk has been read.
+
+    Args:
+        path: Absolute path of the paper
+        chunk_size: Characters per chunk
+        overlap: Characters of overlap between chunks
+        page_size_limit: Optional limit on the characters per page
+
+    Returns:
+        The chunks of the paper
+    """
+    doc = Doc(docname="", citation="", dockey=md5sum(path))
+    return asyncio.run(
+        read_doc(
+            path,
+            doc,
+            chunk_chars=chunk_size,
+            overlap=overlap,
+            page_size_limit=page_size_limit,
+        )
+    )
+
+
+def diff_snapshots(
+    paper_dir: str, old: Snapshot, new: Snapshot
+) -> Dict[str, List[str]]:
+    """
+    Compare two snapshots of a paper directory.
+
+    Files whose size and modification time are unchanged are assumed to be
+    unchanged. Otherwise the content hash decides, so that touching a file
+    doesn't trigger a re-parse. Hashes computed along the way are stored in
+    the new snapshot.
+
+    Args:
+        paper_dir: Directory containing papers
+        old: Snapshot the index was built from
+        new: Current snapshot
+
+    Returns:
+        Dict with the "added", "changed" and "removed" relative paths
+    """
+    added, changed = [], []
+    for rel_path, entry in new.items():
+        previous = old.get(rel_path)
+        if previous is not None and (previous["size"], previous["mtime_ns"]) == (
+            entry["size"],
+            entry["mtime_ns"],
+        ):
+            entry["hash"] = previous.get("hash")
+            continue
+        try:
+            entry["hash"] = file_hash(os.path.join(paper_dir, rel_path))
+        except OSError:
+            # Removed while scanning, the next update picks that up
+            continue
+        if previous is None:
+            added.append(rel_path)
+        elif entry["hash"] != previous.get("hash"):
+            changed.append(rel_path)
+    removed = [rel_path for rel_path in old if rel_path not in new]
+    return {"added": sorted(added), "changed": sorted(changed), "removed": removed}
+
+
+class PaperIndexer:
+    """
+    Incrementally keeps the PaperQA index of a paper directory up to date.
+
+    The papers that went into the index are recorded in a manifest stored next
+    to the index. On update, only the delta to the manifest is processed:
+    changed papers are dropped from the index and re-added together with new
+    papers, removed papers are dropped.
+
+    New papers are parsed and chunked in a pool of worker processes, so that
+    building a large index scales with the number of cores, and their chunks
+    are embedded in batches while other papers are still being parsed.
+    """
+
+    def __init__(
+        self,
+        paper_dir: str,
+        workers: Optional[int] = None,
+        embedding_batch_size: int = 32,
+        embedding_concurrency: int = 4,
+        use_embedding_store: bool = False,
+        embedding_store_dtype: str = "float16",
+        ivf_lists: Optional[int] = None,
+    ):
+        """
+        Initialize the indexer.
+
+        Args:
+            paper_dir: Directory containing papers
+            workers: Number of processes parsing papers, defaults to the CPU count
+            embedding_batch_size: Chunks per embedding request
+            embedding_concurrency: Maximum number of embedding requests in flight
+            use_embedding_store: Keep the chunk embeddings in a memory-mapped
+                store next to the index
+            embedding_store_dtype: "float16" or "float32"
+            ivf_lists: Number of IVF lists of the store, see `EmbeddingStore`
+        """
+        self.paper_dir = paper_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_concurrency = embedding_concurrency
+        self.use_embedding_store = use_embedding_store
+        self.embedding_store_dtype = embedding_store_dtype
+        self.ivf_lists = ivf_lists
+        self.store: Optional[EmbeddingStore] = None
+        self.state = "idle"
+        self.last_update: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        # Updates triggered by the watcher, RPCs and warm-up run one at a time
+        self._update_lock = asyncio.Lock()
+
+    def close(self):
+        """Shut the worker processes down and close the embedding store."""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._close_store()
+
+    def _close_store(self):
+        if self.store:
+            self.store.close()
+            self.store = None
+
+    def embedding_store(self, settings: Settings) -> Optional[EmbeddingStore]:
+        """
+        Open the embedding store of the index used with the given settings.
+
+        Args:
+            settings: Settings the index is used with
+
+        Returns:
+            The store, None if the store is disabled
+        """
+        if not self.use_embedding_store:
+            return None
+        directory = self.index_directory(settings)
+        if self.store is None or self.store.directory != directory:
+            self._close_store()
+            self.store = EmbeddingStore(
+                directory, dtype=self.embedding_store_dtype, ivf_lists=self.ivf_lists
+            )
+        return self.store
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        """Start the worker processes on first use, they are kept for later updates."""
+        if self._executor is None:
+            # The server runs threads, which forked workers would inherit broken
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    @staticmethod
+    def index_directory(settings: Settings) -> Path:
+        """Directory of the index used with the given settings."""
+        index_settings = settings.agent.index
+        return Path(index_settings.index_directory) / (
+            index_settings.name or settings.get_index_name()
+        )
+
+    def _manifest_path(self, settings: Settings) -> Path:
+        return self.index_directory(settings) / MANIFEST_FILENAME
+
+    def _load_manifest(self, settings: Settings) -> Snapshot:
+        try:
+            return json.loads(self._manifest_path(settings).read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, settings: Settings, snapshot: Snapshot):
+        path = self._manifest_path(settings)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(snapshot))
+        os.replace(tmp_path, path)
+
+    def is_built(self, settings: Settings) -> bool:
+        """
+        Check whether the index for the given settings was built by this indexer.
+
+        Args:
+            settings: Settings the index is used with
+
+        Returns:
+            True if the index can be searched without building it first
+        """
+        return self._manifest_path(settings).exists()
+
+    async def update(self, settings: Settings, rebuild: bool = False) -> Dict[str, Any]:
+        """
+        Bring the index up to date with the paper directory.
+
+        Args:
+            settings: Settings the index is used with
+            rebuild: Drop the index and build it from scratch
+
+        Returns:
+            Dict with the processed delta and timing
+        """
+        async with self._update_lock:
+            return await self._update(settings, rebuild)
+
+    async def _update(self, settings: Settings, rebuild: bool) -> Dict[str, Any]:
+        start = time.perf_counter()
+        self.state = "indexing"
+        self.error = None
+        try:
+            if rebuild:
+                logger.info(f"Rebuilding index for {self.paper_dir}")
+                index_directory = self.index_directory(settings)
+                self._close_store()
+                shutil.rmtree(index_directory, ignore_errors=True)
+                # PaperQA caches opened indexes by name, don't reuse the deleted one
+                for key in list(search._OPENED_INDEX_CACHE):
+                    if key[0] == index_directory.name:
+                        search._OPENED_INDEX_CACHE.pop(key, None)
+
+            manifest = self._load_manifest(settings)
+            # Scanning and hashing block, keep the event loop serving questions
+            snapshot = await asyncio.to_thread(
+                scan_paper_directory,
+                self.paper_dir,
+                settings.agent.index.recurse_subdirectories,
+            )
+            delta = await asyncio.to_thread(
+                diff_snapshots, self.paper_dir, manifest, snapshot
+            )
+            if manifest and not any(delta.values()):
+                logger.debug(f"Index for {self.paper_dir} is up to date")
+            else:
+                logger.info(
+                    f"Indexing {self.paper_dir}: {len(delta['added'])} added,"
+                    f" {len(delta['changed'])} changed, {len(delta['removed'])} removed"
+                )
+                await self._apply_delta(settings, delta)
+                self._save_manifest(settings, snapshot)
+            if self.use_embedding_store:
+                try:
+                    await self._sync_store(settings)
+                except Exception as e:
+                    # Searches fall back to PaperQA's own retrieval
+                    logger.error(f"Error updating the embedding store: {str(e)}")
+
+            self.last_update = {
+                **{kind: len(paths) for kind, paths in delta.items()},
+                "papers": len(snapshot),
+                "seconds": round(time.perf_counter() - start, 3),
+                "finished_at": time.time(),
+            }
+            self.state = "idle"
+            return self.last_update
+        except Exception as e:
+            self.state = "error"
+            self.error = str(e)
+            raise
+
+    async def _apply_delta(self, settings: Settings, delta: Dict[str, List[str]]):
+        """Drop changed and removed papers, add new ones, then let PaperQA sync."""
+        search_index = self._search_index(settings)
+        stale = delta["changed"] + delta["removed"]
+        if stale:
+            # PaperQA re-reads the file list from disk once it is empty, so hold
+            # on to the in-memory list to see what is left after the removals
+            index_files = await search_index.index_files
+            for rel_path in stale:
+                await self._remove_paper(
+                    search_index, self._file_location(settings, rel_path)
+                )
+            if index_files:
+                await search_index.save_index()
+            else:
+                # PaperQA can't save an empty file list, drop it instead
+                file_index = await search_index.file_index_filename
+                await file_index.unlink(missing_ok=True)
+
+        # Papers with metadata from a manifest file are left to PaperQA
+        if not settings.agent.index.manifest_file:
+            new = [
+                rel_path
+                for rel_path in delta["added"] + delta["changed"]
+                if not await search_index.filecheck(
+                    self._file_location(settings, rel_path)
+                )
+            ]
+            if new:
+                await self._add_papers(settings, search_index, new)
+
+        # Papers that couldn't be added above are parsed, chunked and embedded
+        # by PaperQA, and papers no longer in the directory are removed
+        await get_directory_index(settings=settings, build=True)
+
+    @staticmethod
+    def _search_index(settings: Settings) -> SearchIndex:
+        """Open the PaperQA search index used with the given settings."""
+        return SearchIndex(
+            fields=[*SearchIndex.REQUIRED_FIELDS, "title", "year"],
+            index_name=settings.agent.index.name or settings.get_index_name(),
+            index_directory=settings.agent.index.index_directory,
+        )
+
+    async def _sync_store(self, settings: Settings):
+        """
+        Bring the embedding store in line with the papers of the index.
+
+        Embeddings are read from the documents saved in the index, so papers
+        added by PaperQA itself and indexes built before the store existed
+        are covered too. Only papers missing from the store or changed since
+        are read.
+
+        Args:
+            settings: Settings the index is used with
+        """
+        store = self.embedding_store(settings)
+        search_index = self._search_index(settings)
+        index_files = {
+            file_location: filehash
+            for file_location, filehash in (await search_index.index_files).items()
+            if filehash != FAILED_DOCUMENT_ADD_ID
+        }
+        stored = store.papers()
+        stale = [
+            file_location
+            for file_location, filehash in stored.items()
+            if index_files.get(file_location) != filehash
+        ]
+        if stale:
+            await asyncio.to_thread(store.remove, stale)
+        for file_location, filehash in index_files.items():
+            if stored.get(file_location) == filehash:
+                continue
+            docs = await search_index.get_saved_object(file_location)
+            if not docs or not docs.texts:
+                continue
+            embeddings = [t.embedding for t in docs.texts]
+            if any(embedding is None for embedding in embeddings):
+                # Embedding was deferred, PaperQA embeds the chunks when searching
+                continue
+            doc = next(iter(docs.docs.values()))
+            await asyncio.to_thread(
+                store.add, file_location, filehash, doc.dockey, embeddings
+            )
+        await asyncio.to_thread(store.update_ivf)
+
+    def _file_location(self, settings: Settings, rel_path: str) -> str:
+        """Location of a paper as stored in the index."""
+        if settings.agent.index.use_absolute_paper_directory:
+            return str(Path(self.paper_dir).absolute() / rel_path)
+        return rel_path
+
+    async def _add_papers(
+        self, settings: Settings, search_index: SearchIndex, rel_paths: List[str]
+    ):
+        """
+        Parse, chunk, embed and index papers.
+
+        All papers are submitted to the worker processes at once, and are
+        embedded and added to the index as soon as they are parsed.
+
+        Args:
+            settings: Settings the index is used with
+            search_index: Index to add the papers to
+            rel_paths: Papers to add, relative to the paper directory
+        """
+        loop = asyncio.get_running_loop()
+        # Worker processes take a while to start, not worth it for a single paper
+        if self.workers > 1 and len(rel_paths) > 1:
+            executor = self._get_executor()
+        else:
+            executor = None
+        parsing = settings.parsing
+        batch_size = settings.agent.index.batch_size
+        # Creating model clients is expensive, share them between papers
+        llm_model = settings.get_llm()
+        embedding_model = (
+            None if parsing.defer_embedding else settings.get_embedding_model()
+        )
+        # Citations are inferred with the LLM, limit those like PaperQA does
+        paper_slots = asyncio.Semaphore(settings.agent.index.concurrency)
+        embedding_slots = asyncio.Semaphore(self.embedding_concurrency)
+        unsaved = 0
+
+        async def add_paper(rel_path: str):
+            nonlocal unsaved
+            path = str(Path(self.paper_dir).absolute() / rel_path)
+            file_location = self._file_location(settings, rel_path)
+            try:
+                texts = await loop.run_in_executor(
+                    executor,
+                    parse_paper,
+                    path,
+                    parsing.chunk_size,
+                    parsing.overlap,
+                    parsing.page_size_limit,
+                )
+                async with paper_slots:
+                    doc = await self._make_doc(settings, llm_model, path, texts)
+                if embedding_model:
+                    await self._embed(embedding_model, texts, embedding_slots)
+            except (ValueError, ImpossibleParsingError) as e:
+                logger.error(f"Error parsing {file_location}, skipping it: {str(e)}")
+                await search_index.mark_failed_document(file_location)
+                return
+            except Exception as e:
+                # Leave it to PaperQA, which retries it when syncing the index
+                logger.error(f"Error indexing {file_location}: {str(e)}")
+                return
+
+            docs = Docs()
+            if not await docs.aadd_texts(texts, doc, settings):
+                logger.info(f"Skipping {file_location}, excluded by document filters")
+                await search_index.mark_failed_document(file_location)
+                return
+            if isinstance(doc, DocDetails):
+                title = doc.title or Path(rel_path).name
+                year = doc.year or "Unknown year"
+            else:
+                title, year = Path(rel_path).name, "Unknown year"
+            await search_index.add_document(
+                {
+                    "title": title,
+                    "year": year,
+                    "file_location": file_location,
+                    "body": "".join(t.text for t in docs.texts),
+                },
+                document=docs,
+            )
+            unsaved += 1
+            if unsaved >= batch_size:
+                # Saving now and then lets an interrupted build resume
+                unsaved = 0
+                await search_index.save_index()
+
+        await asyncio.gather(*(add_paper(rel_path) for rel_path in rel_paths))
+        if search_index.changed:
+            await search_index.save_index()
+
+    @staticmethod
+    async def _make_doc(
+        settings: Settings, llm_model: LLMModel, path: str, texts: List[Text]
+    ) -> Doc:
+        """
+        Build the document of a parsed paper, and assign its chunks to it.
+
+        Mirrors `Docs.aadd`, minus the parsing: the citation is inferred from
+        the first chunk, and details like the title and year are looked up
+        from the citation.
+
+        Args:
+            settings: Settings the index is used with
+            llm_model: LLM inferring the citation
+            path: Absolute path of the paper
+            texts: Chunks of the paper, see `parse_paper`
+
+        Returns:
+            The document
+        """
+        parsing = settings.parsing
+        if not texts:
+            raise ValueError(f"Could not read document {path}. Is it empty?")
+        if len(texts[0].text) < 10 or (
+            not parsing.disable_doc_valid_check
+            and not maybe_is_text("".join(t.text for t in texts[:5]))
+        ):
+            raise ValueError(f"This does not look like a text document: {path}.")
+
+        result = await llm_model.call_single(
+            messages=[
+                Message(content=parsing.citation_prompt.format(text=texts[0].text))
+            ]
+        )
+        citation = result.text or ""
+        if len(citation) < 3 or "Unknown" in citation or "insufficient" in citation:
+            citation = f"Unknown, {os.path.basename(path)}, {datetime.now().year}"
+        doc = Doc(
+            docname=citation_to_docname(citation),
+            citation=citation,
+            dockey=texts[0].doc.dockey,
+        )
+
+        if parsing.use_doc_details:
+            result = await llm_model.call_single(
+                messages=[
+                    Message(
+                        content=parsing.structured_citation_prompt.format(
+                            citation=citation
+                        )
+                    )
+                ]
+            )
+            # Isolate the JSON object the LLM was asked for
+            clean_text = (result.text or "").split("{", 1)[-1].split("}", 1)[0]
+            try:
+                details = json.loads("{" + clean_text + "}")
+                query = {
+                    key: details[key]
+                    for key in ("doi", "authors", "title")
+                    if details.get(key)
+                }
+            except (ValueError, AttributeError):
+                query = {}
+            if "doi" in query or "title" in query:
+                doc = await DocMetadataClient().upgrade_doc_to_doc_details(doc, **query)
+
+        for text in texts:
+            text.name = doc.docname + text.name
+            text.doc = doc
+        return doc
+
+    async def _embed(
+        self,
+        embedding_model: EmbeddingModel,
+        texts: List[Text],
+        slots: asyncio.Semaphore,
+    ):
+        """
+        Embed chunks in batches, sharing the request slots with other papers.
+
+        Rate limits configured for the embedding model apply to every batch.
+
+        Args:
+            embedding_model: Model embedding the chunks
+            texts: Chunks to embed
+            slots: Limits the number of embedding requests in flight
+        """
+
+        async def embed_batch(batch: List[Text]):
+            async with slots:
+                embeddings = await embedding_model.embed_documents(
+                    [t.text for t in batch], batch_size=len(batch)
+                )
+            for text, embedding in zip(batch, embeddings):
+                text.embedding = embedding
+
+        size = self.embedding_batch_size
+        await asyncio.gather(
+            *(embed_batch(texts[i : i + size]) for i in range(0, len(texts), size))
+        )
+
+    @staticmethod
+    async def _remove_paper(search_index: SearchIndex, file_location: str):
+        """
+        Remove a paper from a PaperQA search index.
+
+        PaperQA deletes documents by a term on the tokenized file location,
+        which never matches, so its documents would stay searchable. Delete by
+        a phrase query instead, and add back the documents of other papers
+        whose location contains the same phrase.
+
+        Args:
+            search_index: Index to remove the paper from
+            file_location: Location of the paper as stored in the index
+        """
+        index = await search_index.index
+        query = index.parse_query(
+            '"{}"'.format(file_location.replace('"', " ")), ["file_location"]
+        )
+        index.reload()
+        searcher = index.searcher()
+        hits = searcher.search(query, max(searcher.num_docs, 1)).hits
+        # All fields are stored, so the documents can be added back as they are
+        others = [
+            doc
+            for doc in (searcher.doc(address) for _, address in hits)
+            if doc["file_location"][0] != file_location
+        ]
+        async with search_index.writer() as writer:
+            writer.delete_documents_by_query(query)
+            for doc in others:
+                writer.add_document(doc)
+        await search_index.remove_from_index(file_location)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the indexing status.
+
+        Returns:
+            Dict with the state, last update, last error and the statistics
+            of the embedding store
+        """
+        return {
+            "state": self.state,
+            "last_update": self.last_update,
+            "error": self.error,
+            "embedding_store": self.store.stats() if self.store else None,
+        }
+
+
+class PaperDirectoryWatcher:
+    """
+    Polls a paper directory and reports when its papers change.
+
+    Changes are reported once the directory is stable across two consecutive
+    polls, so that papers still being copied are not indexed half-written.
+    """
+
+    def __init__(
+        self,
+        paper_dir: str,
+        on_change: Callable[[], Any],
+        interval: float = 30.0,
+        recurse: bool = True,
+    ):
+        """
+        Initialize the watcher.
+
+        Args:
+            paper_dir: Directory containing papers
+            on_change: Called from the watcher thread when papers changed
+            interval: Seconds between polls
+            recurse: Whether to watch subdirectories
+        """
+        self.paper_dir = paper_dir
+        self.on_change = on_change
+        self.interval = interval
+        self.recurse = recurse
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _stat_key(snapshot: Snapshot):
+        return {path: (e["size"], e["mtime_ns"]) for path, e in snapshot.items()}
+
+    def start(self):
+        """Start polling in a background thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="paperqa-watcher", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Watching {self.paper_dir} for changes every {self.interval}s")
+
+    def stop(self):
+        """Stop polling."""
+        self._stop.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=5.0)
+
+    def _run(self):
+        # The caller indexes the directory as it is when watching starts
+        reported = pending = self._stat_key(
+            scan_paper_directory(self.paper_dir, self.recurse)
+        )
+        while not self._stop.wait(self.interval):
+            current = self._stat_key(scan_paper_directory(self.paper_dir, self.recurse))
+            if current == pending and current != reported:
+                try:
+                    self.on_change()
+                    reported = current
+                except Exception as e:
+                    logger.error(f"Error handling paper directory change: {str(e)}")
+            pending = current
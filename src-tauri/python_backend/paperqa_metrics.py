@@ -0,0 +1,368 @@
+"""
+PaperQA Metrics - Latency and cost instrumentation of the PaperQA backend.
+
+Requests record their per-stage timings, LLM calls, tokens and cost in a
+`RequestMetrics`, which is found through a context variable by the code they
+call, including LLM callbacks. Everything is aggregated in the process-wide
+`METRICS` registry, as rolling histograms and counters, which can be exported
+as a dictionary or in the Prometheus text format.
+
+Doesn't import PaperQA, so that the server can report metrics right away.
+"""
+
+import contextlib
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Observations kept per histogram to compute the percentiles
+DEFAULT_WINDOW = 1024
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Rolling histogram of observed values.
+
+    Percentiles are computed over the last `window` observations, the count
+    and sum over all of them.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        """
+        Args:
+            window: Number of recent observations to compute percentiles from
+        """
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Record a value."""
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the observations.
+
+        Returns:
+            Dict with the count, sum and mean of all observations, and the
+            percentiles and maximum of the recent ones
+        """
+        values = sorted(self.values)
+        summary = {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+        }
+        for quantile in QUANTILES:
+            summary[f"p{quantile * 100:g}"] = (
+                round(percentile(values, quantile), 6) if values else None
+            )
+        summary["max"] = round(values[-1], 6) if values else None
+        return summary
+
+
+def percentile(values: List[float], quantile: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    rank = max(math.ceil(quantile * len(values)), 1)
+    return values[rank - 1]
+
+
+class Metrics:
+    """
+    Thread-safe registry of labelled histograms and counters.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        """
+        Args:
+            window: Number of recent observations per histogram
+        """
+        self.window = window
+        self.started = time.time()
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Record a value in a histogram.
+
+        Args:
+            name: Name of the histogram
+            value: Observed value
+            **labels: Labels of the series, e.g. method="ask"
+        """
+        key = self._labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self.window)
+            series[key].observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """
+        Add to a counter.
+
+        Args:
+            name: Name of the counter
+            value: Amount to add
+            **labels: Labels of the series, e.g. model="gpt-4o"
+        """
+        key = self._labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def reset(self):
+        """Drop all recorded metrics."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self.started = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get the current value of all metrics.
+
+        Returns:
+            Dict with the uptime, the histograms and the counters, each a list
+            of series with their labels
+        """
+        with self._lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "window": self.window,
+                "histograms": {
+                    name: [
+                        {"labels": dict(labels), **histogram.summary()}
+                        for labels, histogram in sorted(series.items())
+                    ]
+                    for name, series in sorted(self._histograms.items())
+                },
+                "counters": {
+                    name: [
+                        {"labels": dict(labels), "value": round(value, 6)}
+                        for labels, value in sorted(series.items())
+                    ]
+                    for name, series in sorted(self._counters.items())
+                },
+            }
+
+    def prometheus(self) -> str:
+        """
+        Export all metrics in the Prometheus text format.
+
+        Histograms are exported as summaries over their rolling window.
+
+        Returns:
+            The metrics, one sample per line
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} summary")
+                for labels, histogram in sorted(series.items()):
+                    values = sorted(histogram.values)
+                    for quantile in QUANTILES:
+                        if values:
+                            sample = percentile(values, quantile)
+                            quantile_labels = (*labels, ("quantile", str(quantile)))
+                            lines.append(
+                                f"{name}{_format_labels(quantile_labels)} {sample:g}"
+                            )
+                    lines.append(
+                        f"{name}_sum{_format_labels(labels)} {histogram.sum:g}"
+                    )
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {histogram.count}"
+                    )
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Labels) -> str:
+    """Format labels as a Prometheus label set."""
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+# Metrics of the whole process
+METRICS = Metrics()
+
+
+class RequestMetrics:
+    """
+    Timings, LLM calls, tokens and cost of a single request.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.llm_calls = 0
+        self.embedding_calls = 0
+        # Chunk summaries reused from the evidence cache
+        self.evidence_cache_hits = 0
+        # Whether the retrieval was started by a prefetch of the question
+        self.prefetched = False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+    def add_stage(self, stage: str, seconds: float):
+        """Add time spent in a stage, stages can be entered several times."""
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Time the enclosed code as part of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(stage, time.perf_counter() - start)
+
+    def add_llm_call(
+        self,
+        call_type: str,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        cost: float = 0.0,
+    ):
+        """
+        Record an LLM call made for the request.
+
+        Args:
+            call_type: "completion" or "embedding"
+            prompt_tokens: Input tokens of the call
+            completion_tokens: Output tokens of the call
+            cost: Cost of the call in USD
+        """
+        if call_type == "embedding":
+            self.embedding_calls += 1
+        else:
+            self.llm_calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost += cost
+
+    @property
+    def seconds(self) -> float:
+        """Seconds since the request started."""
+        return time.perf_counter() - self.start
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Summarize the request."""
+        return {
+            "seconds": round(self.seconds, 3),
+            "stages": {stage: round(s, 3) for stage, s in self.stages.items()},
+            "llm_calls": self.llm_calls,
+            "embedding_calls": self.embedding_calls,
+            "evidence_cache_hits": self.evidence_cache_hits,
+            "prefetched": self.prefetched,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": round(self.cost, 6),
+        }
+
+    def record(self, **labels):
+        """
+        Add the request to the process-wide metrics.
+
+        Args:
+            **labels: Labels of the series, e.g. preset="fast"
+        """
+        METRICS.observe("paperqa_question_seconds", self.seconds, **labels)
+        for stage, seconds in self.stages.items():
+            METRICS.observe("paperqa_stage_seconds", seconds, stage=stage, **labels)
+        METRICS.observe("paperqa_question_llm_calls", self.llm_calls, **labels)
+        METRICS.observe(
+            "paperqa_question_tokens",
+            self.prompt_tokens + self.completion_tokens,
+            **labels,
+        )
+        METRICS.observe("paperqa_question_cost_usd", self.cost, **labels)
+
+
+_current_request: contextvars.ContextVar[Optional[RequestMetrics]] = (
+    contextvars.ContextVar("paperqa_request_metrics", default=None)
+)
+
+
+def current_request() -> Optional[RequestMetrics]:
+    """Get the metrics of the request being handled, if any."""
+    return _current_request.get()
+
+
+@contextlib.contextmanager
+def track_request(request: RequestMetrics) -> Iterator[RequestMetrics]:
+    """
+    Attribute the LLM calls of the enclosed code, and of the tasks it starts,
+    to a request.
+
+    Args:
+        request: Metrics of the request
+
+    Yields:
+        The request metrics
+    """
+    token = _current_request.set(request)
+    try:
+        yield request
+    finally:
+        _current_request.reset(token)
+
+
+def record_llm_call(
+    model: str,
+    call_type: str,
+    seconds: float,
+    prompt_tokens: int = 0,
+    completion_tokens: int = 0,
+    cost: float = 0.0,
+):
+    """
+    Record an LLM call, for the process and the current request.
+
+    Args:
+        model: Name of the model
+        call_type: "completion" or "embedding"
+        seconds: Duration of the call
+        prompt_tokens: Input tokens of the call
+        completion_tokens: Output tokens of the call
+        cost: Cost of the call in USD
+    """
+    labels = {"model": model, "call_type": call_type}
+    METRICS.increment("paperqa_llm_calls_total", **labels)
+    METRICS.observe("paperqa_llm_call_seconds", seconds, **labels)
+    METRICS.increment(
+        "paperqa_llm_tokens_total", prompt_tokens, kind="prompt", **labels
+    )
+    METRICS.increment(
+        "paperqa_llm_tokens_total", completion_tokens, kind="completion", **labels
+    )
+    METRICS.increment("paperqa_llm_cost_usd_total", cost, **labels)
+    request = current_request()
+    if request:
+        request.add_llm_call(call_type, prompt_tokens, completion_tokens, cost)
@@ -0,0 +1,266 @@
+"""
+PaperQA Prefetch - Speculative retrieval for questions still being typed.
+
+While the user types a question, the client sends it to `prefetch()`. The
+retrieval steps that don't need the final answer (generating search queries,
+searching the papers, embedding the question and, optionally, summarizing
+the most relevant chunks) run in the background, and their results are kept
+for a short while. When the question is then asked, the agent starts from
+them instead of from scratch.
+
+Prefetches of earlier versions of a question (one is a prefix of the other)
+are stale once a newer version is prefetched or asked, and are cancelled.
+
+Doesn't depend on PaperQA, `PaperQA.aprefetch` runs the retrieval steps.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from paperqa_cache import normalize_question
+from paperqa_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Seconds a prefetch is kept for the question to be asked
+DEFAULT_PREFETCH_TTL = 120.0
+# Maximum number of prefetches kept
+DEFAULT_MAX_PREFETCHED = 8
+# Maximum number of prefetches running at the same time, the oldest is
+# cancelled to start another
+DEFAULT_MAX_RUNNING = 2
+
+
+class Prefetched:
+    """
+    Retrieval results of a question, filled in by the prefetch.
+    """
+
+    def __init__(self, question: str):
+        """
+        Args:
+            question: The question as it was typed
+        """
+        self.question = question
+        self.key = normalize_question(question)
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        # Queries generated for the paper search, with how many were requested
+        self.search_queries: Optional[List[str]] = None
+        self.search_count: Optional[int] = None
+        # Embedding of the question in query mode
+        self.query_embedding: Optional[List[float]] = None
+        # `paperqa.Docs` with the papers found
+        self.docs: Any = None
+        # Whether the summaries of the most relevant chunks were cached
+        self.evidence = False
+
+    def matches(self, question: str) -> bool:
+        """Whether the results are for a question, ignoring case and spacing."""
+        return normalize_question(question) == self.key
+
+    def summary(self) -> Dict[str, Any]:
+        """Summarize what was prefetched."""
+        return {
+            "question": self.question,
+            "search_queries": self.search_queries,
+            "papers": len(self.docs.docs) if self.docs is not None else 0,
+            "evidence": self.evidence,
+            "seconds": (
+                round(self.finished_at - self.started_at, 3)
+                if self.finished_at is not None
+                else None
+            ),
+        }
+
+
+def is_stale(key: str, newer: str) -> bool:
+    """Whether a prefetch is for an earlier or later version of a question."""
+    return key != newer and (newer.startswith(key) or key.startswith(newer))
+
+
+class PrefetchStore:
+    """
+    Running and finished prefetches of a PaperQA instance.
+
+    Only used from the event loop the prefetches run on, except for `clear`.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_PREFETCH_TTL,
+        max_entries: int = DEFAULT_MAX_PREFETCHED,
+        max_running: int = DEFAULT_MAX_RUNNING,
+    ):
+        """
+        Args:
+            ttl: Seconds a finished prefetch is kept
+            max_entries: Maximum number of finished prefetches kept
+            max_running: Maximum number of prefetches running at once
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_running = max_running
+        # Finished prefetches by normalized question, oldest first
+        self._entries: "OrderedDict[str, Prefetched]" = OrderedDict()
+        # Running prefetches by normalized question, oldest first
+        self._running: "OrderedDict[str, asyncio.Task]" = OrderedDict()
+        # Event loop the prefetches run on, once one was started
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.hits = 0
+
+    def start(
+        self, question: str, run: Callable[[Prefetched], Awaitable[None]]
+    ) -> asyncio.Task:
+        """
+        Prefetch a question, unless it already is or was.
+
+        Stale prefetches are cancelled, as well as the oldest running ones
+        beyond `max_running`.
+
+        Args:
+            question: The question as typed so far
+            run: Fills in the results of a prefetch
+
+        Returns:
+            Task resolving to the results
+        """
+        entry = Prefetched(question)
+        self._loop = asyncio.get_running_loop()
+        self._expire()
+        self.cancel_stale(entry.key)
+        running = self._running.get(entry.key)
+        if running:
+            return running
+        if entry.key in self._entries:
+            task = asyncio.get_running_loop().create_future()
+            task.set_result(self._entries[entry.key])
+            return task
+
+        while len(self._running) >= self.max_running:
+            key, oldest = self._running.popitem(last=False)
+            logger.debug(f"Too many prefetches, cancelling {key!r}")
+            oldest.cancel()
+        task = asyncio.ensure_future(self._run(entry, run))
+        self._running[entry.key] = task
+        return task
+
+    async def _run(
+        self, entry: Prefetched, run: Callable[[Prefetched], Awaitable[None]]
+    ) -> Prefetched:
+        """Run a prefetch and keep its results."""
+        try:
+            await run(entry)
+        except asyncio.CancelledError:
+            METRICS.increment("paperqa_prefetch_total", result="cancelled")
+            raise
+        except Exception:
+            METRICS.increment("paperqa_prefetch_total", result="error")
+            raise
+        finally:
+            if self._running.get(entry.key) is asyncio.current_task():
+                del self._running[entry.key]
+        METRICS.increment("paperqa_prefetch_total", result="done")
+        entry.finished_at = time.monotonic()
+        self._entries[entry.key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def cancel_stale(self, key: str):
+        """
+        Cancel the running prefetches of other versions of a question.
+
+        Args:
+            key: Normalized question
+        """
+        for stale in [k for k in self._running if is_stale(k, key)]:
+            logger.debug(f"Cancelling stale prefetch {stale!r}")
+            self._running.pop(stale).cancel()
+
+    async def take(self, question: str) -> Optional[Prefetched]:
+        """
+        Get the results prefetched for a question being asked.
+
+        Waits for a running prefetch of the question, and cancels those of
+        other versions of it. The results are handed out once.
+
+        Args:
+            question: The question being asked
+
+        Returns:
+            The results, None if the question wasn't prefetched
+        """
+        key = normalize_question(question)
+        self._expire()
+        self.cancel_stale(key)
+        running = self._running.get(key)
+        if running:
+            try:
+                await asyncio.shield(running)
+            except asyncio.CancelledError:
+                if not running.cancelled():
+                    # The question itself was cancelled
+                    raise
+            except Exception as e:
+                logger.warning(f"Prefetch of {question!r} failed: {str(e)}")
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.hits += 1
+            METRICS.increment("paperqa_prefetch_hits_total")
+        return entry
+
+    def _expire(self):
+        """Drop the finished prefetches older than the TTL."""
+        now = time.monotonic()
+        for key in [
+            k for k, e in self._entries.items() if now - e.started_at > self.ttl
+        ]:
+            del self._entries[key]
+
+    def clear(self):
+        """
+        Cancel the running prefetches and drop the finished ones.
+
+        Can be called from any thread, e.g. when the settings change. From
+        another thread, the prefetches are cleared on their event loop, before
+        anything scheduled on it afterwards.
+        """
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if not on_loop:
+            try:
+                loop.call_soon_threadsafe(self._clear)
+                return
+            except RuntimeError:
+                # The loop is closed, nothing runs on it anymore
+                pass
+        self._clear()
+
+    def _clear(self):
+        for task in self._running.values():
+            task.cancel()
+        self._running.clear()
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the state of the prefetches.
+
+        Returns:
+            Dict with the number of running and kept prefetches and the
+            questions that were answered from one
+        """
+        return {
+            "running": len(self._running),
+            "prefetched": len(self._entries),
+            "hits": self.hits,
+        }
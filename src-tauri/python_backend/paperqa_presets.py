@@ -0,0 +1,15 @@
+"""
+PaperQA Presets - Names of the preset configurations offered by Nova.
+
+Kept apart from the API module, which takes seconds to import, so that the
+server can list them while PaperQA is still loading.
+"""
+
+PRESET_NAMES = (
+    "high_quality",
+    "fast",
+    "wikicrow",
+    "contracrow",
+    "debug",
+    "tier1_limits",
+)
@@ -0,0 +1,536 @@
+"""
+PaperQA Profiling - On-demand profiles of the running server.
+
+A request can be profiled by passing `profile` with it, and the whole server
+between `start_profiling` and `stop_profiling`. Two kinds of profiles are
+taken, without external tools:
+
+- "sample": the stacks of the threads are sampled at a fixed wall-clock
+  interval, like py-spy does. Shows where time goes whether the threads run
+  Python code or wait on I/O, with little overhead. Saved as collapsed stacks,
+  which flame graph tools (speedscope, flamegraph.pl) read.
+- "cprofile": every Python call is traced with cProfile. Exact call counts and
+  CPU time per function, but slows the server down. Saved in the pstats
+  format, which snakeviz and `python -m pstats` read.
+
+Questions are answered on the event loop thread, which is profiled along
+with the worker thread handling the request.
+"""
+
+import asyncio
+import cProfile
+import collections
+import concurrent.futures
+import contextlib
+import io
+import logging
+import os
+import pstats
+import re
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("sample", "cprofile")
+# Mode of `profile=true`
+DEFAULT_PROFILE_MODE = "sample"
+# Seconds between two samples of the thread stacks
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# Number of functions in the summary of a profile
+TOP_HOTSPOTS = 15
+# Seconds to wait for the event loop to start or stop its profiler
+LOOP_CALL_TIMEOUT = 5.0
+
+# Innermost functions of a thread blocked on I/O, a lock or a timer. Samples
+# ending in them count as waiting rather than running.
+WAITING_FUNCTIONS = {
+    "select",
+    "poll",
+    "wait",
+    "acquire",
+    "sleep",
+    "recv",
+    "recv_into",
+    "recv_multipart",
+    "readinto",
+    "accept",
+    # Idle thread pool workers block on their queue from here
+    "_worker",
+}
+
+# Only one cProfile profiler can trace a thread, and the event loop thread is
+# traced by every cProfile profile
+_cprofile_lock = threading.Lock()
+
+
+def profile_directory() -> Path:
+    """
+    Get the directory profiles are saved to.
+
+    Returns:
+        $PAPERQA_PROFILE_DIR, or "paperqa-profiles" in the temporary directory
+    """
+    directory = os.environ.get("PAPERQA_PROFILE_DIR")
+    if directory:
+        return Path(directory).expanduser()
+    return Path(tempfile.gettempdir()) / "paperqa-profiles"
+
+
+def parse_mode(mode: Union[bool, str]) -> str:
+    """
+    Get the profile mode asked for by a request.
+
+    Args:
+        mode: True for the default mode, or one of PROFILE_MODES
+
+    Returns:
+        The profile mode
+    """
+    if mode is True:
+        return DEFAULT_PROFILE_MODE
+    if mode not in PROFILE_MODES:
+        raise ValueError(
+            f"Unknown profile mode {mode!r}, expected one of {PROFILE_MODES}"
+        )
+    return mode
+
+
+def is_waiting(name: str) -> bool:
+    """
+    Whether a function blocks its thread, see WAITING_FUNCTIONS.
+
+    Args:
+        name: Name of the function, or the name cProfile gives a builtin,
+            e.g. "<method 'poll' of 'select.epoll' objects>"
+    """
+    match = re.match(r"<(?:built-in )?method '?([\w.]+)", name)
+    return (match.group(1) if match else name).rsplit(".", 1)[-1] in WAITING_FUNCTIONS
+
+
+def frame_label(code) -> str:
+    """Name a function by its name, file and first line."""
+    path = Path(code.co_filename)
+    return f"{code.co_name} ({path.parent.name}/{path.name}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples the stacks of threads from a background thread.
+    """
+
+    def __init__(
+        self,
+        threads: Optional[Set[int]] = None,
+        interval: float = DEFAULT_SAMPLE_INTERVAL,
+    ):
+        """
+        Args:
+            threads: Idents of the threads to sample, None for all threads
+            interval: Seconds between two samples
+        """
+        if interval <= 0:
+            raise ValueError("The sample interval must be positive")
+        self.threads = threads
+        self.interval = interval
+        # Number of samples by thread name and stack, outermost frame first
+        self.stacks: Dict[Tuple[str, Tuple[str, ...]], int] = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="paperqa-profiler", daemon=True
+        )
+
+    def start(self):
+        """Start sampling."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampling thread."""
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (self.threads and ident not in self.threads):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[(names.get(ident, str(ident)), tuple(reversed(stack)))] += 1
+            self.samples += 1
+
+    def save(self, path: Path):
+        """
+        Write the samples as collapsed stacks, one "thread;outer;...;inner count"
+        line per stack.
+
+        Args:
+            path: File to write
+        """
+        with open(path, "w") as f:
+            for (thread, stack), count in self.stacks.items():
+                f.write(";".join((thread, *stack)) + f" {count}\n")
+
+    def summary(self, top: int = TOP_HOTSPOTS) -> Dict[str, Any]:
+        """
+        Summarize the samples.
+
+        Args:
+            top: Number of hotspots to return
+
+        Returns:
+            Dict with the number of samples, the share of samples waiting by
+            thread, and the functions most often running, with the share of
+            samples they were running in ("self") or on the stack ("total")
+        """
+        self_counts: Dict[str, int] = collections.Counter()
+        total_counts: Dict[str, int] = collections.Counter()
+        threads: Dict[str, List[int]] = collections.defaultdict(lambda: [0, 0])
+        for (thread, stack), count in self.stacks.items():
+            if not stack:
+                continue
+            for label in set(stack):
+                total_counts[label] += count
+            threads[thread][0] += count
+            if is_waiting(stack[-1].split(" ", 1)[0]):
+                threads[thread][1] += count
+            else:
+                self_counts[stack[-1]] += count
+        thread_samples = sum(samples for samples, _ in threads.values())
+
+        def percent(count: int, of: int) -> float:
+            return round(100 * count / of, 1) if of else 0.0
+
+        return {
+            "samples": self.samples,
+            "interval": self.interval,
+            "threads": {
+                thread: {
+                    "samples": samples,
+                    "waiting_percent": percent(waiting, samples),
+                }
+                for thread, (samples, waiting) in sorted(threads.items())
+            },
+            "hotspots": [
+                {
+                    "function": label,
+                    "self_percent": percent(count, thread_samples),
+                    "total_percent": percent(total_counts[label], thread_samples),
+                }
+                for label, count in self_counts.most_common(top)
+            ],
+        }
+
+
+class Profile:
+    """
+    A profile of the server, saved to a file once stopped.
+
+    In "cprofile" mode, the event loop thread and optionally the thread
+    starting the profile are traced. Other threads can add profiles of their
+    own with `add`. In "sample" mode, the given threads are sampled.
+    """
+
+    def __init__(
+        self,
+        mode: str,
+        name: str,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        threads: Optional[Set[int]] = None,
+        trace_caller: bool = True,
+        interval: float = DEFAULT_SAMPLE_INTERVAL,
+    ):
+        """
+        Args:
+            mode: One of PROFILE_MODES
+            name: Name of the profile, part of its file name
+            loop: Event loop whose thread is profiled, if any
+            threads: Idents of the threads sampled, None for all threads
+            trace_caller: Trace the thread calling `start` and `stop` with
+                cProfile
+            interval: Seconds between two samples
+        """
+        self.mode = parse_mode(mode)
+        self.name = name
+        self.loop = loop
+        self.threads = threads
+        self.trace_caller = trace_caller
+        self.interval = interval
+        self.started_at: Optional[float] = None
+        self._sampler: Optional[StackSampler] = None
+        # cProfile profilers by thread ident, and finished ones added
+        self._tracers: Dict[int, cProfile.Profile] = {}
+        self._added: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    def start(self) -> "Profile":
+        """
+        Start profiling.
+
+        Returns:
+            The profile
+        """
+        self.started_at = time.perf_counter()
+        if self.mode == "sample":
+            self._sampler = StackSampler(self.threads, self.interval)
+            self._sampler.start()
+            return self
+
+        if not _cprofile_lock.acquire(blocking=False):
+            raise RuntimeError(
+                "Another cProfile profile is running, use the sample mode"
+            )
+        try:
+            if self.trace_caller:
+                self._trace()
+            if self.loop:
+                self._call_in_loop(self._trace)
+        except Exception:
+            self._untrace_all()
+            _cprofile_lock.release()
+            raise
+        return self
+
+    def _trace(self):
+        """Trace the current thread."""
+        tracer = cProfile.Profile()
+        tracer.enable()
+        self._tracers[threading.get_ident()] = tracer
+
+    def _untrace(self):
+        """Stop tracing the current thread."""
+        tracer = self._tracers.get(threading.get_ident())
+        if tracer:
+            tracer.disable()
+
+    def _untrace_all(self):
+        """Stop tracing the current thread and the event loop thread."""
+        self._untrace()
+        if self.loop and self.loop.is_running():
+            try:
+                self._call_in_loop(self._untrace)
+            except Exception as e:
+                logger.warning(f"Could not stop profiling the event loop: {e}")
+
+    def _call_in_loop(self, fn: Callable[[], Any]):
+        """Call a function on the event loop thread and wait for it."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+
+        def call():
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(call)
+        return future.result(timeout=LOOP_CALL_TIMEOUT)
+
+    def add(self, tracer: cProfile.Profile):
+        """
+        Add the profile of a thread traced separately, e.g. of a request
+        handled while the profile runs.
+
+        Args:
+            tracer: Disabled cProfile profiler
+        """
+        with self._lock:
+            self._added.append(tracer)
+
+    def stop(self, top: int = TOP_HOTSPOTS) -> Dict[str, Any]:
+        """
+        Stop profiling and save the profile.
+
+        Args:
+            top: Number of hotspots in the summary
+
+        Returns:
+            Dict with the mode, duration and file of the profile, and its
+            hotspots, see `StackSampler.summary` and `_cprofile_summary`
+        """
+        seconds = time.perf_counter() - self.started_at
+        directory = profile_directory()
+        directory.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r"[^\w.-]", "_", self.name)[:64]
+        stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}"
+
+        if self.mode == "sample":
+            self._sampler.stop()
+            path = directory / f"{stem}.txt"
+            self._sampler.save(path)
+            summary = self._sampler.summary(top)
+        else:
+            try:
+                self._untrace_all()
+            finally:
+                _cprofile_lock.release()
+            path = directory / f"{stem}.prof"
+            with self._lock:
+                tracers = [*self._tracers.values(), *self._added]
+            stats = pstats.Stats(*tracers, stream=io.StringIO())
+            stats.dump_stats(path)
+            summary = self._cprofile_summary(stats, top)
+        logger.info(f"Saved {self.mode} profile {self.name!r} to {path}")
+        return {
+            "mode": self.mode,
+            "seconds": round(seconds, 3),
+            "path": str(path),
+            **summary,
+        }
+
+    @staticmethod
+    def _cprofile_summary(stats: pstats.Stats, top: int) -> Dict[str, Any]:
+        """Get the functions running the longest themselves, and time waiting."""
+        # Rows of pstats are (primitive calls, calls, self time, total time,
+        # callers) by (file, line, function)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        waiting = sum(row[2] for (_, _, name), row in rows if is_waiting(name))
+        hotspots = []
+        for (filename, line, name), (_, calls, self_time, total_time, _) in rows:
+            if is_waiting(name):
+                continue
+            if len(hotspots) == top:
+                break
+            hotspots.append(
+                {
+                    "function": f"{name} ({Path(filename).name}:{line})",
+                    "calls": calls,
+                    "self_seconds": round(self_time, 4),
+                    "total_seconds": round(total_time, 4),
+                }
+            )
+        return {
+            "calls": stats.total_calls,
+            "running_seconds": round(stats.total_tt - waiting, 3),
+            "waiting_seconds": round(waiting, 3),
+            "hotspots": hotspots,
+        }
+
+
+class Profiler:
+    """
+    Profiles of a server process: the running session and request profiles.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """
+        Args:
+            loop: Event loop the questions are answered on, profiled along
+                with the requests
+        """
+        self.loop = loop
+        self.session: Optional[Profile] = None
+        self._loop_thread: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _loop_threads(self) -> Set[int]:
+        """Get the ident of the event loop thread, if any."""
+        if self.loop is None:
+            return set()
+        if self._loop_thread is None:
+
+            async def ident() -> int:
+                return threading.get_ident()
+
+            future = asyncio.run_coroutine_threadsafe(ident(), self.loop)
+            self._loop_thread = future.result(timeout=LOOP_CALL_TIMEOUT)
+        return {self._loop_thread}
+
+    def start(
+        self, mode: Union[bool, str] = True, interval: float = DEFAULT_SAMPLE_INTERVAL
+    ) -> Dict[str, Any]:
+        """
+        Start profiling the whole process until `stop`.
+
+        Args:
+            mode: True for the default mode, or one of PROFILE_MODES
+            interval: Seconds between two samples in "sample" mode
+
+        Returns:
+            Dict with the mode and sample interval of the session
+        """
+        with self._lock:
+            if self.session:
+                raise RuntimeError("Profiling is already running")
+            # Every thread is sampled, the event loop is traced
+            self.session = Profile(
+                parse_mode(mode),
+                "session",
+                loop=self.loop,
+                trace_caller=False,
+                interval=interval,
+            ).start()
+            return {"mode": self.session.mode, "interval": interval}
+
+    def stop(self, top: int = TOP_HOTSPOTS) -> Dict[str, Any]:
+        """
+        Stop profiling the process and save the profile.
+
+        Args:
+            top: Number of hotspots in the summary
+
+        Returns:
+            Summary of the profile, see `Profile.stop`
+        """
+        with self._lock:
+            if not self.session:
+                raise RuntimeError("Profiling is not running")
+            session, self.session = self.session, None
+        return session.stop(top)
+
+    @contextlib.contextmanager
+    def request(
+        self, mode: Optional[Union[bool, str]], name: str
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Profile a request handled by the current thread.
+
+        With a "cprofile" session running, the thread is traced for the
+        session whatever `mode` is.
+
+        Args:
+            mode: Profile of the request, None or False for none
+            name: Name of the profile, e.g. the request id
+
+        Yields:
+            Dict receiving the summary of the request profile when the block
+            exits, or an error if the profile couldn't be taken. Empty if the
+            request isn't profiled.
+        """
+        report: Dict[str, Any] = {}
+        session = self.session
+        tracer = None
+        if session and session.mode == "cprofile":
+            tracer = cProfile.Profile()
+            tracer.enable()
+        profile = None
+        if mode:
+            try:
+                profile = Profile(
+                    parse_mode(mode),
+                    name,
+                    loop=self.loop,
+                    threads={threading.get_ident(), *self._loop_threads()},
+                ).start()
+            except (ValueError, RuntimeError) as e:
+                report.update(status="error", message=str(e))
+        try:
+            yield report
+        finally:
+            if profile:
+                try:
+                    report.update(profile.stop())
+                except Exception as e:
+                    logger.error(f"Error saving the profile of {name!r}: {str(e)}")
+                    report.update(status="error", message=str(e))
+            if tracer:
+                tracer.disable()
+                session.add(tracer)
@@ -0,0 +1,542 @@
+"""
+PaperQA Rate Limits - Process-wide scheduling of LLM and embedding calls.
+
+All LLM and embedding calls of the process, whichever PaperQA instance or
+request makes them, go through `LLM_SCHEDULER` once `install` is called:
+
+- Each model has a token bucket refilled at its configured rate limit
+  (e.g. "30000 per 1 minute"), so concurrent questions share the quota
+  instead of each assuming it has all of it.
+- Provider responses drive the pace: a 429 pauses every call to the model
+  for the Retry-After time (or an exponential backoff) and lowers the rate,
+  which then recovers with each successful call. After the pause, a single
+  call probes the provider before the others resume, so they don't all hit
+  the limit again at once. Rate limit headers reporting an exhausted quota
+  pause the model until the quota resets.
+- Identical calls in flight at the same time (same model, prompt and
+  parameters) are made once and share the response.
+
+Doesn't import litellm until installed, so that the server can report the
+limiter state right away.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from paperqa_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Attempts of a call answered with 429 before the error is raised
+MAX_ATTEMPTS = 5
+
+# Exponential backoff after a 429 without Retry-After
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Seconds between checks whether a probing call is done
+PROBE_INTERVAL = 0.05
+
+# Rate scaling after a 429 and recovery per successful call
+DECREASE_FACTOR = 0.5
+INCREASE_STEP = 0.05
+MIN_SCALE = 0.1
+
+# Params of a call that make two calls identical, besides model and prompt
+CALL_PARAMS = (
+    "temperature",
+    "top_p",
+    "n",
+    "max_tokens",
+    "max_completion_tokens",
+    "stop",
+    "tools",
+    "tool_choice",
+    "response_format",
+    "dimensions",
+    "encoding_format",
+)
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Any) -> Optional[float]:
+    """
+    Parse a rate limit reset time into seconds.
+
+    Args:
+        value: Seconds (e.g. "20") or an OpenAI style duration (e.g. "6m0s")
+
+    Returns:
+        Seconds, None if the value can't be parsed
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    parts = _DURATION.findall(str(value))
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_SECONDS[unit] for amount, unit in parts)
+
+
+def strictest_limit(limits: List[str]) -> Optional[str]:
+    """
+    Pick the rate limit allowing the fewest tokens per second.
+
+    Args:
+        limits: Tokens per period, e.g. "30000 per 1 minute"
+
+    Returns:
+        The strictest limit, None if there are none
+    """
+    if not limits:
+        return None
+    from limits import parse
+
+    def rate(limit: str) -> float:
+        item = parse(limit)
+        return item.amount / item.get_expiry()
+
+    return min(limits, key=rate)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a fixed rate, allowing bursts up to its capacity.
+    """
+
+    def __init__(self, amount: float, period: float):
+        """
+        Args:
+            amount: Tokens allowed per period, also the capacity of the bucket
+            period: Length of the period in seconds
+        """
+        self.capacity = amount
+        self.rate = amount / period
+        self.tokens = amount
+        self.updated = time.monotonic()
+
+    def refill(self, scale: float = 1.0):
+        """Add the tokens earned since the last refill, at `scale` times the rate."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate * scale
+        )
+        self.updated = now
+
+    def wait_time(self, cost: float, scale: float = 1.0) -> float:
+        """Seconds until `cost` tokens are available, 0 if they are now."""
+        self.refill(scale)
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / (self.rate * scale)
+
+
+class ModelLimiter:
+    """
+    Pace of the calls to one model.
+    """
+
+    def __init__(self, model: str):
+        """
+        Args:
+            model: Name of the model
+        """
+        self.model = model
+        self.limit: Optional[str] = None
+        self.bucket: Optional[TokenBucket] = None
+        # Fraction of the configured rate currently used, lowered on 429s
+        self.scale = 1.0
+        self.paused_until = 0.0
+        # Only one call at a time until a call succeeds after a 429
+        self.probing = False
+        self.waiting = 0
+        self.in_flight = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def set_limit(self, limit: Optional[str]):
+        """
+        Set the rate limit of the model.
+
+        Args:
+            limit: Tokens per period, e.g. "30000 per 1 minute", None for no
+                limit other than the provider's responses
+        """
+        with self._lock:
+            if limit == self.limit:
+                return
+            self.limit = limit
+            if limit is None:
+                self.bucket = None
+                return
+            from limits import parse
+
+            item = parse(limit)
+            self.bucket = TokenBucket(item.amount, item.get_expiry())
+
+    async def acquire(self, cost: float) -> float:
+        """
+        Wait until a call of `cost` tokens may be made.
+
+        Args:
+            cost: Estimated tokens of the call
+
+        Returns:
+            Seconds waited
+        """
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    delay = self.paused_until - time.monotonic()
+                    if delay <= 0 and self.probing and self.in_flight:
+                        delay = PROBE_INTERVAL
+                    if delay <= 0 and self.bucket is not None:
+                        delay = self.bucket.wait_time(cost, self.scale)
+                        if delay <= 0:
+                            self.bucket.tokens -= min(cost, self.bucket.capacity)
+                    if delay <= 0:
+                        self.in_flight += 1
+                        return time.monotonic() - start
+                await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+    def release(self, extra_tokens: float = 0.0):
+        """
+        Record that a call is done.
+
+        Args:
+            extra_tokens: Tokens used beyond the estimate, negative if fewer
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if self.bucket is not None and extra_tokens:
+                self.bucket.refill(self.scale)
+                self.bucket.tokens -= extra_tokens
+
+    def on_success(self, headers: Optional[Dict[str, Any]] = None):
+        """
+        Speed up again after a successful call, and pause if the provider
+        reports an exhausted quota.
+
+        Args:
+            headers: Response headers of the call
+        """
+        pause = None
+        for kind in ("requests", "tokens"):
+            remaining = _header(headers, f"ratelimit-remaining-{kind}")
+            if remaining is not None and str(remaining).strip() in ("0", "0.0"):
+                reset = parse_duration(_header(headers, f"ratelimit-reset-{kind}"))
+                if reset is not None:
+                    pause = max(pause or 0.0, reset)
+        with self._lock:
+            self.scale = min(1.0, self.scale + INCREASE_STEP)
+            self.probing = False
+            if pause:
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        if pause:
+            logger.info(f"{self.model} quota exhausted, pausing for {pause:.1f}s")
+
+    def on_rate_limited(self, attempt: int, headers: Optional[Dict[str, Any]] = None):
+        """
+        Slow down after a 429.
+
+        Args:
+            attempt: Number of the attempt that was rate limited, from 1
+            headers: Response headers of the call
+        """
+        delay = parse_duration(_header(headers, "retry-after"))
+        if delay is None:
+            delay = min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX)
+            delay *= random.uniform(0.5, 1.0)
+        with self._lock:
+            self.rate_limited += 1
+            self.probing = True
+            self.scale = max(MIN_SCALE, self.scale * DECREASE_FACTOR)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        logger.warning(
+            f"{self.model} rate limited (attempt {attempt}), pausing for"
+            f" {delay:.1f}s at {self.scale:.0%} of the rate limit"
+        )
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the state of the limiter.
+
+        Returns:
+            Dict with the limit, the fraction of it in use, the saturation of
+            the token bucket (1 when empty) and the calls waiting and running
+        """
+        with self._lock:
+            saturation = None
+            if self.bucket is not None:
+                self.bucket.refill(self.scale)
+                saturation = round(
+                    1 - max(self.bucket.tokens, 0.0) / self.bucket.capacity, 3
+                )
+            return {
+                "limit": self.limit,
+                "scale": round(self.scale, 3),
+                "saturation": saturation,
+                "paused_seconds": round(
+                    max(self.paused_until - time.monotonic(), 0.0), 3
+                ),
+                "probing": self.probing,
+                "waiting": self.waiting,
+                "in_flight": self.in_flight,
+                "rate_limited": self.rate_limited,
+            }
+
+
+def _header(headers: Optional[Dict[str, Any]], suffix: str) -> Any:
+    """Get a header by the end of its name, e.g. x-ratelimit-remaining-tokens."""
+    if not headers:
+        return None
+    for name, value in headers.items():
+        if name.lower().endswith(suffix):
+            return value
+    return None
+
+
+def _response_headers(obj: Any) -> Optional[Dict[str, Any]]:
+    """Get the HTTP headers of a litellm response or exception."""
+    hidden = getattr(obj, "_hidden_params", None)
+    if isinstance(hidden, dict) and hidden.get("additional_headers"):
+        return hidden["additional_headers"]
+    headers = getattr(obj, "litellm_response_headers", None) or getattr(
+        getattr(obj, "response", None), "headers", None
+    )
+    return dict(headers) if headers else None
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+class LLMScheduler:
+    """
+    Rate limiting, backoff and coalescing of the LLM and embedding calls of
+    the process.
+    """
+
+    def __init__(self):
+        self.limiters: Dict[str, ModelLimiter] = {}
+        # Limits asked for by each owner, e.g. a PaperQA instance, by model
+        self._owner_limits: Dict[Hashable, Dict[str, str]] = {}
+        self._limits_lock = threading.Lock()
+        # Calls in flight by their identity, with the number of callers
+        self._calls: Dict[str, Tuple[asyncio.Task, list]] = {}
+        self._lock = threading.Lock()
+        self._installed = False
+
+    def limiter(self, model: str) -> ModelLimiter:
+        """Get the limiter of a model."""
+        with self._lock:
+            if model not in self.limiters:
+                self.limiters[model] = ModelLimiter(model)
+            return self.limiters[model]
+
+    def set_limit(self, model: str, limit: Optional[str]):
+        """
+        Set the rate limit of a model, for all PaperQA instances.
+
+        Args:
+            model: Name of the model, as passed to litellm
+            limit: Tokens per period, e.g. "30000 per 1 minute", None for no
+                limit other than the provider's responses
+        """
+        self.limiter(model).set_limit(limit)
+
+    def set_limits(self, owner: Hashable, limits: Dict[str, str]):
+        """
+        Set the rate limits of an owner, replacing the ones it set before.
+
+        Owners are e.g. the PaperQA instances of the process. A model limited
+        by several owners gets the strictest of their limits, and a model no
+        owner limits anymore is no longer limited.
+
+        Args:
+            owner: Identity of the owner
+            limits: Tokens per period by model name, empty to drop the
+                owner's limits
+        """
+        with self._limits_lock:
+            previous = self._owner_limits.pop(owner, {})
+            if limits:
+                self._owner_limits[owner] = dict(limits)
+            for model in set(previous) | set(limits):
+                self.set_limit(
+                    model,
+                    strictest_limit(
+                        [
+                            owner_limits[model]
+                            for owner_limits in self._owner_limits.values()
+                            if model in owner_limits
+                        ]
+                    ),
+                )
+
+    def install(self):
+        """Route all litellm completion and embedding calls through the scheduler."""
+        if self._installed:
+            return
+        import litellm
+
+        acompletion, aembedding = litellm.acompletion, litellm.aembedding
+
+        async def scheduled_acompletion(*args, **kwargs):
+            return await self.call("completion", acompletion, *args, **kwargs)
+
+        async def scheduled_aembedding(*args, **kwargs):
+            return await self.call("embedding", aembedding, *args, **kwargs)
+
+        litellm.acompletion = scheduled_acompletion
+        litellm.aembedding = scheduled_aembedding
+        self._installed = True
+
+    async def call(
+        self, call_type: str, func: Callable[..., Awaitable[Any]], *args, **kwargs
+    ) -> Any:
+        """
+        Make an LLM or embedding call, or join an identical one in flight.
+
+        Args:
+            call_type: "completion" or "embedding"
+            func: litellm function making the call
+            *args: Positional arguments of the call
+            **kwargs: Keyword arguments of the call, with "model"
+
+        Returns:
+            The response of the call
+        """
+        model = kwargs.get("model") or (args[0] if args else "")
+        if kwargs.get("stream"):
+            # Streams can't be shared
+            return await self._call(call_type, model, func, args, kwargs)
+
+        key = self._call_key(call_type, model, args, kwargs)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            shared = self._calls.get(key)
+            if shared is not None and shared[0].get_loop() is not loop:
+                shared = None
+            if shared is None:
+                task = loop.create_task(
+                    self._call(call_type, model, func, args, kwargs)
+                )
+                shared = (task, [0])
+                self._calls[key] = shared
+                task.add_done_callback(lambda _, key=key: self._calls.pop(key, None))
+            else:
+                METRICS.increment(
+                    "paperqa_llm_coalesced_total", model=model, call_type=call_type
+                )
+            task, callers = shared
+            callers[0] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Stop the call once nobody waits for it anymore
+            with self._lock:
+                callers[0] -= 1
+                if callers[0] == 0:
+                    task.cancel()
+            raise
+
+    @staticmethod
+    def _call_key(
+        call_type: str, model: str, args: tuple, kwargs: Dict[str, Any]
+    ) -> str:
+        """Identity of a call, equal for calls with the same result."""
+        payload = {
+            "call_type": call_type,
+            "model": model,
+            "args": args,
+            "messages": kwargs.get("messages"),
+            "input": kwargs.get("input"),
+            **{name: kwargs[name] for name in CALL_PARAMS if name in kwargs},
+        }
+        encoded = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    @staticmethod
+    def _estimate_tokens(kwargs: Dict[str, Any]) -> int:
+        """Rough token count of a call, 4 characters per token."""
+        prompt = kwargs.get("messages") or kwargs.get("input") or ""
+        return max(len(json.dumps(prompt, default=str)) // 4, 1)
+
+    async def _call(
+        self,
+        call_type: str,
+        model: str,
+        func: Callable[..., Awaitable[Any]],
+        args: tuple,
+        kwargs: Dict[str, Any],
+    ) -> Any:
+        """Make a call within the rate limit of its model, retrying on 429s."""
+        limiter = self.limiter(model)
+        estimate = self._estimate_tokens(kwargs)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            waited = await limiter.acquire(estimate)
+            METRICS.observe(
+                "paperqa_llm_limiter_wait_seconds",
+                waited,
+                model=model,
+                call_type=call_type,
+            )
+            extra = 0.0
+            try:
+                response = await func(*args, **kwargs)
+            except Exception as e:
+                if not _is_rate_limited(e) or attempt == MAX_ATTEMPTS:
+                    raise
+                METRICS.increment(
+                    "paperqa_llm_rate_limited_total", model=model, call_type=call_type
+                )
+                limiter.on_rate_limited(attempt, _response_headers(e))
+                continue
+            else:
+                usage = getattr(response, "usage", None)
+                used = getattr(usage, "total_tokens", None) if usage else None
+                if used:
+                    extra = used - estimate
+                limiter.on_success(_response_headers(response))
+                return response
+            finally:
+                limiter.release(extra)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the state of the limiters.
+
+        Returns:
+            Dict with the state of each model's limiter, see
+            `ModelLimiter.status`, and the number of calls in flight
+        """
+        with self._lock:
+            limiters = list(self.limiters.values())
+            calls = len(self._calls)
+        return {
+            "installed": self._installed,
+            "shared_calls": calls,
+            "models": {limiter.model: limiter.status() for limiter in limiters},
+        }
+
+
+# Scheduler of all LLM calls of the process
+LLM_SCHEDULER = LLMScheduler()
@@ -0,0 +1,232 @@
+"""
+PaperQA Responses - Compact encoding of the replies sent to clients.
+
+Answers carry every context gathered for them, and a `formatted_answer` that
+repeats the answer and the references. Clients can ask for a smaller reply:
+only some fields, contexts cut to a maximum length, repeated text left out,
+and msgpack instead of JSON. `expand_response` restores left out text.
+
+msgpack is optional, replies are JSON when it isn't installed.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODINGS = ("json", "msgpack")
+
+# First frame of msgpack replies, JSON replies are a single frame
+MSGPACK_HEADER = b"msgpack"
+
+# Fields kept whatever `fields` are selected, so errors are still reported
+ALWAYS_KEPT = ("status", "message")
+
+# Request params controlling the reply format
+OPTIONS = ("fields", "max_context_chars", "dedupe", "encoding")
+
+
+def format_answer(question: str, answer: str, references: str) -> str:
+    """Build the formatted answer the way PaperQA does."""
+    formatted_answer = f"Question: {question}\n\n{answer}\n"
+    if references:
+        formatted_answer += f"\nReferences\n\n{references}\n"
+    return formatted_answer
+
+
+class ResponseFormat:
+    """
+    How to shape and encode the reply to a request.
+    """
+
+    def __init__(
+        self,
+        fields: Optional[Sequence[str]] = None,
+        max_context_chars: Optional[int] = None,
+        dedupe: bool = False,
+        encoding: str = "json",
+    ):
+        """
+        Args:
+            fields: Fields of the answers to return, None for all of them.
+                "status" and "message" are always returned.
+            max_context_chars: Length to cut the text of contexts to, None to
+                return it whole
+            dedupe: Leave out text repeated elsewhere in the answer, see
+                `expand_response`
+            encoding: "json" or "msgpack"
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(
+                f"Unknown encoding {encoding!r}, expected one of {ENCODINGS}"
+            )
+        if encoding == "msgpack" and msgpack is None:
+            raise ValueError("msgpack encoding requested but msgpack isn't installed")
+        if max_context_chars is not None and max_context_chars < 0:
+            raise ValueError("max_context_chars can't be negative")
+        self.fields = set(fields) | set(ALWAYS_KEPT) if fields is not None else None
+        self.max_context_chars = max_context_chars
+        self.dedupe = dedupe
+        self.encoding = encoding
+
+    @classmethod
+    def from_params(cls, params: Dict[str, Any]) -> "ResponseFormat":
+        """
+        Take the reply format out of request params.
+
+        Args:
+            params: Request params, the format options are removed from them
+
+        Returns:
+            The requested reply format
+        """
+        return cls(**{key: params.pop(key) for key in OPTIONS if key in params})
+
+    @property
+    def is_default(self) -> bool:
+        """Whether replies are sent as is."""
+        return (
+            self.fields is None
+            and self.max_context_chars is None
+            and not self.dedupe
+            and self.encoding == "json"
+        )
+
+    def compact(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Shape a reply, or a batch reply, as requested.
+
+        Args:
+            result: Reply of a method, answers may be nested under "results"
+
+        Returns:
+            The shaped reply, `result` is left unchanged
+        """
+        if isinstance(result.get("results"), list):
+            return {
+                **result,
+                "results": [
+                    self.compact(r) if isinstance(r, dict) else r
+                    for r in result["results"]
+                ],
+            }
+        if self.fields is not None:
+            result = {key: value for key, value in result.items() if key in self.fields}
+        if self.dedupe:
+            result = self._dedupe(result)
+        if self.max_context_chars is not None and result.get("contexts"):
+            result = {**result, "contexts": self._truncate(result["contexts"])}
+        return result
+
+    @staticmethod
+    def _dedupe(result: Dict[str, Any]) -> Dict[str, Any]:
+        """Leave out the formatted answer and repeated context text."""
+        result = dict(result)
+        derived = []
+        expected = format_answer(
+            result.get("question", ""),
+            result.get("answer", ""),
+            result.get("references", ""),
+        )
+        if result.get("formatted_answer") == expected:
+            del result["formatted_answer"]
+            derived.append("formatted_answer")
+        if result.get("contexts"):
+            seen: Dict[str, int] = {}
+            contexts = []
+            for i, ctx in enumerate(result["contexts"]):
+                text = ctx.get("context")
+                if text and text in seen:
+                    ctx = {k: v for k, v in ctx.items() if k != "context"}
+                    ctx["same_as"] = seen[text]
+                elif text:
+                    seen[text] = i
+                contexts.append(ctx)
+            result["contexts"] = contexts
+        if derived:
+            result["derived"] = derived
+        return result
+
+    def _truncate(self, contexts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Cut the text of contexts to `max_context_chars`."""
+        truncated = []
+        for ctx in contexts:
+            text = ctx.get("context")
+            if text and len(text) > self.max_context_chars:
+                ctx = {
+                    **ctx,
+                    "context": text[: self.max_context_chars],
+                    "truncated": True,
+                }
+            truncated.append(ctx)
+        return truncated
+
+    def encode(self, result: Dict[str, Any]) -> List[bytes]:
+        """
+        Encode a reply into message frames.
+
+        Args:
+            result: Reply to encode
+
+        Returns:
+            A single JSON frame, or MSGPACK_HEADER followed by the msgpack frame
+        """
+        if self.encoding == "msgpack":
+            return [MSGPACK_HEADER, msgpack.packb(result, use_bin_type=True)]
+        return [json.dumps(result).encode()]
+
+
+def decode_response(frames: List[bytes]) -> Dict[str, Any]:
+    """
+    Decode the frames of a reply, see `ResponseFormat.encode`.
+
+    Args:
+        frames: Frames of the reply
+
+    Returns:
+        The reply
+    """
+    if len(frames) == 2 and frames[0] == MSGPACK_HEADER:
+        if msgpack is None:
+            raise ValueError("Reply is msgpack encoded but msgpack isn't installed")
+        return msgpack.unpackb(frames[1], raw=False)
+    return json.loads(frames[0])
+
+
+def expand_response(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Restore the text left out of a deduplicated reply.
+
+    Args:
+        result: Reply shaped with `dedupe`, answers may be nested under "results"
+
+    Returns:
+        The reply with the formatted answer and all context text
+    """
+    if isinstance(result.get("results"), list):
+        return {
+            **result,
+            "results": [
+                expand_response(r) if isinstance(r, dict) else r
+                for r in result["results"]
+            ],
+        }
+    result = dict(result)
+    if "formatted_answer" in result.pop("derived", []):
+        result["formatted_answer"] = format_answer(
+            result.get("question", ""),
+            result.get("answer", ""),
+            result.get("references", ""),
+        )
+    if result.get("contexts"):
+        contexts = []
+        for ctx in result["contexts"]:
+            if "same_as" in ctx:
+                ctx = dict(ctx)
+                ctx["context"] = contexts[ctx.pop("same_as")]["context"]
+            contexts.append(ctx)
+        result["contexts"] = contexts
+    return result
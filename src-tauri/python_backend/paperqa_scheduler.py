@@ -0,0 +1,293 @@
+"""
+PaperQA Scheduler - Priority and fair queuing of requests for the worker pool.
+
+Requests wait in one of two priority classes. Interactive requests (single
+questions, settings changes) always start before batch requests (question
+batches, indexing), and some workers are kept free of batch work so that an
+interactive request doesn't wait for a long batch to finish. Within a class,
+clients take turns, so a client submitting hundreds of requests doesn't hold
+back the others. Each class has a maximum queue depth, requests beyond it are
+rejected right away instead of waiting.
+
+Doesn't depend on ZMQ, the server hands queued requests to idle workers.
+"""
+
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# Priority of requests that don't set one
+DEFAULT_PRIORITIES = {"ask_batch": BATCH, "index": BATCH, "reindex": BATCH}
+
+DEFAULT_MAX_QUEUE = 256
+
+# Weight of the latest request in the average service time
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class QueuedRequest:
+    """
+    A request waiting for a worker.
+    """
+
+    def __init__(
+        self,
+        envelope: List[bytes],
+        request_data: Dict[str, Any],
+        client: str,
+        priority: str,
+    ):
+        """
+        Args:
+            envelope: Routing frames of the client
+            request_data: Decoded request
+            client: Id of the client, requests of a client are served in order
+            priority: INTERACTIVE or BATCH
+        """
+        self.envelope = envelope
+        self.request_data = request_data
+        self.client = client
+        self.priority = priority
+        self.request_id = (request_data.get("params") or {}).get("request_id")
+        self.queued_at = time.perf_counter()
+        # Times the request was started on a worker that failed before answering
+        self.attempts = 0
+
+
+class RequestScheduler:
+    """
+    Queues of requests by priority class and client.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+        interactive_workers: int = 1,
+    ):
+        """
+        Args:
+            workers: Number of workers serving the requests
+            max_queue: Maximum number of waiting requests per priority class
+            interactive_workers: Workers kept free of batch requests, at most
+                all workers but one
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.interactive_workers = max(min(interactive_workers, workers - 1), 0)
+        # Waiting requests by priority, then by client in turn order
+        self._queues: Dict[str, "OrderedDict[str, Deque[QueuedRequest]]"] = {
+            priority: OrderedDict() for priority in PRIORITIES
+        }
+        self._depth = {priority: 0 for priority in PRIORITIES}
+        self.running = {priority: 0 for priority in PRIORITIES}
+        # Smoothed seconds a worker spends on a request, by priority
+        self.service_seconds: Dict[str, Optional[float]] = {
+            priority: None for priority in PRIORITIES
+        }
+
+    @staticmethod
+    def priority_of(request_data: Dict[str, Any]) -> str:
+        """
+        Get the priority class of a request.
+
+        Args:
+            request_data: Decoded request, with an optional "priority" param
+
+        Returns:
+            INTERACTIVE or BATCH
+        """
+        params = request_data.get("params") or {}
+        priority = params.get("priority") or DEFAULT_PRIORITIES.get(
+            request_data.get("method"), INTERACTIVE
+        )
+        if priority not in PRIORITIES:
+            raise ValueError(
+                f"Unknown priority {priority!r}, expected one of {PRIORITIES}"
+            )
+        return priority
+
+    def submit(self, request: QueuedRequest, front: bool = False) -> bool:
+        """
+        Queue a request.
+
+        Args:
+            request: The request
+            front: Start the request before the other requests of its client,
+                even if the queue is full, for requests that already started
+                once and are retried
+
+        Returns:
+            False if the queue of its priority class is full
+        """
+        if not front and self._depth[request.priority] >= self.max_queue:
+            return False
+        queue = self._queues[request.priority]
+        requests = queue.setdefault(request.client, deque())
+        if front:
+            requests.appendleft(request)
+            queue.move_to_end(request.client, last=False)
+        else:
+            requests.append(request)
+        self._depth[request.priority] += 1
+        return True
+
+    def next(self) -> Optional[QueuedRequest]:
+        """
+        Take the request to start next on an idle worker.
+
+        Returns:
+            The request, None if no request may start now
+        """
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            if not queue or not self._may_start(priority):
+                continue
+            client, requests = next(iter(queue.items()))
+            request = requests.popleft()
+            # The client goes to the back of the line
+            del queue[client]
+            if requests:
+                queue[client] = requests
+            self._depth[priority] -= 1
+            self.running[priority] += 1
+            return request
+        return None
+
+    def _may_start(self, priority: str) -> bool:
+        """Whether a request of a priority class may take an idle worker."""
+        if priority == INTERACTIVE:
+            return True
+        return self.running[BATCH] < self.workers - self.interactive_workers
+
+    def finished(self, priority: str, seconds: Optional[float]):
+        """
+        Record that a request started by `next` is done.
+
+        Args:
+            priority: Priority class of the request
+            seconds: Time the worker spent on it, None if the worker failed
+                before answering
+        """
+        self.running[priority] -= 1
+        if seconds is None:
+            return
+        average = self.service_seconds[priority]
+        self.service_seconds[priority] = (
+            seconds
+            if average is None
+            else average + SERVICE_TIME_SMOOTHING * (seconds - average)
+        )
+
+    def remove(self, request_id: str) -> Optional[QueuedRequest]:
+        """
+        Take a waiting request out of the queue.
+
+        Args:
+            request_id: Id the request was submitted with
+
+        Returns:
+            The request, None if no waiting request has this id
+        """
+        for priority, queue in self._queues.items():
+            for client, requests in queue.items():
+                for request in requests:
+                    if request.request_id == request_id:
+                        requests.remove(request)
+                        if not requests:
+                            del queue[client]
+                        self._depth[priority] -= 1
+                        return request
+        return None
+
+    def position(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get where a waiting request is in the queue.
+
+        Args:
+            request_id: Id the request was submitted with
+
+        Returns:
+            Dict with the number of requests that start before it and the
+            estimated wait in seconds, None if no waiting request has this id
+        """
+        for priority in PRIORITIES:
+            clients = list(self._queues[priority].values())
+            for turn, requests in enumerate(clients):
+                for index, request in enumerate(requests):
+                    if request.request_id != request_id:
+                        continue
+                    # Clients take turns: each one ahead in line gets
+                    # index + 1 requests in first, the others index
+                    ahead = sum(
+                        min(len(other), index + (other_turn < turn))
+                        for other_turn, other in enumerate(clients)
+                    )
+                    if priority == BATCH:
+                        ahead += self._depth[INTERACTIVE]
+                    return {
+                        "priority": priority,
+                        "position": ahead,
+                        "estimated_wait": self.estimated_wait(priority, ahead),
+                    }
+        return None
+
+    def estimated_wait(self, priority: str, ahead: int) -> Optional[float]:
+        """
+        Estimate how long a request waits for a worker.
+
+        Rough estimate from the average service time, assuming all workers
+        the request may use are busy.
+
+        Args:
+            priority: Priority class of the request
+            ahead: Number of requests that start before it
+
+        Returns:
+            Seconds, None before any request of the class was served
+        """
+        average = self.service_seconds[priority]
+        if average is None:
+            return None
+        capacity = (
+            self.workers
+            if priority == INTERACTIVE
+            else self.workers - self.interactive_workers
+        )
+        return round((ahead + 1) * average / capacity, 3)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the state of the queues.
+
+        Returns:
+            Dict with the waiting and running requests, clients and average
+            service time per priority class, and the queue limits
+        """
+        return {
+            "workers": self.workers,
+            "interactive_workers": self.interactive_workers,
+            "max_queue": self.max_queue,
+            "priorities": {
+                priority: {
+                    "queued": self._depth[priority],
+                    "running": self.running[priority],
+                    "clients": len(self._queues[priority]),
+                    "service_seconds": (
+                        round(self.service_seconds[priority], 3)
+                        if self.service_seconds[priority] is not None
+                        else None
+                    ),
+                    "estimated_wait": self.estimated_wait(
+                        priority,
+                        self._depth[priority]
+                        + (self._depth[INTERACTIVE] if priority == BATCH else 0),
+                    ),
+                }
+                for priority in PRIORITIES
+            },
+        }
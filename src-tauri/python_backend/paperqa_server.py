@@ -5,16 +5,51 @@
 #     "pyzmq",
 # ]
 # ///
+import asyncio
 import atexit
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import gc
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import queue
 import signal
+import sqlite3
 import sys
 import threading
-from typing import Any, Dict, Optional, Literal
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Literal, Tuple
 
 import zmq
-from paperqa_api import PaperQA
+from paperqa_history import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    AnswerHistory,
+    default_history_path,
+)
+from paperqa_metrics import METRICS
+from paperqa_presets import PRESET_NAMES
+from paperqa_profiling import DEFAULT_SAMPLE_INTERVAL, TOP_HOTSPOTS, Profiler
+from paperqa_ratelimit import LLM_SCHEDULER
+from paperqa_response import ResponseFormat
+from paperqa_scheduler import DEFAULT_MAX_QUEUE, QueuedRequest, RequestScheduler
+from paperqa_supervisor import (
+    BROADCAST_METHODS,
+    CONFIG_METHODS,
+    MAX_REQUEST_RETRIES,
+    ControlCall,
+    WorkerProcess,
+    WorkerSupervisor,
+)
+
+if TYPE_CHECKING:
+    from paperqa_api import EventCallback, PaperQA
+    from paperqa_indexing import PaperDirectoryWatcher
 
 # Configure logging
 logging.basicConfig(
@@ -23,18 +58,220 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Imported in the background by `PaperQAService`, since importing paperqa
+# (and litellm with it) takes seconds
+PaperQA = None
+PaperDirectoryWatcher = None
+fingerprint = None
+
+# Instance used by requests that don't name one
+DEFAULT_INSTANCE = "default"
+
+# Seconds a request may run past its deadline while its partial result is
+# collected, before the worker stops waiting for it
+DEADLINE_GRACE = 5.0
+
+# Seconds for which a cancelled request id is remembered, to cancel requests
+# that are still queued when the cancel request arrives
+CANCELLED_TTL = 300.0
+
+# Memory an unloaded instance has to free for the memory budget to unload more
+# instances. Freed memory often stays with the process, and unloading every
+# idle instance on each load wouldn't bring it back under the budget.
+MIN_FREED_BYTES = 16 * 2**20
+
+
+def memory_usage() -> Optional[int]:
+    """
+    Get the resident memory of the server process.
+
+    Uses psutil if it is installed, /proc otherwise.
+
+    Returns:
+        Resident set size in bytes, or None if it can't be measured
+    """
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class PaperQAInstance:
+    """
+    A loaded PaperQA instance and its background work.
+
+    Names initialized with the same configuration share one instance, and with
+    it the loaded index, model clients and caches.
+    """
+
+    def __init__(self, paperqa: "PaperQA", config: Dict[str, Any], key: str):
+        """
+        Args:
+            paperqa: The PaperQA instance
+            config: Arguments the PaperQA instance was created with
+            key: Fingerprint of the configuration
+        """
+        self.paperqa = paperqa
+        self.config = config
+        self.key = key
+        self.names = set()
+        self.last_used = time.monotonic()
+        # Number of requests using the instance, which keep it loaded
+        self.active = 0
+
+        # Background index builds and the paper directory watcher triggering them
+        self.index_future: Optional[concurrent.futures.Future] = None
+        self.watcher: Optional["PaperDirectoryWatcher"] = None
+        self.watch_interval: Optional[float] = None
+
+        # Background warm-up, redone after settings updates if requested
+        self.warmup_future: Optional[concurrent.futures.Future] = None
+        self.warm = False
+
+        # Serializes settings updates of the instance
+        self.update_lock = threading.Lock()
+
+        # Set once the instance is unloaded, it is closed once idle
+        self.unloaded = False
+        self.closed = False
+
+    def is_idle(self) -> bool:
+        """Whether no request or background work is using the instance."""
+        background = (self.index_future, self.warmup_future)
+        return self.active == 0 and all(f is None or f.done() for f in background)
+
 
 class PaperQAService:
     """
-    ZMQ-based service that exposes the PaperQA API (Single Instance).
+    ZMQ-based service that exposes the PaperQA API.
+
+    Serves several named PaperQA instances, e.g. one per paper directory or
+    provider. Requests go to the instance named by their `instance` param, or
+    to DEFAULT_INSTANCE. Idle instances are unloaded, least recently used
+    first, when too many are loaded or the process uses too much memory, and
+    are loaded again on their next request.
     """
 
-    def __init__(self):
-        """Initialize the service without a PaperQA instance yet."""
-        self.paperqa = None
-        self.is_initialized = False
+    def __init__(
+        self,
+        max_instances: int = 4,
+        memory_budget_mb: Optional[float] = None,
+        index_owner: bool = True,
+    ):
+        """
+        Initialize the service without PaperQA instances yet.
+
+        Args:
+            max_instances: Maximum number of instances kept loaded
+            memory_budget_mb: Resident memory of the process above which idle
+                instances are unloaded, None for no limit
+            index_owner: Whether the service watches paper directories and
+                builds missing indexes when warming up, False for all worker
+                processes of a supervisor but one, which share the indexes
+        """
+        if max_instances < 1:
+            raise ValueError("The service needs room for at least one instance")
+        self.max_instances = max_instances
+        self.memory_budget_mb = memory_budget_mb
+        self.index_owner = index_owner
+        # Resident memory after an unload that freed nothing, the budget only
+        # unloads instances again once the process grew past it or got back
+        # under budget
+        self._memory_floor: Optional[int] = None
+
+        # Loaded instances by name, names with the same configuration share one
+        self.instances: Dict[str, PaperQAInstance] = {}
+        # How each name was initialized, to load it again after it was unloaded
+        self._configs: Dict[str, Dict[str, Any]] = {}
+
+        # Load PaperQA while the server already answers status requests
+        self._api_loaded = threading.Event()
+        self._api_error: Optional[str] = None
+        threading.Thread(
+            target=self._load_api, name="paperqa-import", daemon=True
+        ).start()
+
+        # Serializes (re)configuration, requests are served from several threads
+        self._lock = threading.RLock()
+
+        # Persistent event loop shared by all questions, so that LLM clients,
+        # rate limiters and index handles stay warm between requests
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="paperqa-event-loop", daemon=True
+        )
+        self._loop_thread.start()
+
+        # Futures of running requests, by request id
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+        # Ids cancelled before their request started, with the time of the
+        # cancellation
+        self._cancelled: Dict[str, float] = {}
+        self._inflight_lock = threading.Lock()
+
+        # Answers given by all instances
+        self.history: Optional[AnswerHistory] = None
+        try:
+            self.history = AnswerHistory(default_history_path())
+        except (OSError, sqlite3.Error) as e:
+            # Answers are still given, just not recorded
+            logger.error(f"Error opening the answer history: {str(e)}")
         logger.info("PaperQA service initialized (waiting for configuration)")
 
+    @property
+    def paperqa(self) -> Optional["PaperQA"]:
+        """PaperQA instance of the default instance, if loaded."""
+        instance = self.instances.get(DEFAULT_INSTANCE)
+        return instance.paperqa if instance else None
+
+    @property
+    def is_initialized(self) -> bool:
+        """Whether the default instance was initialized."""
+        return DEFAULT_INSTANCE in self._configs
+
+    def _load_api(self):
+        """Import the PaperQA API."""
+        global PaperQA, PaperDirectoryWatcher, fingerprint
+        start = time.perf_counter()
+        try:
+            from paperqa_api import PaperQA
+            from paperqa_cache import fingerprint
+            from paperqa_indexing import PaperDirectoryWatcher
+
+            logger.info(f"PaperQA loaded in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"Error loading PaperQA: {str(e)}")
+            self._api_error = str(e)
+        finally:
+            self._api_loaded.set()
+
+    def _wait_for_api(self):
+        """Block until the PaperQA API is imported."""
+        self._api_loaded.wait()
+        if self._api_error:
+            raise RuntimeError(f"PaperQA could not be loaded: {self._api_error}")
+
+    def close(self):
+        """Stop the paper directory watchers, the shared event loop and PaperQA."""
+        instances = self._loaded()
+        for instance in instances:
+            if instance.watcher:
+                instance.watcher.stop()
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._loop_thread.join(timeout=5.0)
+        for instance in instances:
+            instance.paperqa.close()
+        if self.history:
+            self.history.close()
+
     def initialize(
         self,
         paper_dir: str,
@@ -53,9 +290,31 @@ class PaperQAService:
         index_name: Optional[str] = None,
         api_key: Optional[str] = None,
         provider_type: Literal["openai", "anthropic", "gemini"] = "gemini",
+        use_answer_cache: bool = False,
+        answer_cache_ttl: Optional[float] = 7 * 24 * 3600,
+        answer_cache_max_entries: int = 1000,
+        use_semantic_cache: bool = False,
+        semantic_cache_threshold: float = 0.92,
+        use_evidence_cache: bool = True,
+        evidence_cache_max_entries: int = 20000,
+        evidence_cache_threshold: Optional[float] = None,
+        watch_paper_dir: bool = False,
+        watch_interval: float = 30.0,
+        index_workers: Optional[int] = None,
+        embedding_batch_size: int = 32,
+        embedding_concurrency: int = 4,
+        use_embedding_store: bool = False,
+        embedding_store_dtype: str = "float16",
+        ivf_lists: Optional[int] = None,
+        library_retrieval: bool = False,
+        warm: bool = False,
+        instance: str = DEFAULT_INSTANCE,
     ) -> Dict[str, Any]:
         """
-        Initialize the PaperQA instance with the given settings.
+        Initialize a named PaperQA instance with the given settings.
+
+        If another name was initialized with the same settings, the instance
+        is shared with it.
 
         Args:
             paper_dir: Directory containing papers to analyze
@@ -74,257 +333,2260 @@ class PaperQAService:
             index_name: Custom name for the index
             api_key: API key for the specified provider (OpenAI, Anthropic, or Gemini)
             provider_type: Type of provider (openai, anthropic, or gemini)
+            use_answer_cache: Reuse answers to previously asked questions
+            answer_cache_ttl: Seconds after which cached answers expire
+            answer_cache_max_entries: Maximum number of cached answers
+            use_semantic_cache: Also reuse answers to paraphrased questions
+            semantic_cache_threshold: Minimum cosine similarity for a match
+            use_evidence_cache: Reuse summaries of the same chunks made for
+                earlier questions
+            evidence_cache_max_entries: Maximum number of cached summaries
+            evidence_cache_threshold: Minimum cosine similarity between two
+                questions for summaries to be reused, None for the same
+                question only
+            watch_paper_dir: Index the paper directory in the background now and
+                whenever its papers change
+            watch_interval: Seconds between checks of the paper directory
+            index_workers: Number of processes parsing papers when indexing,
+                defaults to the number of CPUs
+            embedding_batch_size: Chunks per embedding request when indexing
+            embedding_concurrency: Maximum number of embedding requests in flight
+                when indexing
+            use_embedding_store: Keep chunk embeddings in a memory-mapped store
+                and retrieve evidence from it
+            embedding_store_dtype: "float16" or "float32"
+            ivf_lists: Number of IVF lists of the embedding store, None to
+                partition large stores automatically, 0 to never partition
+            library_retrieval: Retrieve evidence from the chunks of the whole
+                library, not only of the papers found by the paper search
+            warm: Load the index and set up the model clients in the background,
+                now and after settings updates, see `warmup()`
+            instance: Name of the instance, used by later requests to select it
 
         Returns:
             Dict with status message
         """
         try:
-            # Create a new PaperQA instance
-            self.paperqa = PaperQA(
-                paper_dir=paper_dir,
-                llm=llm,
-                summary_llm=summary_llm,
-                agent_llm=agent_llm,
-                embedding=embedding,
-                temperature=temperature,
-                verbosity=verbosity,
-                evidence_k=evidence_k,
-                max_sources=max_sources,
-                chunk_size=chunk_size,
-                use_tier1_limits=use_tier1_limits,
-                rate_limit=rate_limit,
-                preset=preset,
-                index_name=index_name,
-                api_key=api_key,
-                provider_type=provider_type,
+            self._wait_for_api()
+            config = {
+                "paper_dir": paper_dir,
+                "llm": llm,
+                "summary_llm": summary_llm,
+                "agent_llm": agent_llm,
+                "embedding": embedding,
+                "temperature": temperature,
+                "verbosity": verbosity,
+                "evidence_k": evidence_k,
+                "max_sources": max_sources,
+                "chunk_size": chunk_size,
+                "use_tier1_limits": use_tier1_limits,
+                "rate_limit": rate_limit,
+                "preset": preset,
+                "index_name": index_name,
+                "api_key": api_key,
+                "provider_type": provider_type,
+                "use_answer_cache": use_answer_cache,
+                "answer_cache_ttl": answer_cache_ttl,
+                "answer_cache_max_entries": answer_cache_max_entries,
+                "use_semantic_cache": use_semantic_cache,
+                "semantic_cache_threshold": semantic_cache_threshold,
+                "use_evidence_cache": use_evidence_cache,
+                "evidence_cache_max_entries": evidence_cache_max_entries,
+                "evidence_cache_threshold": evidence_cache_threshold,
+                "index_workers": index_workers,
+                "embedding_batch_size": embedding_batch_size,
+                "embedding_concurrency": embedding_concurrency,
+                "use_embedding_store": use_embedding_store,
+                "embedding_store_dtype": embedding_store_dtype,
+                "ivf_lists": ivf_lists,
+                "library_retrieval": library_retrieval,
+            }
+            if watch_paper_dir and not self.index_owner:
+                logger.info(f"Not watching {paper_dir}, another process does")
+                watch_paper_dir = False
+            loaded = self._load(
+                instance,
+                config,
+                watch_interval=watch_interval if watch_paper_dir else None,
+                warm=warm,
             )
-            self.is_initialized = True
             logger.info(
-                f"PaperQA instance initialized with paper directory: {paper_dir}"
+                f"PaperQA instance {instance} initialized with paper directory:"
+                f" {paper_dir}"
             )
             return {
                 "status": "success",
                 "message": "PaperQA initialized successfully",
+                "instance": instance,
+                "shared_with": sorted(loaded.names - {instance}),
             }
         except Exception as e:
             logger.error(f"Error initializing PaperQA: {str(e)}")
             return {"status": "error", "message": str(e)}
 
-    def ask(self, question: str) -> Dict[str, Any]:
+    def _load(
+        self,
+        name: str,
+        config: Dict[str, Any],
+        watch_interval: Optional[float] = None,
+        warm: bool = False,
+        acquire: bool = False,
+    ) -> PaperQAInstance:
         """
-        Ask a question using the PaperQA instance.
+        Load an instance under a name, sharing a loaded one with the same config.
 
         Args:
-            question: The question to ask
+            name: Name of the instance
+            config: Arguments to create the PaperQA instance with
+            watch_interval: Seconds between checks of the paper directory, None
+                to not watch it
+            warm: Warm the instance up, now and after settings updates
+            acquire: Count the caller as a request using the instance
 
         Returns:
-            Dict with the answer and other information
+            The loaded instance
         """
-        if not self.is_initialized:
-            logger.error("PaperQA not initialized")
-            return {
-                "status": "error",
-                "message": "PaperQA not initialized. Call initialize() first.",
+        key = fingerprint(config)
+        with self._lock:
+            loaded = self._find(key)
+        # Creating PaperQA takes a while, don't hold up other requests meanwhile
+        paperqa = None if loaded else PaperQA(**config)
+
+        with self._lock:
+            loaded = self._find(key)
+            if loaded is None:
+                loaded, paperqa = PaperQAInstance(paperqa, config, key), None
+            previous = self.instances.get(name)
+            orphan = None
+            if previous is not loaded:
+                orphan = self._detach(name)
+                loaded.names.add(name)
+                self.instances[name] = loaded
+            self._configs[name] = {
+                "config": config,
+                "watch_interval": watch_interval,
+                "warm": warm,
             }
+            loaded.last_used = time.monotonic()
+            if acquire:
+                loaded.active += 1
+            if watch_interval != loaded.watch_interval:
+                self._watch(loaded, watch_interval)
+            if warm:
+                loaded.warm = True
+                if loaded.paperqa.warmup_status["state"] != "ready":
+                    self._warmup(loaded)
 
-        try:
-            logger.info(f"Asking question: {question}")
-            result = self.paperqa.ask(question)
-            return {"status": "success", **result}
-        except Exception as e:
-            logger.error(f"Error asking question: {str(e)}")
-            return {"status": "error", "message": str(e)}
+        if paperqa:
+            # Another request loaded the same configuration in the meantime
+            paperqa.close()
+        if orphan:
+            self._unload(orphan)
+        self._evict_idle(keep=loaded)
+        return loaded
 
-    def update_settings(self, **kwargs) -> Dict[str, Any]:
+    def _find(self, key: str) -> Optional[PaperQAInstance]:
+        """Find the loaded instance with a configuration fingerprint."""
+        return next((i for i in self.instances.values() if i.key == key), None)
+
+    def _loaded(self) -> List[PaperQAInstance]:
+        """Get the loaded instances, once each."""
+        with self._lock:
+            return list({id(i): i for i in self.instances.values()}.values())
+
+    def _detach(self, name: str) -> Optional[PaperQAInstance]:
         """
-        Update settings for the PaperQA instance.
+        Remove a name from its instance.
 
         Args:
-            **kwargs: Key-value pairs of settings to update
+            name: Name of the instance
 
         Returns:
-            Dict with status message
+            The instance if no other name uses it, to be unloaded
         """
-        if not self.is_initialized:
-            logger.error("PaperQA not initialized")
-            return {
-                "status": "error",
-                "message": "PaperQA not initialized. Call initialize() first.",
-            }
+        instance = self.instances.pop(name, None)
+        if instance is None:
+            return None
+        instance.names.discard(name)
+        return None if instance.names else instance
 
-        try:
-            logger.info(f"Updating settings: {kwargs}")
-            self.paperqa.update_settings(**kwargs)
-            return {
-                "status": "success",
-                "message": "Settings updated successfully",
-            }
-        except Exception as e:
-            logger.error(f"Error updating settings: {str(e)}")
-            return {"status": "error", "message": str(e)}
+    def _unload(self, instance: PaperQAInstance):
+        """
+        Stop the background work of an instance and release its resources.
 
-    def get_preset_names(self) -> Dict[str, Any]:
+        An instance still in use is closed once its requests and background
+        work are done.
         """
-        Get a list of available preset configuration names.
+        if instance.watcher:
+            instance.watcher.stop()
+            instance.watcher = None
+        with self._lock:
+            instance.unloaded = True
+            pending = [
+                future
+                for future in (instance.index_future, instance.warmup_future)
+                if future is not None and not future.done()
+            ]
+        if not self._close_unloaded(instance):
+            # Questions in flight may still use it, only stop the indexing
+            # worker processes until then
+            instance.paperqa.indexer.close()
+            for future in pending:
+                future.add_done_callback(lambda _: self._close_unloaded(instance))
+        gc.collect()
+
+    def _close_unloaded(self, instance: PaperQAInstance) -> bool:
+        """
+        Close an unloaded instance if nothing uses it anymore.
+
+        Args:
+            instance: The instance
 
         Returns:
-            Dict with list of preset names
+            True if the instance is closed
         """
-        try:
-            presets = PaperQA.get_preset_names()
-            return {"status": "success", "presets": presets}
-        except Exception as e:
-            logger.error(f"Error getting preset names: {str(e)}")
-            return {"status": "error", "message": str(e)}
+        with self._lock:
+            if instance.closed:
+                return True
+            if not instance.unloaded or not instance.is_idle():
+                return False
+            instance.closed = True
+        instance.paperqa.close()
+        return True
 
-    def get_status(self) -> Dict[str, Any]:
+    def _evict_idle(self, keep: PaperQAInstance):
         """
-        Get the current status of the PaperQA service.
+        Unload idle instances, least recently used first, while over the limits.
+
+        Args:
+            keep: Instance that was just used, which stays loaded
+        """
+        while True:
+            with self._lock:
+                loaded = self._loaded()
+                rss = None
+                if len(loaded) > self.max_instances:
+                    reason = f"more than {self.max_instances} instances loaded"
+                else:
+                    rss = self._over_memory_budget()
+                    if rss is None:
+                        return
+                    reason = f"over the memory budget of {self.memory_budget_mb} MB"
+                idle = [i for i in loaded if i is not keep and i.is_idle()]
+                if not idle:
+                    logger.warning(f"Can't unload any instance ({reason}), all in use")
+                    return
+                victim = min(idle, key=lambda i: i.last_used)
+                for name in victim.names:
+                    del self.instances[name]
+            names = ", ".join(sorted(victim.names))
+            logger.info(f"Unloading instance {names}: {reason}")
+            self._unload(victim)
+            if rss is not None:
+                freed = rss - (memory_usage() or rss)
+                if freed < MIN_FREED_BYTES:
+                    self._memory_floor = rss - freed
+                    logger.info(
+                        f"Unloading instance {names} freed {freed / 2**20:.1f} MB,"
+                        " not unloading more instances for the memory budget"
+                    )
+                    return
+                self._memory_floor = None
+
+    def _over_memory_budget(self) -> Optional[int]:
+        """
+        Check whether unloading instances may bring the process under budget.
 
         Returns:
-            Dict with status information
+            Resident memory of the process in bytes if it is over the budget
+            and has grown since unloading last freed nothing, None otherwise
         """
-        api_key_configured = False
+        if self.memory_budget_mb is None:
+            return None
+        rss = memory_usage()
+        if rss is None:
+            return None
+        if rss / 2**20 <= self.memory_budget_mb:
+            self._memory_floor = None
+            return None
+        if (
+            self._memory_floor is not None
+            and rss < self._memory_floor + MIN_FREED_BYTES
+        ):
+            return None
+        return rss
 
-        if not self.is_initialized:
-            # Check if any API key is in environment even if not initialized
-            # Default to checking OpenAI key for backward compatibility
-            api_key_configured = bool(os.environ.get("OPENAI_API_KEY"))
+    @contextlib.contextmanager
+    def _using(self, name: Optional[str]):
+        """
+        Use a named instance for the duration of a request.
+
+        An unloaded instance is loaded again, and the instance isn't unloaded
+        before the request is done.
+
+        Args:
+            name: Name of the instance, None for DEFAULT_INSTANCE
+
+        Yields:
+            The instance, or None if no instance was initialized under that name
+        """
+        name = name or DEFAULT_INSTANCE
+        with self._lock:
+            loaded = self.instances.get(name)
+            if loaded:
+                loaded.active += 1
+            saved = None if loaded else self._configs.get(name)
+        if saved:
+            logger.info(f"Loading unloaded instance {name}")
+            loaded = self._load(name, **saved, acquire=True)
+        try:
+            yield loaded
+        finally:
+            if loaded:
+                with self._lock:
+                    loaded.active -= 1
+                    loaded.last_used = time.monotonic()
+                # Close the instance if it was unloaded during the request
+                self._close_unloaded(loaded)
+
+    def _hold(self, instance: PaperQAInstance, future: concurrent.futures.Future):
+        """
+        Count background work as a request using an instance until it is done.
+
+        Args:
+            instance: The instance the work uses
+            future: Future of the work
+        """
+        with self._lock:
+            instance.active += 1
+
+        def release(_):
+            with self._lock:
+                instance.active -= 1
+                instance.last_used = time.monotonic()
+            self._close_unloaded(instance)
+
+        future.add_done_callback(release)
+
+    @staticmethod
+    def _not_initialized(name: Optional[str]) -> Dict[str, Any]:
+        """Error returned for requests to an instance that wasn't initialized."""
+        if not name or name == DEFAULT_INSTANCE:
+            logger.error("PaperQA not initialized")
             return {
-                "status": "not_initialized",
+                "status": "error",
                 "message": "PaperQA not initialized. Call initialize() first.",
-                "api_key_configured": api_key_configured,
             }
-
-        api_key_configured = self.paperqa.is_api_key_configured()
+        logger.error(f"PaperQA instance {name} not initialized")
         return {
-            "status": "initialized",
-            "paper_dir": self.paperqa.paper_dir,
-            "llm": self.paperqa.llm,
-            "embedding": self.paperqa.embedding,
-            "preset": self.paperqa.preset or "none",
-            "provider_type": self.paperqa.provider_type,
-            "api_key_configured": api_key_configured,
+            "status": "error",
+            "message": f"PaperQA instance {name!r} not initialized."
+            " Call initialize() first.",
         }
 
+    def ask(
+        self,
+        question: str,
+        request_id: Optional[str] = None,
+        on_event: Optional["EventCallback"] = None,
+        instance: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Ask a question using a PaperQA instance.
 
-class PaperQAServer:
-    """
-    ZMQ-based server for PaperQA.
-    """
+        The question runs on the service's shared event loop; the calling
+        thread blocks until it is answered, cancelled or past its deadline.
+
+        Args:
+            question: The question to ask
+            request_id: Optional id under which the request can be cancelled
+            on_event: Optional callback receiving progress events
+            instance: Name of the instance, None for the default instance
+            timeout: Seconds after which to stop and return the evidence
+                gathered so far, with status "timeout", None for no limit
+
+        Returns:
+            Dict with the answer and other information
+        """
+        deadline = self._deadline(timeout)
+        # Load the instance here rather than on the event loop
+        with self._using(instance):
+            return self._run(
+                self.aask(
+                    question, on_event=on_event, instance=instance, deadline=deadline
+                ),
+                request_id,
+                deadline,
+            )
+
+    @staticmethod
+    def _deadline(timeout: Optional[float]) -> Optional[float]:
+        """Convert a timeout in seconds to a `time.monotonic()` deadline."""
+        return time.monotonic() + timeout if timeout is not None else None
 
-    def __init__(self, host="*", port=5555):
+    def _run(
+        self,
+        coro,
+        request_id: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Dict[str, Any]:
         """
-        Initialize the server.
+        Run a request on the shared event loop and wait for its result.
+
+        The request is expected to stop by itself at its deadline. If it is
+        still running DEADLINE_GRACE seconds later, it is cancelled.
 
         Args:
-            host: Host to bind to (default: "*" - all interfaces)
-            port: Port to bind to (default: 5555)
+            coro: Coroutine answering the request
+            request_id: Optional id under which the request can be cancelled
+            deadline: Optional `time.monotonic()` deadline of the request
+
+        Returns:
+            Dict with the result of the request
         """
-        self.host = host
-        self.port = port
-        self.running = False
-        self.thread = None
-        self.service = PaperQAService()
-        self.socket = None
-        self.context = None
+        with self._inflight_lock:
+            if request_id and self._cancelled.pop(request_id, None) is not None:
+                coro.close()
+                logger.info(f"Request {request_id} was cancelled before it started")
+                return {"status": "cancelled", "message": "Request was cancelled"}
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+            if request_id:
+                self._inflight[request_id] = future
+        wait = None
+        if deadline is not None:
+            wait = max(deadline - time.monotonic(), 0.0) + DEADLINE_GRACE
+        try:
+            return future.result(timeout=wait)
+        except concurrent.futures.CancelledError:
+            logger.info(f"Request {request_id} was cancelled")
+            return {"status": "cancelled", "message": "Request was cancelled"}
+        except concurrent.futures.TimeoutError:
+            logger.warning(f"Request {request_id} overran its deadline, cancelling it")
+            future.cancel()
+            return {
+                "status": "timeout",
+                "message": "Request did not finish before its deadline",
+            }
+        finally:
+            if request_id:
+                with self._inflight_lock:
+                    self._inflight.pop(request_id, None)
 
-        # Set up signal handling
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+    async def aask(
+        self,
+        question: str,
+        on_event: Optional["EventCallback"] = None,
+        instance: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Ask a question using a PaperQA instance, asynchronously.
 
-        # Register cleanup function to run on exit
-        atexit.register(self.cleanup)
+        Args:
+            question: The question to ask
+            on_event: Optional callback receiving progress events
+            instance: Name of the instance, None for the default instance
+            deadline: Optional `time.monotonic()` time at which to stop and
+                return the evidence gathered so far
 
-        # Log the process ID for debugging
-        logger.info(f"Server starting with PID: {os.getpid()}")
+        Returns:
+            Dict with the answer and other information
+        """
+        with self._using(instance) as loaded:
+            if loaded is None:
+                return self._not_initialized(instance)
 
-    def cleanup(self):
-        """Clean up resources when the process exits."""
-        logger.info("Cleaning up server resources...")
-        self.running = False
-        if self.socket:
             try:
-                self.socket.close()
+                logger.info(f"Asking question: {question}")
+                result = await loaded.paperqa.aask(
+                    question, on_event=on_event, deadline=deadline
+                )
+                result = {"status": "success", **result}
             except Exception as e:
-                logger.error(f"Error closing socket: {e}")
+                logger.error(f"Error asking question: {str(e)}")
+                return {"status": "error", "message": str(e)}
+            self._record(result, instance, loaded.paperqa.paper_dir)
+            return result
+
+    def ask_batch(
+        self,
+        questions: List[str],
+        concurrency: Optional[int] = None,
+        request_id: Optional[str] = None,
+        on_event: Optional["EventCallback"] = None,
+        instance: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Ask many questions using a PaperQA instance.
+
+        Args:
+            questions: The questions to ask
+            concurrency: Maximum number of questions answered at the same time
+            request_id: Optional id under which the batch can be cancelled
+            on_event: Optional callback receiving the progress events of all
+                questions, tagged with the `index` of their question
+            instance: Name of the instance, None for the default instance
+            timeout: Seconds after which to stop all questions, those not
+                answered yet get status "timeout" and their evidence so far
+
+        Returns:
+            Dict with the results in the order of the questions and the timing
+        """
+        deadline = self._deadline(timeout)
+        with self._using(instance):
+            return self._run(
+                self.aask_batch(
+                    questions,
+                    concurrency=concurrency,
+                    on_event=on_event,
+                    instance=instance,
+                    deadline=deadline,
+                ),
+                request_id,
+                deadline,
+            )
+
+    async def aask_batch(
+        self,
+        questions: List[str],
+        concurrency: Optional[int] = None,
+        on_event: Optional["EventCallback"] = None,
+        instance: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Ask many questions using a PaperQA instance, asynchronously.
+
+        Args:
+            questions: The questions to ask
+            concurrency: Maximum number of questions answered at the same time
+            on_event: Optional callback receiving progress events
+            instance: Name of the instance, None for the default instance
+            deadline: Optional `time.monotonic()` time at which to stop all
+                questions
+
+        Returns:
+            Dict with the results in the order of the questions and the timing
+        """
+        with self._using(instance) as loaded:
+            if loaded is None:
+                return self._not_initialized(instance)
+            if not questions:
+                return {"status": "error", "message": "No questions to ask"}
+            if concurrency is not None and (
+                not isinstance(concurrency, int) or concurrency < 1
+            ):
+                return {
+                    "status": "error",
+                    "message": "concurrency must be a positive integer, got"
+                    f" {concurrency!r}",
+                }
 
-        if self.context:
             try:
-                self.context.term()
+                logger.info(f"Asking {len(questions)} questions")
+                kwargs = {"concurrency": concurrency} if concurrency is not None else {}
+                result = await loaded.paperqa.aask_batch(
+                    questions, on_event=on_event, deadline=deadline, **kwargs
+                )
             except Exception as e:
-                logger.error(f"Error terminating ZMQ context: {e}")
+                logger.error(f"Error asking questions: {str(e)}")
+                return {"status": "error", "message": str(e)}
+            for answer in result["results"]:
+                self._record(answer, instance, loaded.paperqa.paper_dir)
+            return {"status": "success", **result}
 
-        logger.info("Server cleanup complete")
+    def _record(self, result: Dict[str, Any], instance: Optional[str], paper_dir: str):
+        """
+        Add an answer to the history and set its `history_id`.
 
-    def signal_handler(self, sig, frame):
-        """Handle signals to gracefully shut down the server."""
-        signal_name = "SIGTERM" if sig == signal.SIGTERM else "SIGINT"
-        logger.info(f"Received {signal_name} signal, stopping server...")
-        self.running = False
-        if self.thread and self.thread.is_alive():
-            self.thread.join(timeout=5.0)
-        sys.exit(0)
+        Args:
+            result: Result of the question, errors aren't recorded
+            instance: Name of the instance that answered
+            paper_dir: Directory the answer was generated from
+        """
+        if self.history is None:
+            return
+        try:
+            history_id = self.history.add(
+                result, instance or DEFAULT_INSTANCE, paper_dir
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Error recording the answer in the history: {str(e)}")
+            return
+        if history_id is not None:
+            result["history_id"] = history_id
 
-    def handle_request(self, socket):
+    def prefetch(
+        self,
+        question: str,
+        gather_evidence: bool = False,
+        wait: bool = False,
+        instance: Optional[str] = None,
+    ) -> Dict[str, Any]:
         """
-        Handle a single request from a client.
+        Start retrieving evidence for a question the user is still typing.
+
+        Runs in the background, asking the question shortly after starts
+        from the results. Prefetches of earlier versions of the question are
+        cancelled, see `PaperQA.aprefetch`.
 
         Args:
-            socket: ZMQ socket to receive from and send to
+            question: The question as typed so far
+            gather_evidence: Also summarize the most relevant chunks
+            wait: Block until the prefetch is done and return its summary
+            instance: Name of the instance, None for the default instance
+
+        Returns:
+            Dict with status message, or the prefetch summary if waiting
         """
+        with self._using(instance) as loaded:
+            if loaded is None:
+                return self._not_initialized(instance)
+
+            future = asyncio.run_coroutine_threadsafe(
+                self._aprefetch(loaded.paperqa, question, gather_evidence), self.loop
+            )
+            if wait:
+                try:
+                    return future.result()
+                except concurrent.futures.CancelledError:
+                    return {"status": "cancelled", "message": "Prefetch was cancelled"}
+            # Keep the instance loaded while the prefetch runs in the background
+            self._hold(loaded, future)
+            return {"status": "success", "message": "Prefetch started"}
+
+    async def _aprefetch(
+        self, paperqa: "PaperQA", question: str, gather_evidence: bool
+    ) -> Dict[str, Any]:
+        """Prefetch a question with a PaperQA instance."""
         try:
-            # Receive request
-            request_data = socket.recv_json()
+            return await paperqa.aprefetch(question, gather_evidence=gather_evidence)
+        except Exception as e:
+            logger.error(f"Error prefetching {question!r}: {str(e)}")
+            return {"status": "error", "message": str(e)}
 
-            # Extract method and params
-            method = request_data.get("method")
-            params = request_data.get("params", {})
-
-            logger.debug(f"Received request: {method} with params: {params}")
-
-            # Call the appropriate method
-            if method == "initialize":
-                result = self.service.initialize(**params)
-            elif method == "ask":
-                question = params.get("question", "")
-                result = self.service.ask(question)
-            elif method == "update_settings":
-                result = self.service.update_settings(**params)
-            elif method == "get_preset_names":
-                result = self.service.get_preset_names()
-            elif method == "get_status":
-                result = self.service.get_status()
-            else:
-                result = {
-                    "status": "error",
-                    "message": f"Unknown method: {method}",
-                }
+    def cancel(self, request_id: str) -> Dict[str, Any]:
+        """
+        Cancel an in-flight request.
 
-            # Send response
-            socket.send_json(result)
+        The agent run of the request is stopped and the worker serving it
+        answers with status "cancelled". A request that hasn't started yet,
+        e.g. because all workers are busy, is cancelled when it starts.
 
-        except Exception as e:
-            logger.error(f"Error handling request: {str(e)}")
-            # Send error response
-            socket.send_json({"status": "error", "message": f"Server error: {str(e)}"})
+        Args:
+            request_id: Id the request was submitted with
 
-    def run(self):
-        """Run the server in a loop."""
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
+        Returns:
+            Dict with status message
+        """
+        if not request_id:
+            return {"status": "error", "message": "No request_id to cancel"}
+        now = time.monotonic()
+        with self._inflight_lock:
+            future = self._inflight.get(request_id)
+            if future is None:
+                self._cancelled = {
+                    rid: at
+                    for rid, at in self._cancelled.items()
+                    if now - at < CANCELLED_TTL
+                }
+                self._cancelled[request_id] = now
+                logger.info(f"Request {request_id} will be cancelled when it starts")
+                return {
+                    "status": "success",
+                    "message": f"Request {request_id} not running,"
+                    " it will be cancelled if it starts",
+                }
+        if not future.cancel():
+            return {
+                "status": "error",
+                "message": f"Request {request_id} already finished",
+            }
+        logger.info(f"Cancelling request {request_id}")
+        return {"status": "success", "message": f"Request {request_id} cancelled"}
 
-        endpoint = f"tcp://{self.host}:{self.port}"
-        self.socket.bind(endpoint)
+    def index(
+        self, rebuild: bool = False, wait: bool = False, instance: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Bring the index of the paper directory up to date in the background.
 
-        logger.info(f"PaperQA ZMQ server started on {endpoint}")
+        Only papers added, changed or removed since the last update are
+        processed. Questions keep using the current index meanwhile.
+
+        Args:
+            rebuild: Drop the index and build it from scratch
+            wait: Block until indexing is done and return its result
+            instance: Name of the instance, None for the default instance
+
+        Returns:
+            Dict with status message, or the indexing result if waiting
+        """
+        with self._using(instance) as loaded:
+            if loaded is None:
+                return self._not_initialized(instance)
+
+            future, message = self._index(loaded, rebuild)
+            if wait:
+                return future.result()
+            return {
+                "status": "success",
+                "message": message,
+                "index": loaded.paperqa.indexer.status(),
+            }
+
+    def _index(
+        self, instance: PaperQAInstance, rebuild: bool = False
+    ) -> Tuple[concurrent.futures.Future, str]:
+        """
+        Start indexing the paper directory of an instance, unless it already is.
+
+        Args:
+            instance: Instance to index the paper directory of
+            rebuild: Drop the index and build it from scratch
+
+        Returns:
+            Future of the indexing result, and a status message
+        """
+        with self._lock:
+            future = instance.index_future
+            if future and not future.done():
+                return future, "Indexing already in progress"
+            future = asyncio.run_coroutine_threadsafe(
+                self._aindex(instance.paperqa, rebuild), self.loop
+            )
+            instance.index_future = future
+            return future, "Rebuilding index" if rebuild else "Indexing started"
+
+    def reindex(
+        self, wait: bool = False, instance: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Rebuild the index of the paper directory from scratch in the background.
+
+        Args:
+            wait: Block until indexing is done and return its result
+            instance: Name of the instance, None for the default instance
+
+        Returns:
+            Dict with status message, or the indexing result if waiting
+        """
+        return self.index(rebuild=True, wait=wait, instance=instance)
+
+    def warmup(
+        self, wait: bool = False, instance: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Load what the first question needs in the background.
+
+        Builds the index if it doesn't exist yet, loads it, and makes an
+        embedding request so that the model client is set up. `get_status()`
+        reports `ready` once done, with the time spent per step.
+
+        Args:
+            wait: Block until the warm-up is done and return its result
+            instance: Name of the instance, None for the default instance
+
+        Returns:
+            Dict with status message, or the warm-up result if waiting
+        """
+        with self._using(instance) as loaded:
+            if loaded is None:
+                return self._not_initialized(instance)
+
+            future, message = self._warmup(loaded)
+            if wait:
+                return future.result()
+            return {"status": "success", "message": message}
+
+    def _warmup(
+        self, instance: PaperQAInstance
+    ) -> Tuple[concurrent.futures.Future, str]:
+        """
+        Start warming an instance up, unless it already is.
+
+        Args:
+            instance: Instance to warm up
+
+        Returns:
+            Future of the warm-up result, and a status message
+        """
+        with self._lock:
+            future = instance.warmup_future
+            if future and not future.done():
+                return future, "Warm-up already in progress"
+            future = asyncio.run_coroutine_threadsafe(
+                self._awarmup(instance.paperqa), self.loop
+            )
+            instance.warmup_future = future
+            return future, "Warm-up started"
+
+    async def _awarmup(self, paperqa: "PaperQA") -> Dict[str, Any]:
+        """Warm a PaperQA instance up."""
+        try:
+            timings = await paperqa.awarmup(build_index=self.index_owner)
+            logger.info(f"Warm-up finished: {timings}")
+            return {"status": "success", "timings": timings}
+        except Exception as e:
+            logger.error(f"Error warming up: {str(e)}")
+            return {"status": "error", "message": str(e)}
+
+    def _watch(self, instance: PaperQAInstance, interval: Optional[float]):
+        """
+        (Re)start watching the paper directory of an instance, and index it now.
+
+        Args:
+            instance: Instance to watch the paper directory of
+            interval: Seconds between checks, None to stop watching
+        """
+        if instance.watcher:
+            instance.watcher.stop()
+            instance.watcher = None
+        instance.watch_interval = interval
+        if interval is None:
+            return
+        instance.watcher = PaperDirectoryWatcher(
+            instance.paperqa.paper_dir,
+            on_change=functools.partial(self._index, instance),
+            interval=interval,
+            recurse=instance.paperqa.settings.agent.index.recurse_subdirectories,
+        )
+        instance.watcher.start()
+        self._index(instance)
+
+    async def _aindex(self, paperqa: "PaperQA", rebuild: bool) -> Dict[str, Any]:
+        """Index the paper directory of a PaperQA instance."""
+        try:
+            result = await paperqa.aindex(rebuild=rebuild)
+            logger.info(f"Indexing {paperqa.paper_dir} finished: {result}")
+            return {"status": "success", **result}
+        except Exception as e:
+            logger.error(f"Error indexing papers: {str(e)}")
+            return {"status": "error", "message": str(e)}
+
+    def update_settings(
+        self, instance: Optional[str] = None, **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Update settings for a PaperQA instance.
+
+        If the instance is shared with other names, it is copied first, so
+        that they keep their settings.
+
+        Args:
+            instance: Name of the instance, None for the default instance
+            **kwargs: Key-value pairs of settings to update
+
+        Returns:
+            Dict with status message
+        """
+        name = instance or DEFAULT_INSTANCE
+        with self._using(name) as loaded:
+            if loaded is None:
+                return self._not_initialized(instance)
+
+            try:
+                logger.info(f"Updating settings: {kwargs}")
+                with self._lock:
+                    saved = self._configs[name]
+                    config = {**saved["config"], **kwargs}
+                    shared = len(loaded.names) > 1
+                    if shared:
+                        saved["config"] = config
+                    else:
+                        # Names initialized with the old settings no longer
+                        # share the instance
+                        loaded.config, loaded.key = config, fingerprint(config)
+                if shared:
+                    self._load(name, **saved)
+                    return {
+                        "status": "success",
+                        "message": "Settings updated successfully",
+                    }
+
+                # Rebuilding the indexer and caches takes a while, only hold up
+                # other updates of this instance meanwhile
+                with loaded.update_lock:
+                    # Answer-only settings keep the index and model clients loaded
+                    if loaded.paperqa.update_settings(**kwargs):
+                        if loaded.watcher:
+                            # The paper directory or the index may have changed
+                            self._watch(loaded, loaded.watch_interval)
+                        if loaded.warm:
+                            self._warmup(loaded)
+                with self._lock:
+                    saved["config"] = config
+                return {
+                    "status": "success",
+                    "message": "Settings updated successfully",
+                }
+            except Exception as e:
+                logger.error(f"Error updating settings: {str(e)}")
+                return {"status": "error", "message": str(e)}
+
+    def get_preset_names(self) -> Dict[str, Any]:
+        """
+        Get a list of available preset configuration names.
+
+        Returns:
+            Dict with list of preset names
+        """
+        try:
+            presets = list(PRESET_NAMES)
+            return {"status": "success", "presets": presets}
+        except Exception as e:
+            logger.error(f"Error getting preset names: {str(e)}")
+            return {"status": "error", "message": str(e)}
+
+    def get_metrics(
+        self, format: Literal["json", "prometheus"] = "json", reset: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Get the latency, LLM usage and cost metrics of the service.
+
+        Histograms hold per-stage timings, the time requests waited for a
+        worker and per-question LLM calls, tokens and cost, with percentiles
+        over their most recent observations. Counters hold the LLM calls,
+        tokens and cost by model. The state of the LLM rate limiters is
+        returned under "rate_limits".
+
+        Args:
+            format: "json" for a dict of histograms and counters, "prometheus"
+                for the Prometheus text format
+            reset: Drop the metrics after reading them
+
+        Returns:
+            Dict with the metrics, or their Prometheus text under "prometheus"
+        """
+        try:
+            if format == "prometheus":
+                result = {"status": "success", "prometheus": METRICS.prometheus()}
+            else:
+                result = {"status": "success", "metrics": METRICS.snapshot()}
+            result["rate_limits"] = LLM_SCHEDULER.status()
+            if reset:
+                METRICS.reset()
+            return result
+        except Exception as e:
+            logger.error(f"Error getting metrics: {str(e)}")
+            return {"status": "error", "message": str(e)}
+
+    def list_history(
+        self,
+        offset: int = 0,
+        limit: int = DEFAULT_PAGE_SIZE,
+        paper: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        List past answers, newest first.
+
+        Args:
+            offset: Number of answers to skip
+            limit: Maximum number of answers to return, at most MAX_PAGE_SIZE
+            paper: Only answers with contexts from this paper, by document or
+                text name
+
+        Returns:
+            Dict with the page of answers (without their contexts) and the
+            total number of matching answers
+        """
+        return self._history_page(
+            lambda offset, limit: self.history.recent(offset, limit, paper=paper),
+            offset,
+            limit,
+        )
+
+    def search_history(
+        self,
+        query: str,
+        offset: int = 0,
+        limit: int = DEFAULT_PAGE_SIZE,
+        paper: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Search the questions and answers of past answers, best matches first.
+
+        Args:
+            query: Words to look for, the last one can be incomplete
+            offset: Number of answers to skip
+            limit: Maximum number of answers to return, at most MAX_PAGE_SIZE
+            paper: Only answers with contexts from this paper, by document or
+                text name
+
+        Returns:
+            Dict with the page of answers, each with a `snippet` of the
+            matching text, and the total number of matching answers
+        """
+        return self._history_page(
+            lambda offset, limit: self.history.search(
+                query, offset, limit, paper=paper
+            ),
+            offset,
+            limit,
+        )
+
+    def _history_page(
+        self,
+        fetch: Callable[[int, int], Tuple[List[Dict[str, Any]], int]],
+        offset: int,
+        limit: int,
+    ) -> Dict[str, Any]:
+        """Get a page of the history with `fetch(offset, limit)`."""
+        if self.history is None:
+            return self._history_unavailable()
+        offset = max(int(offset), 0)
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        try:
+            entries, total = fetch(offset, limit)
+        except sqlite3.Error as e:
+            logger.error(f"Error reading the answer history: {str(e)}")
+            return {"status": "error", "message": str(e)}
+        return {
+            "status": "success",
+            "entries": entries,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+        }
+
+    def get_answer(self, history_id: int) -> Dict[str, Any]:
+        """
+        Get a past answer with its references and contexts.
+
+        Args:
+            history_id: Id of the answer, see `list_history`
+
+        Returns:
+            Dict with the answer as it was returned by `ask`
+        """
+        if self.history is None:
+            return self._history_unavailable()
+        try:
+            result = self.history.get(int(history_id))
+        except sqlite3.Error as e:
+            logger.error(f"Error reading the answer history: {str(e)}")
+            return {"status": "error", "message": str(e)}
+        if result is None:
+            return {
+                "status": "error",
+                "message": f"No answer with id {history_id} in the history",
+            }
+        return result
+
+    @staticmethod
+    def _history_unavailable() -> Dict[str, Any]:
+        """Error returned for history requests when the history couldn't be opened."""
+        return {"status": "error", "message": "The answer history is unavailable"}
+
+    def get_status(self, instance: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Get the current status of the PaperQA service.
+
+        Args:
+            instance: Name of the instance, None for the default instance
+
+        Returns:
+            Dict with status information
+        """
+        name = instance or DEFAULT_INSTANCE
+        with self._lock:
+            loaded = self.instances.get(name)
+            saved = self._configs.get(name)
+            service = {
+                "instances": self._instances_status(),
+                "history": self.history.stats() if self.history else None,
+                **self._memory_status(),
+            }
+
+        if saved is None:
+            # Check if any API key is in environment even if not initialized
+            # Default to checking OpenAI key for backward compatibility
+            api_key_configured = bool(os.environ.get("OPENAI_API_KEY"))
+            return {
+                "status": "not_initialized",
+                "message": "PaperQA not initialized. Call initialize() first.",
+                "api_key_configured": api_key_configured,
+                "paperqa_loaded": self._api_loaded.is_set() and not self._api_error,
+                "paperqa_error": self._api_error,
+                **service,
+            }
+
+        if loaded is None:
+            config = saved["config"]
+            return {
+                "status": "initialized",
+                "instance": name,
+                "loaded": False,
+                "ready": False,
+                "paper_dir": config["paper_dir"],
+                "llm": config["llm"],
+                "embedding": config["embedding"],
+                "preset": config["preset"] or "none",
+                "provider_type": config["provider_type"],
+                **service,
+            }
+
+        paperqa = loaded.paperqa
+        api_key_configured = paperqa.is_api_key_configured()
+        warmup = paperqa.warmup_status
+        return {
+            "status": "initialized",
+            "instance": name,
+            "loaded": True,
+            "shared_with": sorted(loaded.names - {name}),
+            "ready": warmup["state"] == "ready",
+            "warmup": warmup,
+            "paper_dir": paperqa.paper_dir,
+            "llm": paperqa.llm,
+            "embedding": paperqa.embedding,
+            "preset": paperqa.preset or "none",
+            "provider_type": paperqa.provider_type,
+            "api_key_configured": api_key_configured,
+            "answer_cache": (
+                paperqa.answer_cache.stats() if paperqa.answer_cache else None
+            ),
+            "semantic_cache": (
+                paperqa.semantic_cache.stats() if paperqa.semantic_cache else None
+            ),
+            "evidence_cache": (
+                paperqa.evidence_cache.stats() if paperqa.evidence_cache else None
+            ),
+            "prefetch": paperqa.prefetches.stats(),
+            "index": paperqa.indexer.status(),
+            **service,
+        }
+
+    def _instances_status(self) -> List[Dict[str, Any]]:
+        """Summarize every initialized instance, loaded or not."""
+        now = time.monotonic()
+        summary = []
+        for name, saved in sorted(self._configs.items()):
+            loaded = self.instances.get(name)
+            summary.append(
+                {
+                    "instance": name,
+                    "paper_dir": saved["config"]["paper_dir"],
+                    "loaded": loaded is not None,
+                    "active": loaded.active if loaded else 0,
+                    "idle_seconds": (
+                        round(now - loaded.last_used, 1) if loaded else None
+                    ),
+                }
+            )
+        return summary
+
+    def _memory_status(self) -> Dict[str, Any]:
+        """Report the memory used by the process and the limits of the service."""
+        rss = memory_usage()
+        return {
+            "memory_mb": round(rss / 2**20, 1) if rss is not None else None,
+            "memory_budget_mb": self.memory_budget_mb,
+            "max_instances": self.max_instances,
+        }
+
+
+class PaperQAServer:
+    """
+    ZMQ-based server for PaperQA.
+
+    Clients connect to a ROUTER socket. Cheap control methods are answered
+    directly by the broker loop, everything else is queued by a
+    `RequestScheduler` and handed to idle workers of a pool of worker threads,
+    so that several slow requests (e.g. ``ask``) can be processed at the same
+    time. Workers connect to a second ROUTER socket and ask for work by
+    sending WORKER_READY, or the reply to their previous request.
+
+    Progress events of streaming requests are published on an XPUB socket,
+    using the request id as topic. When the last subscriber of a streaming
+    request goes away, the request is cancelled.
+
+    With `processes` set, the server runs in supervisor mode: the workers are
+    threads of worker processes managed by a `WorkerSupervisor`, each with
+    its own PaperQA service, and the server process only routes requests.
+    Configuration requests and `warmup` go to every process over a control
+    socket, the control methods to one or all of them. Requests of a process
+    that exits are retried on the others.
+    """
+
+    # Methods answered directly by the broker loop, even while workers are busy
+    INLINE_METHODS = {
+        "get_status",
+        "get_preset_names",
+        "get_metrics",
+        "cancel",
+        "list_history",
+        "search_history",
+        "get_answer",
+        "start_profiling",
+        "stop_profiling",
+    }
+
+    WORKERS_ENDPOINT = "inproc://paperqa-workers"
+    EVENTS_ENDPOINT = "inproc://paperqa-events"
+
+    # First message of a worker, telling the broker it can take a request
+    WORKER_READY = b"READY"
+
+    def __init__(
+        self,
+        host="*",
+        port=5555,
+        workers=4,
+        events_port=None,
+        max_instances=4,
+        memory_budget_mb=None,
+        request_timeout=None,
+        max_queue=DEFAULT_MAX_QUEUE,
+        interactive_workers=1,
+        processes=0,
+        max_worker_rss_mb=None,
+    ):
+        """
+        Initialize the server.
+
+        Args:
+            host: Host to bind to (default: "*" - all interfaces)
+            port: Port to bind to (default: 5555)
+            workers: Number of worker threads handling requests (default: 4)
+            events_port: Port to publish streaming events on (default: port + 1)
+            max_instances: Maximum number of PaperQA instances kept loaded
+                (default: 4)
+            memory_budget_mb: Memory above which idle PaperQA instances are
+                unloaded (default: None - no limit)
+            request_timeout: Seconds after which questions return the evidence
+                gathered so far, for requests without a "timeout" param
+                (default: None - no limit)
+            max_queue: Maximum number of requests waiting for a worker per
+                priority class, more are rejected (default: 256)
+            interactive_workers: Workers kept free of batch requests
+                (default: 1)
+            processes: Number of worker processes, each running `workers`
+                worker threads, 0 to serve requests from threads of the
+                server process (default: 0)
+            max_worker_rss_mb: Memory above which a worker process is
+                replaced by a fresh one (default: None - no limit)
+        """
+        if workers < 1:
+            raise ValueError("The server needs at least one worker")
+
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.events_port = events_port or port + 1
+        self.request_timeout = request_timeout
+        self.running = False
+        self.thread = None
+        self.worker_threads = []
+        self.service = None
+        self.supervisor = None
+        if processes:
+            self.supervisor = WorkerSupervisor(
+                processes,
+                {
+                    "workers": workers,
+                    "max_instances": max_instances,
+                    "memory_budget_mb": memory_budget_mb,
+                    "request_timeout": request_timeout,
+                },
+                max_rss_mb=max_worker_rss_mb,
+            )
+        else:
+            self.service = PaperQAService(
+                max_instances=max_instances, memory_budget_mb=memory_budget_mb
+            )
+        # Profiles of requests and of the whole process, questions are
+        # answered on the service's event loop
+        self.profiler = Profiler(self.service.loop if self.service else None)
+        self.scheduler = RequestScheduler(
+            workers * max(processes, 1),
+            max_queue=max_queue,
+            interactive_workers=interactive_workers,
+        )
+        # Workers waiting for a request, and the request each busy worker
+        # is serving with its start time, by worker routing id
+        self._idle_workers = collections.deque()
+        self._assigned: Dict[bytes, Tuple[QueuedRequest, float]] = {}
+        self.socket = None
+        self.backend = None
+        self.events = None
+        self.events_sink = None
+        self.control = None
+        self.context = None
+
+        # Supervisor mode: requests waiting for the replies of worker
+        # processes by call id, broadcasts waiting for a process to start,
+        # and ids cancelled before their request arrived
+        self._control_calls: Dict[bytes, ControlCall] = {}
+        self._call_ids = itertools.count(1)
+        self._deferred: List[Tuple[List[bytes], Dict[str, Any], ResponseFormat]] = []
+        self._cancelled: Dict[str, float] = {}
+
+        # Per-thread PUSH sockets feeding events to the broker loop
+        self._event_sockets = threading.local()
+        # Ids of streaming requests that are still running
+        self._streams = set()
+
+        # Set up signal handling
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+
+        # Register cleanup function to run on exit
+        atexit.register(self.cleanup)
+
+        # Log the process ID for debugging
+        logger.info(f"Server starting with PID: {os.getpid()}")
+
+    def cleanup(self):
+        """Clean up resources when the process exits."""
+        logger.info("Cleaning up server resources...")
+        self.running = False
+        for worker in self.worker_threads:
+            worker.join(timeout=1.0)
+        self.worker_threads = []
+
+        if self.supervisor:
+            self.supervisor.stop()
+
+        sockets = (
+            self.socket,
+            self.backend,
+            self.events,
+            self.events_sink,
+            self.control,
+        )
+        for socket in sockets:
+            if socket:
+                try:
+                    socket.close(linger=0)
+                except Exception as e:
+                    logger.error(f"Error closing socket: {e}")
+        self.socket = None
+        self.backend = None
+        self.events = None
+        self.events_sink = None
+        self.control = None
+
+        if self.context:
+            try:
+                # Workers stuck in a long request still own their sockets,
+                # so don't wait for them to be closed.
+                self.context.destroy(linger=0)
+            except Exception as e:
+                logger.error(f"Error terminating ZMQ context: {e}")
+            self.context = None
+
+        if self.service:
+            self.service.close()
+        logger.info("Server cleanup complete")
+
+    def signal_handler(self, sig, frame):
+        """Handle signals to gracefully shut down the server."""
+        signal_name = "SIGTERM" if sig == signal.SIGTERM else "SIGINT"
+        logger.info(f"Received {signal_name} signal, stopping server...")
+        self.running = False
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=5.0)
+        sys.exit(0)
+
+    def dispatch(
+        self,
+        request_data: Dict[str, Any],
+        queue_wait: float = 0.0,
+        response_format: Optional[ResponseFormat] = None,
+    ) -> Dict[str, Any]:
+        """
+        Call the service method named in a request.
+
+        Args:
+            request_data: Decoded request with "method" and "params"
+            queue_wait: Seconds the request waited for a worker, which count
+                against its timeout
+            response_format: Format of the reply, also applied to the
+                streamed "answer" events
+
+        Returns:
+            Dict with the result of the call
+        """
+        # Extract method and params
+        method = request_data.get("method")
+        params = request_data.get("params") or {}
+
+        logger.debug(f"Received request: {method} with params: {params}")
+
+        # Call the appropriate method
+        if method == "initialize":
+            return self.service.initialize(**params)
+        elif method == "ask":
+            return self.dispatch_ask(
+                functools.partial(
+                    self.service.ask,
+                    params.get("question", ""),
+                    instance=params.get("instance"),
+                    timeout=self.request_timeout_left(params, queue_wait),
+                ),
+                params,
+                response_format,
+            )
+        elif method == "ask_batch":
+            return self.dispatch_ask(
+                functools.partial(
+                    self.service.ask_batch,
+                    params.get("questions") or [],
+                    concurrency=params.get("concurrency"),
+                    instance=params.get("instance"),
+                    timeout=self.request_timeout_left(params, queue_wait),
+                ),
+                params,
+                response_format,
+            )
+        elif method == "index":
+            return self.service.index(**params)
+        elif method == "reindex":
+            return self.service.reindex(**params)
+        elif method == "warmup":
+            return self.service.warmup(**params)
+        elif method == "prefetch":
+            return self.service.prefetch(**params)
+        elif method == "update_settings":
+            return self.service.update_settings(**params)
+        elif method == "get_preset_names":
+            return self.service.get_preset_names()
+        elif method == "get_status":
+            return self.get_status(**params)
+        elif method == "get_metrics":
+            return self.service.get_metrics(**params)
+        elif method == "list_history":
+            return self.service.list_history(**params)
+        elif method == "search_history":
+            return self.service.search_history(**params)
+        elif method == "get_answer":
+            return self.service.get_answer(**params)
+        elif method == "start_profiling":
+            return self.start_profiling(**params)
+        elif method == "stop_profiling":
+            return self.stop_profiling(**params)
+        elif method == "cancel":
+            if self.cancel_queued(params.get("request_id")):
+                return {
+                    "status": "success",
+                    "message": f"Request {params['request_id']} cancelled",
+                }
+            return self.service.cancel(**params)
+        return {
+            "status": "error",
+            "message": f"Unknown method: {method}",
+        }
+
+    def get_status(
+        self, instance: Optional[str] = None, request_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Get the status of a PaperQA instance and of the request queue.
+
+        Args:
+            instance: Name of the instance, None for the default instance
+            request_id: Optional id of a request to get the queue position of
+
+        Returns:
+            Dict with status information, the state of the queue under "queue"
+            and, if the request is waiting, its position and estimated wait
+            under "request"
+        """
+        status = self.service.get_status(instance)
+        status["queue"] = self.scheduler.status()
+        if request_id:
+            status["request"] = self.scheduler.position(request_id) or {
+                "position": None
+            }
+        return status
+
+    def start_profiling(
+        self, mode: Any = True, interval: float = DEFAULT_SAMPLE_INTERVAL
+    ) -> Dict[str, Any]:
+        """
+        Start profiling the server process until `stop_profiling`.
+
+        Args:
+            mode: "sample" to sample the stacks of all threads, "cprofile" to
+                trace the event loop and the requests handled, True for
+                "sample"
+            interval: Seconds between two samples in "sample" mode
+
+        Returns:
+            Dict with the mode of the profile
+        """
+        try:
+            return {"status": "success", **self.profiler.start(mode, interval)}
+        except (ValueError, RuntimeError) as e:
+            return {"status": "error", "message": str(e)}
+
+    def stop_profiling(self, top: int = TOP_HOTSPOTS) -> Dict[str, Any]:
+        """
+        Stop profiling the server process and save the profile.
+
+        Args:
+            top: Number of hotspots in the summary
+
+        Returns:
+            Dict with the file the profile was saved to and its hotspots under
+            "profile"
+        """
+        try:
+            return {"status": "success", "profile": self.profiler.stop(top)}
+        except RuntimeError as e:
+            return {"status": "error", "message": str(e)}
+
+    def cancel_queued(self, request_id: Optional[str]) -> bool:
+        """
+        Cancel a request still waiting for a worker.
+
+        Only called from the broker loop, which owns the client socket.
+
+        Args:
+            request_id: Id the request was submitted with
+
+        Returns:
+            Whether a waiting request was cancelled
+        """
+        request = self.scheduler.remove(request_id) if request_id else None
+        if request is None:
+            return False
+        logger.info(f"Cancelling queued request {request_id}")
+        result = {"status": "cancelled", "message": "Request was cancelled"}
+        self.socket.send_multipart([*request.envelope, json.dumps(result).encode()])
+        return True
+
+    def request_timeout_left(
+        self, params: Dict[str, Any], queue_wait: float
+    ) -> Optional[float]:
+        """
+        Get the time left to answer a request.
+
+        Args:
+            params: Request params with the optional "timeout" in seconds
+            queue_wait: Seconds the request already waited for a worker
+
+        Returns:
+            Seconds left before the deadline of the request, None for no limit
+        """
+        timeout = params.get("timeout", self.request_timeout)
+        if timeout is None:
+            return None
+        return float(timeout) - queue_wait
+
+    def dispatch_ask(
+        self,
+        ask: Callable[..., Dict[str, Any]],
+        params: Dict[str, Any],
+        response_format: Optional[ResponseFormat] = None,
+    ) -> Dict[str, Any]:
+        """
+        Call an ask method, publishing its progress events if requested.
+
+        Args:
+            ask: Service method taking `request_id` and `on_event`
+            params: Request params with the optional "request_id" and "stream"
+            response_format: Format applied to the published "answer" events
+
+        Returns:
+            Dict with the result of the call
+        """
+        request_id = params.get("request_id")
+        if not params.get("stream"):
+            return ask(request_id=request_id)
+        if not request_id:
+            return {
+                "status": "error",
+                "message": "Streaming requests need a request_id",
+            }
+        on_event = functools.partial(self.publish_event, request_id)
+        if response_format and not response_format.is_default:
+            publish = on_event
+
+            def on_event(event: str, data: Dict[str, Any]):
+                if event == "answer":
+                    data = response_format.compact(data)
+                publish(event, data)
+
+        self._streams.add(request_id)
+        try:
+            return ask(request_id=request_id, on_event=on_event)
+        finally:
+            self._streams.discard(request_id)
+
+    def handle_request(self, socket):
+        """
+        Handle a single request from a client.
+
+        Args:
+            socket: ZMQ socket to receive from and send to, the request is
+                made of the client envelope followed by the JSON payload
+        """
+        frames = socket.recv_multipart()
+        delimiter = frames.index(b"")
+        envelope, payload = frames[: delimiter + 1], frames[delimiter + 1 :]
+        try:
+            # Receive request
+            request_data = json.loads(payload[0])
+            start = time.perf_counter()
+            method = request_data.get("method")
+            response_format = ResponseFormat.from_params(
+                request_data.get("params") or {}
+            )
+            queued_at = request_data.pop("queued_at", None)
+            queue_wait = 0.0
+            if queued_at is not None:
+                queue_wait = start - queued_at
+                METRICS.observe("paperqa_queue_wait_seconds", queue_wait, method=method)
+            params = request_data.get("params") or {}
+            profile_mode = params.pop("profile", None)
+            with self.profiler.request(
+                profile_mode, params.get("request_id") or method or "request"
+            ) as profile:
+                result = self.dispatch(request_data, queue_wait, response_format)
+                METRICS.observe(
+                    "paperqa_request_seconds",
+                    time.perf_counter() - start,
+                    method=method,
+                )
+                METRICS.increment(
+                    "paperqa_requests_total", method=method, status=result.get("status")
+                )
+                if queued_at is not None and isinstance(result.get("metrics"), dict):
+                    result["metrics"]["queue_wait"] = round(queue_wait, 3)
+
+                # Send response, encoding it is part of the profile
+                compact = response_format.compact(result)
+                reply = response_format.encode(compact)
+            if profile:
+                reply = response_format.encode({**compact, "profile": profile})
+            METRICS.observe(
+                "paperqa_response_bytes",
+                sum(len(frame) for frame in reply),
+                method=method,
+                encoding=response_format.encoding,
+            )
+            socket.send_multipart([*envelope, *reply])
+
+        except Exception as e:
+            logger.error(f"Error handling request: {str(e)}")
+            # Send error response
+            result = {"status": "error", "message": f"Server error: {str(e)}"}
+            socket.send_multipart([*envelope, json.dumps(result).encode()])
+
+    def publish_event(self, request_id: str, event: str, data: Dict[str, Any]):
+        """
+        Publish a progress event of a streaming request.
+
+        Can be called from any thread, events are handed over to the broker
+        loop which owns the XPUB socket.
+
+        Args:
+            request_id: Id of the request, used as topic
+            event: Name of the event
+            data: Event payload
+        """
+        socket = getattr(self._event_sockets, "socket", None)
+        if socket is None:
+            socket = self.context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.EVENTS_ENDPOINT)
+            self._event_sockets.socket = socket
+        message = {"request_id": request_id, "event": event, **data}
+        socket.send_multipart([request_id.encode(), json.dumps(message).encode()])
+
+    def handle_subscription(self, message: bytes):
+        """
+        Track subscriptions on the events socket.
+
+        Args:
+            message: Subscription message from the XPUB socket, a leading 1 or 0
+                byte for (un)subscribe followed by the topic
+        """
+        if not message:
+            return
+        subscribed, request_id = message[0] == 1, message[1:].decode(errors="replace")
+        if subscribed:
+            logger.debug(f"Client subscribed to events of {request_id}")
+        elif request_id in self._streams:
+            logger.info(f"Client of streaming request {request_id} went away")
+            self.service.cancel(request_id)
+        elif self.supervisor:
+            slot = self.running_slot(request_id)
+            request = self._assigned[slot][0] if slot else None
+            if request and (request.request_data.get("params") or {}).get("stream"):
+                logger.info(f"Client of streaming request {request_id} went away")
+                self.forward_cancel(None, request_id, ResponseFormat())
+
+    def worker_loop(self, worker_id: int, identity: Optional[bytes] = None):
+        """
+        Serve requests forwarded by the broker until the server stops.
+
+        Args:
+            worker_id: Index of the worker, used for logging
+            identity: Routing id of the worker, None for one chosen by ZMQ
+        """
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        if identity:
+            socket.setsockopt(zmq.IDENTITY, identity)
+        socket.connect(self.WORKERS_ENDPOINT)
+        socket.send(self.WORKER_READY)
+        logger.debug(f"Worker {worker_id} ready")
+
+        try:
+            while self.running:
+                try:
+                    if socket.poll(timeout=500) != 0:  # timeout in ms
+                        self.handle_request(socket)
+                except zmq.ZMQError as e:
+                    if not self.running or e.errno == zmq.ETERM:
+                        break
+                    logger.error(f"ZMQ error in worker {worker_id}: {str(e)}")
+        finally:
+            socket.close()
+            logger.debug(f"Worker {worker_id} stopped")
+
+    def route_request(self, frames):
+        """
+        Answer a client request inline or queue it for the worker pool.
+
+        Args:
+            frames: Multipart message received on the ROUTER socket, made of
+                the routing envelope, an empty delimiter and the JSON payload
+        """
+        try:
+            delimiter = frames.index(b"")
+        except ValueError:
+            logger.error("Dropping malformed request without envelope")
+            return
+        envelope, payload = frames[: delimiter + 1], frames[delimiter + 1 :]
+
+        response_format = ResponseFormat()
+        try:
+            request_data = json.loads(payload[0])
+        except (IndexError, ValueError) as e:
+            result = {"status": "error", "message": f"Server error: {str(e)}"}
+        else:
+            method = request_data.get("method")
+            if self.supervisor and method in BROADCAST_METHODS | self.INLINE_METHODS:
+                try:
+                    response_format = ResponseFormat.from_params(
+                        request_data.get("params") or {}
+                    )
+                    result = self.forward_request(
+                        envelope, request_data, response_format
+                    )
+                    if result is None:
+                        return
+                    result = response_format.compact(result)
+                except Exception as e:
+                    logger.error(f"Error handling request: {str(e)}")
+                    response_format = ResponseFormat()
+                    result = {"status": "error", "message": f"Server error: {str(e)}"}
+            elif method not in self.INLINE_METHODS:
+                result = self.queue_request(envelope, request_data)
+                if result is None:
+                    self.start_queued()
+                    return
+            else:
+                try:
+                    response_format = ResponseFormat.from_params(
+                        request_data.get("params") or {}
+                    )
+                    result = response_format.compact(self.dispatch(request_data))
+                except Exception as e:
+                    logger.error(f"Error handling request: {str(e)}")
+                    response_format = ResponseFormat()
+                    result = {"status": "error", "message": f"Server error: {str(e)}"}
+
+        self.socket.send_multipart([*envelope, *response_format.encode(result)])
+
+    def queue_request(
+        self, envelope: List[bytes], request_data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Queue a request for the worker pool.
+
+        The request is queued under its "priority" param, or the default
+        priority of its method, and its "client" param, or the connection it
+        came from.
+
+        Args:
+            envelope: Routing frames of the client
+            request_data: Decoded request
+
+        Returns:
+            None if the request was queued, else the reply rejecting it
+        """
+        method = request_data.get("method")
+        params = request_data.get("params") or {}
+        try:
+            priority = self.scheduler.priority_of(request_data)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        params.pop("priority", None)
+        client = str(params.pop("client", None) or envelope[0].hex())
+
+        request_id = params.get("request_id")
+        if request_id and self._cancelled.pop(request_id, None) is not None:
+            logger.info(f"Request {request_id} was cancelled before it arrived")
+            return {"status": "cancelled", "message": "Request was cancelled"}
+
+        # Stamped to measure how long the request waits for a worker
+        request_data["queued_at"] = time.perf_counter()
+        request = QueuedRequest(envelope, request_data, client, priority)
+        if self.scheduler.submit(request):
+            return None
+
+        logger.warning(f"Rejecting {method} request, the {priority} queue is full")
+        METRICS.increment(
+            "paperqa_requests_rejected_total", method=method, priority=priority
+        )
+        return {
+            "status": "rejected",
+            "message": f"Server busy, the {priority} queue is full. Retry later.",
+            "estimated_wait": self.scheduler.status()["priorities"][priority][
+                "estimated_wait"
+            ],
+        }
+
+    def start_queued(self):
+        """Hand waiting requests to idle workers, in scheduling order."""
+        while self._idle_workers:
+            if self.supervisor:
+                process = self.supervisor.find(self._idle_workers[0])
+                if process is None or process.retiring:
+                    self._idle_workers.popleft()
+                    continue
+            request = self.scheduler.next()
+            if request is None:
+                return
+            worker = self._idle_workers.popleft()
+            self._assigned[worker] = (request, time.perf_counter())
+            self.backend.send_multipart(
+                [
+                    worker,
+                    b"",
+                    *request.envelope,
+                    json.dumps(request.request_data).encode(),
+                ]
+            )
+
+    def handle_worker(self, frames):
+        """
+        Forward the reply of a worker and give it the next request.
+
+        Args:
+            frames: Multipart message received on the workers ROUTER socket,
+                made of the worker id, an empty delimiter and either
+                WORKER_READY or the reply with its client envelope
+        """
+        worker, reply = frames[0], frames[2:]
+        if reply != [self.WORKER_READY]:
+            self.socket.send_multipart(reply)
+            request, started = self._assigned.pop(worker)
+            self.scheduler.finished(request.priority, time.perf_counter() - started)
+        process = self.supervisor.find(worker) if self.supervisor else None
+        if process and process.retiring:
+            self.stop_if_idle(process)
+        else:
+            self._idle_workers.append(worker)
+        self.start_queued()
+
+    def forward_request(
+        self,
+        envelope: List[bytes],
+        request_data: Dict[str, Any],
+        response_format: ResponseFormat,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Send a control or broadcast request to the worker processes.
+
+        Only called in supervisor mode, from the broker loop.
+
+        Args:
+            envelope: Routing frames of the client
+            request_data: Decoded request
+            response_format: Format of the reply
+
+        Returns:
+            None if the reply is sent once the processes answered, else the
+            reply
+        """
+        method = request_data.get("method")
+        params = request_data.get("params") or {}
+        if method in BROADCAST_METHODS:
+            self.broadcast(envelope, request_data, response_format)
+            return None
+        if method == "get_preset_names":
+            return {"status": "success", "presets": list(PRESET_NAMES)}
+        if method == "cancel":
+            request_id = params.get("request_id")
+            if not request_id:
+                return {"status": "error", "message": "No request_id to cancel"}
+            return self.forward_cancel(envelope, request_id, response_format)
+
+        ready = self.supervisor.ready()
+        if not ready:
+            return self.merge_replies(ControlCall(None, request_data, None, []))
+        # Status comes from the index owner, metrics and profiles from every
+        # process
+        if method in ("get_metrics", "start_profiling", "stop_profiling"):
+            targets = ready
+        else:
+            targets = ready[:1]
+        self.send_control(
+            ControlCall(
+                envelope, request_data, response_format, [p.key for p in targets]
+            )
+        )
+        return None
+
+    def broadcast(
+        self,
+        envelope: List[bytes],
+        request_data: Dict[str, Any],
+        response_format: ResponseFormat,
+    ):
+        """
+        Send a request to every worker process, configuration requests are
+        also replayed to processes started later.
+
+        Waits for a process to be ready if none is.
+
+        Args:
+            envelope: Routing frames of the client
+            request_data: Decoded request
+            response_format: Format of the reply
+        """
+        ready = self.supervisor.ready()
+        if not ready:
+            self._deferred.append((envelope, request_data, response_format))
+            return
+        if request_data.get("method") in CONFIG_METHODS:
+            sequence = self.supervisor.record(request_data)
+            for process in ready:
+                process.applied = sequence
+        self.send_control(
+            ControlCall(envelope, request_data, response_format, [p.key for p in ready])
+        )
+
+    def send_control(self, call: ControlCall):
+        """Send a request to the control sockets of its target processes."""
+        call_id = str(next(self._call_ids)).encode()
+        self._control_calls[call_id] = call
+        payload = json.dumps(call.request_data).encode()
+        for key in call.targets:
+            self.control.send_multipart([key.encode(), call_id, payload])
+
+    def running_slot(self, request_id: Optional[str]) -> Optional[bytes]:
+        """Find the worker serving a request, by request id."""
+        if not request_id:
+            return None
+        return next(
+            (
+                slot
+                for slot, (request, _) in self._assigned.items()
+                if request.request_id == request_id
+            ),
+            None,
+        )
+
+    def forward_cancel(
+        self,
+        envelope: Optional[List[bytes]],
+        request_id: str,
+        response_format: ResponseFormat,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Cancel a request in supervisor mode.
+
+        A running request is cancelled by the process serving it, a request
+        that didn't arrive yet is cancelled when it does.
+
+        Args:
+            envelope: Routing frames of the client, None if no one waits for
+                the reply
+            request_id: Id the request was submitted with
+            response_format: Format of the reply
+
+        Returns:
+            None if the reply is sent once the process answered, else the reply
+        """
+        if self.cancel_queued(request_id):
+            return {"status": "success", "message": f"Request {request_id} cancelled"}
+        slot = self.running_slot(request_id)
+        if slot is not None:
+            process = self.supervisor.find(slot)
+            request_data = {"method": "cancel", "params": {"request_id": request_id}}
+            self.send_control(
+                ControlCall(envelope, request_data, response_format, [process.key])
+            )
+            return None
+        now = time.monotonic()
+        self._cancelled = {
+            rid: at for rid, at in self._cancelled.items() if now - at < CANCELLED_TTL
+        }
+        self._cancelled[request_id] = now
+        logger.info(f"Request {request_id} will be cancelled when it arrives")
+        return {
+            "status": "success",
+            "message": f"Request {request_id} not running,"
+            " it will be cancelled if it starts",
+        }
+
+    def handle_control(self, frames):
+        """
+        Handle a message of a worker process on the control socket.
+
+        Args:
+            frames: Multipart message received on the control ROUTER socket,
+                made of the process key, the call id and the JSON reply, or
+                an empty call id and the state of a process that just started
+        """
+        key, call_id, payload = frames
+        process = self.supervisor.find(key)
+        if process is None:
+            return
+        if not call_id:
+            self.worker_process_ready(process, json.loads(payload)["applied"])
+            return
+        call = self._control_calls.get(call_id)
+        if call is None or process.key not in call.waiting:
+            return
+        call.replies[process.key] = json.loads(payload)
+        call.waiting.discard(process.key)
+        if not call.waiting:
+            self.finish_control_call(call_id)
+
+    def worker_process_ready(self, process: WorkerProcess, applied: int):
+        """
+        Let a worker process that just started take requests.
+
+        Args:
+            process: The process
+            applied: Sequence number of the last configuration request it
+                replayed
+        """
+        process.ready = True
+        process.applied = applied
+        # Configuration requests broadcast while it was starting
+        for sequence, request_data in self.supervisor.missed(process):
+            payload = json.dumps(request_data).encode()
+            self.control.send_multipart([process.key.encode(), b"", payload])
+            process.applied = sequence
+        logger.info(f"Worker process {process.key} ready")
+        deferred, self._deferred = self._deferred, []
+        for envelope, request_data, response_format in deferred:
+            self.broadcast(envelope, request_data, response_format)
+
+    def finish_control_call(self, call_id: bytes):
+        """Reply to a request once the processes it was sent to answered."""
+        call = self._control_calls.pop(call_id)
+        if call.method == "cancel" and not call.replies:
+            # The process exited, the request may be queued again for a retry
+            request_id = call.request_data["params"]["request_id"]
+            result = self.forward_cancel(
+                call.envelope, request_id, call.response_format
+            )
+            if result is None:
+                return
+        else:
+            result = self.merge_replies(call)
+        if call.envelope is None:
+            return
+        response_format = call.response_format
+        self.socket.send_multipart(
+            [*call.envelope, *response_format.encode(response_format.compact(result))]
+        )
+
+    def merge_replies(self, call: ControlCall) -> Dict[str, Any]:
+        """
+        Combine the replies of the worker processes to a request.
+
+        Args:
+            call: Request sent to the processes
+
+        Returns:
+            The reply to the client
+        """
+        replies = call.ordered_replies()
+        params = call.request_data.get("params") or {}
+        if call.method == "get_status":
+            if replies:
+                result = replies[0][1]
+            else:
+                result = {
+                    "status": "starting",
+                    "message": "Worker processes are starting",
+                }
+            result["queue"] = self.scheduler.status()
+            if params.get("request_id"):
+                result["request"] = self.scheduler.position(params["request_id"]) or {
+                    "position": None
+                }
+            result["supervisor"] = self.supervisor.status()
+            for process in result["supervisor"]["workers"]:
+                prefix = f"{process['worker']}:".encode()
+                process["busy"] = sum(s.startswith(prefix) for s in self._assigned)
+            return result
+        if call.method == "get_metrics":
+            if params.get("format") == "prometheus":
+                result = {"status": "success", "prometheus": METRICS.prometheus()}
+            else:
+                result = {"status": "success", "metrics": METRICS.snapshot()}
+            if params.get("reset"):
+                METRICS.reset()
+            result["workers"] = dict(replies)
+            return result
+        if call.method in ("start_profiling", "stop_profiling"):
+            # The server process only routes requests, profile the workers
+            workers = dict(replies)
+            if any(reply.get("status") == "success" for reply in workers.values()):
+                return {"status": "success", "workers": workers}
+            if replies:
+                return {**replies[0][1], "workers": workers}
+        if not replies:
+            return {
+                "status": "error",
+                "message": "The worker process exited before answering",
+            }
+        # Processes share the configuration, an error of one is reported
+        errors = [reply for _, reply in replies if reply.get("status") == "error"]
+        return errors[0] if errors else replies[0][1]
+
+    def supervise(self):
+        """Replace exited worker processes and retire those over their limit."""
+        for process in self.supervisor.reap():
+            self.worker_process_exited(process)
+        for process in self.supervisor.check_memory():
+            self.stop_if_idle(process)
+
+    def worker_process_exited(self, process: WorkerProcess):
+        """
+        Retry the requests of a worker process that exited on other workers.
+
+        Args:
+            process: The process
+        """
+        prefix = f"{process.key}:".encode()
+        self._idle_workers = collections.deque(
+            w for w in self._idle_workers if not w.startswith(prefix)
+        )
+        for slot in [s for s in self._assigned if s.startswith(prefix)]:
+            request, _ = self._assigned.pop(slot)
+            self.scheduler.finished(request.priority, None)
+            self.retry_request(request)
+        for call_id, call in list(self._control_calls.items()):
+            if process.key in call.waiting:
+                call.waiting.discard(process.key)
+                if not call.waiting:
+                    self.finish_control_call(call_id)
+        self.start_queued()
+
+    def retry_request(self, request: QueuedRequest):
+        """
+        Queue a request again after its worker process exited, or fail it
+        after MAX_REQUEST_RETRIES retries.
+
+        Args:
+            request: The request
+        """
+        method = request.request_data.get("method")
+        request.attempts += 1
+        if request.attempts > MAX_REQUEST_RETRIES:
+            logger.error(f"Giving up on {method} request, its worker processes exited")
+            result = {
+                "status": "error",
+                "message": "The worker process serving the request exited",
+            }
+            self.socket.send_multipart([*request.envelope, json.dumps(result).encode()])
+            return
+        logger.warning(f"Retrying {method} request, its worker process exited")
+        METRICS.increment("paperqa_requests_retried_total", method=method)
+        self.scheduler.submit(request, front=True)
+
+    def stop_if_idle(self, process: WorkerProcess):
+        """Stop a retiring worker process once it serves no request."""
+        prefix = f"{process.key}:".encode()
+        if not any(slot.startswith(prefix) for slot in self._assigned):
+            self.supervisor.stop_worker(process)
+
+    @staticmethod
+    def bind_local(socket) -> str:
+        """Bind a socket to a free loopback port, for worker processes."""
+        port = socket.bind_to_random_port("tcp://127.0.0.1")
+        return f"tcp://127.0.0.1:{port}"
+
+    def run(self):
+        """Run the server in a loop."""
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.backend = self.context.socket(zmq.ROUTER)
+        self.events = self.context.socket(zmq.XPUB)
+        self.events_sink = self.context.socket(zmq.PULL)
+
+        endpoint = f"tcp://{self.host}:{self.port}"
+        self.socket.bind(endpoint)
+        self.events.bind(f"tcp://{self.host}:{self.events_port}")
+
+        self.running = True
+        self.worker_threads = []
+        self._idle_workers.clear()
+        self._assigned.clear()
+        if self.supervisor:
+            # Worker processes connect over loopback TCP
+            self.control = self.context.socket(zmq.ROUTER)
+            self.supervisor.start(
+                {
+                    "workers": self.bind_local(self.backend),
+                    "events": self.bind_local(self.events_sink),
+                    "control": self.bind_local(self.control),
+                }
+            )
+            workers = f"{self.supervisor.processes} worker processes"
+        else:
+            self.backend.bind(self.WORKERS_ENDPOINT)
+            self.events_sink.bind(self.EVENTS_ENDPOINT)
+            for worker_id in range(self.workers):
+                worker = threading.Thread(target=self.worker_loop, args=(worker_id,))
+                worker.daemon = True
+                worker.start()
+                self.worker_threads.append(worker)
+            workers = f"{self.workers} workers"
+
+        logger.info(
+            f"PaperQA ZMQ server started on {endpoint} with {workers},"
+            f" publishing events on port {self.events_port}"
+        )
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        poller.register(self.events, zmq.POLLIN)
+        poller.register(self.events_sink, zmq.POLLIN)
+        if self.control:
+            poller.register(self.control, zmq.POLLIN)
 
-        self.running = True
         while self.running:
             try:
-                # Wait for next request from client with a timeout
-                if self.socket.poll(timeout=500) != 0:  # timeout in ms
-                    self.handle_request(self.socket)
+                # Wait for next message with a timeout
+                events = dict(poller.poll(timeout=500))  # timeout in ms
+                if self.socket in events:
+                    self.route_request(self.socket.recv_multipart())
+                if self.backend in events:
+                    self.handle_worker(self.backend.recv_multipart())
+                if self.events_sink in events:
+                    self.events.send_multipart(self.events_sink.recv_multipart())
+                if self.events in events:
+                    self.handle_subscription(self.events.recv())
+                if self.control in events:
+                    self.handle_control(self.control.recv_multipart())
+                if self.supervisor:
+                    self.supervise()
             except zmq.ZMQError as e:
                 logger.error(f"ZMQ error: {str(e)}")
                 # Continue running unless we're shutting down
@@ -336,6 +2598,110 @@ class PaperQAServer:
         # Cleanup happens in the cleanup method
         logger.info("Server stopped.")
 
+    def serve_supervisor(
+        self,
+        endpoints: Dict[str, str],
+        key: str,
+        config_log: List[Tuple[int, Dict[str, Any]]],
+        index_owner: bool,
+    ):
+        """
+        Serve the requests of a supervisor, as one of its worker processes.
+
+        Replays the configuration requests so far, then connects the worker
+        threads to the supervisor and tells it the process is ready. Control
+        requests are answered on a DEALER socket until the supervisor stops
+        the process or exits.
+
+        Args:
+            endpoints: Endpoints of the supervisor's "workers", "events" and
+                "control" sockets
+            key: Id of the process, prefix of the routing ids of its workers
+            config_log: Configuration requests to replay, with their sequence
+                numbers
+            index_owner: Whether this process watches paper directories and
+                builds missing indexes
+        """
+        self.service.index_owner = index_owner
+        self.WORKERS_ENDPOINT = endpoints["workers"]
+        self.EVENTS_ENDPOINT = endpoints["events"]
+        self.context = zmq.Context()
+        self.control = self.context.socket(zmq.DEALER)
+        self.control.setsockopt(zmq.LINGER, 0)
+        self.control.setsockopt(zmq.IDENTITY, key.encode())
+        self.control.connect(endpoints["control"])
+
+        applied = 0
+        for sequence, request_data in config_log:
+            result = self.dispatch(request_data)
+            if result.get("status") == "error":
+                logger.error(
+                    f"Replaying {request_data.get('method')} failed:"
+                    f" {result.get('message')}"
+                )
+            applied = sequence
+
+        self.running = True
+        self.worker_threads = []
+        for worker_id in range(self.workers):
+            worker = threading.Thread(
+                target=self.worker_loop,
+                args=(worker_id, f"{key}:{worker_id}".encode()),
+            )
+            worker.daemon = True
+            worker.start()
+            self.worker_threads.append(worker)
+        self.control.send_multipart([b"", json.dumps({"applied": applied}).encode()])
+        logger.info(f"Worker process {key} serving with {self.workers} workers")
+
+        # Configuration requests run in order, control methods concurrently,
+        # replies are sent from this thread which owns the socket
+        configure = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        inline = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        replies = queue.SimpleQueue()
+        parent = multiprocessing.parent_process()
+        while self.running and (parent is None or parent.is_alive()):
+            try:
+                if self.control.poll(timeout=100):
+                    call_id, payload = self.control.recv_multipart()
+                    request_data = json.loads(payload)
+                    executor = (
+                        configure
+                        if request_data.get("method") in CONFIG_METHODS
+                        else inline
+                    )
+                    executor.submit(self.control_call, call_id, request_data, replies)
+                while not replies.empty():
+                    self.control.send_multipart(replies.get())
+            except zmq.ZMQError as e:
+                if not self.running or e.errno == zmq.ETERM:
+                    break
+                logger.error(f"ZMQ error in worker process {key}: {str(e)}")
+
+        logger.info(f"Worker process {key} stopping")
+        configure.shutdown(wait=False, cancel_futures=True)
+        inline.shutdown(wait=False, cancel_futures=True)
+        self.cleanup()
+
+    def control_call(
+        self, call_id: bytes, request_data: Dict[str, Any], replies: queue.SimpleQueue
+    ):
+        """
+        Answer a request of the supervisor on the control socket.
+
+        Args:
+            call_id: Id of the call, empty if the supervisor expects no reply
+            request_data: Decoded request
+            replies: Queue of reply frames sent by the control loop
+        """
+        try:
+            result = self.dispatch(request_data)
+        except Exception as e:
+            logger.error(f"Error handling control request: {str(e)}")
+            result = {"status": "error", "message": f"Server error: {str(e)}"}
+        if call_id:
+            replies.put([call_id, json.dumps(result).encode()])
+
     def start(self):
         """Start the server in a background thread."""
         if self.thread and self.thread.is_alive():
@@ -353,10 +2719,25 @@ class PaperQAServer:
         self.running = False
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=5.0)
+        for worker in self.worker_threads:
+            worker.join(timeout=1.0)
         logger.info("Server stopped.")
 
 
 if __name__ == "__main__":
     # Start the server directly if this file is run as a script
-    server = PaperQAServer()
+    memory_budget_mb = os.environ.get("PAPERQA_MEMORY_BUDGET_MB")
+    request_timeout = os.environ.get("PAPERQA_REQUEST_TIMEOUT")
+    max_worker_rss_mb = os.environ.get("PAPERQA_MAX_WORKER_RSS_MB")
+    server = PaperQAServer(
+        port=int(os.environ.get("PAPERQA_SERVER_PORT", "5555")),
+        workers=int(os.environ.get("PAPERQA_SERVER_WORKERS", "4")),
+        max_instances=int(os.environ.get("PAPERQA_MAX_INSTANCES", "4")),
+        memory_budget_mb=float(memory_budget_mb) if memory_budget_mb else None,
+        request_timeout=float(request_timeout) if request_timeout else None,
+        max_queue=int(os.environ.get("PAPERQA_MAX_QUEUE", str(DEFAULT_MAX_QUEUE))),
+        interactive_workers=int(os.environ.get("PAPERQA_INTERACTIVE_WORKERS", "1")),
+        processes=int(os.environ.get("PAPERQA_WORKER_PROCESSES", "0")),
+        max_worker_rss_mb=float(max_worker_rss_mb) if max_worker_rss_mb else None,
+    )
     server.run()  # This will block until the server is stopped
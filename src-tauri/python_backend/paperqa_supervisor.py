@@ -0,0 +1,401 @@
+"""
+PaperQA Supervisor - Worker processes of the server, replaced when they fail.
+
+In supervisor mode the server process only routes requests. Each worker
+process runs its own PaperQA service, with its own instances and event loop,
+and its worker threads take requests from the server like the worker threads
+of a single-process server do, so CPU-heavy work runs on all cores. A worker
+process that crashes, or grows past its memory limit, is replaced by a fresh
+one, which is configured by replaying the `initialize` and `update_settings`
+requests so far. The requests it was serving are retried on another worker.
+
+The server process creates a `WorkerSupervisor`, worker processes start in
+`run_worker_process`.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Requests that configure the service, sent to every worker process and
+# replayed to new ones
+CONFIG_METHODS = {"initialize", "update_settings"}
+# Requests sent to every worker process
+BROADCAST_METHODS = CONFIG_METHODS | {"warmup"}
+
+# Seconds between memory checks of the worker processes
+MEMORY_CHECK_INTERVAL = 2.0
+# Worker processes past this multiple of the memory limit are stopped right
+# away, instead of once their requests are done
+MEMORY_KILL_FACTOR = 1.5
+
+# Restarts of a process that failed soon after starting are delayed, doubling
+# up to the maximum, so that a broken configuration doesn't spin
+RESTART_BACKOFF = 1.0
+MAX_RESTART_BACKOFF = 60.0
+# Seconds a process has to run for its failure not to delay its restart
+HEALTHY_UPTIME = 30.0
+# Seconds a worker process gets to exit when stopped
+STOP_TIMEOUT = 5.0
+
+# Times a request is retried after the worker process serving it failed
+MAX_REQUEST_RETRIES = 1
+
+
+def process_memory(pid: int) -> Optional[int]:
+    """
+    Get the resident memory of a process.
+
+    Uses psutil if it is installed, /proc otherwise.
+
+    Args:
+        pid: Id of the process
+
+    Returns:
+        Resident set size in bytes, or None if it can't be measured
+    """
+    try:
+        import psutil
+
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def run_worker_process(
+    options: Dict[str, Any],
+    endpoints: Dict[str, str],
+    key: str,
+    config_log: List[Tuple[int, Dict[str, Any]]],
+    index_owner: bool,
+):
+    """
+    Entry point of a worker process.
+
+    Args:
+        options: Arguments of the `PaperQAServer` of the process
+        endpoints: Server endpoints the process connects to, see
+            `PaperQAServer.serve_supervisor`
+        key: Id of the process
+        config_log: Configuration requests to replay, with their sequence
+            numbers
+        index_owner: Whether the process watches paper directories and builds
+            missing indexes, only one process does
+    """
+    from paperqa_server import PaperQAServer
+
+    server = PaperQAServer(**options)
+    server.serve_supervisor(endpoints, key, config_log, index_owner)
+
+
+class WorkerProcess:
+    """
+    A worker process of the supervisor.
+    """
+
+    def __init__(self, index: int, generation: int, process: multiprocessing.Process):
+        """
+        Args:
+            index: Slot of the process, the process of slot 0 owns the indexes
+            generation: Number of processes started in the slot before
+            process: The process
+        """
+        self.index = index
+        self.generation = generation
+        self.process = process
+        # Routing id of the process, its worker threads are "<key>:<thread>"
+        self.key = f"p{index}.{generation}"
+        self.started_at = time.monotonic()
+        # Whether the process replayed the configuration and takes requests
+        self.ready = False
+        # Sequence number of the last configuration request the process got
+        self.applied = 0
+        # Over its memory limit: no new requests, restarted once idle
+        self.retiring = False
+        self.rss: Optional[int] = None
+
+    @property
+    def uptime(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def status(self) -> Dict[str, Any]:
+        """Summarize the process."""
+        return {
+            "worker": self.key,
+            "pid": self.process.pid,
+            "alive": self.process.is_alive(),
+            "ready": self.ready,
+            "retiring": self.retiring,
+            "memory_mb": round(self.rss / 2**20, 1) if self.rss is not None else None,
+            "uptime": round(self.uptime, 1),
+        }
+
+
+class WorkerSupervisor:
+    """
+    Starts the worker processes and replaces the ones that exit.
+
+    Doesn't route requests, the server hands them to the worker threads of
+    the processes and calls `reap` and `check_memory` from its loop.
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        options: Dict[str, Any],
+        max_rss_mb: Optional[float] = None,
+    ):
+        """
+        Args:
+            processes: Number of worker processes
+            options: Arguments of the `PaperQAServer` of each process
+            max_rss_mb: Resident memory above which a worker process is
+                replaced, None for no limit
+        """
+        if processes < 1:
+            raise ValueError("The supervisor needs at least one worker process")
+        self.processes = processes
+        self.options = options
+        self.max_rss_mb = max_rss_mb
+        self.endpoints: Optional[Dict[str, str]] = None
+        self.workers: Dict[str, WorkerProcess] = {}
+        # Configuration requests replayed to new processes, with their
+        # sequence numbers
+        self.config_log: List[Tuple[int, Dict[str, Any]]] = []
+        self._sequence = 0
+        self._generations = [0] * processes
+        # Failures in a row and the earliest restart time, by slot
+        self._failures = [0] * processes
+        self._restart_at: Dict[int, float] = {}
+        self._memory_checked = 0.0
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+
+    def start(self, endpoints: Dict[str, str]):
+        """
+        Start all worker processes.
+
+        Args:
+            endpoints: Server endpoints the processes connect to
+        """
+        self.endpoints = endpoints
+        for index in range(self.processes):
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        """Start the process of a slot."""
+        generation = self._generations[index]
+        self._generations[index] += 1
+        key = f"p{index}.{generation}"
+        process = self._context.Process(
+            target=run_worker_process,
+            args=(self.options, self.endpoints, key, self.config_log, index == 0),
+            name=f"paperqa-worker-{key}",
+            daemon=True,
+        )
+        process.start()
+        self.workers[key] = WorkerProcess(index, generation, process)
+        logger.info(f"Started worker process {key} with PID {process.pid}")
+
+    def find(self, identity: bytes) -> Optional[WorkerProcess]:
+        """
+        Find the process of a worker thread or control connection.
+
+        Args:
+            identity: Routing id, the process key optionally followed by ":"
+                and the thread
+
+        Returns:
+            The process, None if it already exited
+        """
+        return self.workers.get(identity.decode().split(":", 1)[0])
+
+    def ready(self) -> List[WorkerProcess]:
+        """Get the processes taking requests, the index owner first."""
+        return sorted(
+            (w for w in self.workers.values() if w.ready), key=lambda w: w.index
+        )
+
+    def record(self, request_data: Dict[str, Any]) -> int:
+        """
+        Add a configuration request to the log replayed to new processes.
+
+        `initialize` replaces the earlier requests for the same instance.
+
+        Args:
+            request_data: Decoded `initialize` or `update_settings` request
+
+        Returns:
+            Sequence number of the request
+        """
+        instance = (request_data.get("params") or {}).get("instance")
+        if request_data.get("method") == "initialize":
+            self.config_log = [
+                (seq, logged)
+                for seq, logged in self.config_log
+                if (logged.get("params") or {}).get("instance") != instance
+            ]
+        self._sequence += 1
+        self.config_log.append((self._sequence, request_data))
+        return self._sequence
+
+    def missed(self, worker: WorkerProcess) -> List[Tuple[int, Dict[str, Any]]]:
+        """Get the configuration requests logged after a process started."""
+        return [(seq, r) for seq, r in self.config_log if seq > worker.applied]
+
+    def reap(self) -> List[WorkerProcess]:
+        """
+        Collect exited processes and start replacements when due.
+
+        Returns:
+            Processes that exited since the last call
+        """
+        exited = [w for w in self.workers.values() if not w.process.is_alive()]
+        now = time.monotonic()
+        for worker in exited:
+            del self.workers[worker.key]
+            worker.process.join(timeout=0)
+            # Also when retired, e.g. by a memory limit it can't stay under
+            if worker.uptime >= HEALTHY_UPTIME:
+                self._failures[worker.index] = 0
+                delay = 0.0
+            else:
+                self._failures[worker.index] += 1
+                delay = min(
+                    RESTART_BACKOFF * 2 ** (self._failures[worker.index] - 1),
+                    MAX_RESTART_BACKOFF,
+                )
+            if worker.retiring:
+                logger.info(
+                    f"Worker process {worker.key} stopped, replacing it in {delay:.0f}s"
+                )
+            else:
+                logger.error(
+                    f"Worker process {worker.key} exited with code"
+                    f" {worker.process.exitcode}, restarting it in {delay:.0f}s"
+                )
+            self._restart_at[worker.index] = now + delay
+        for index, at in list(self._restart_at.items()):
+            if at <= now:
+                del self._restart_at[index]
+                self.restarts += 1
+                self._spawn(index)
+        return exited
+
+    def check_memory(self) -> List[WorkerProcess]:
+        """
+        Measure the processes and retire the ones over the memory limit.
+
+        Processes far over the limit are stopped right away.
+
+        Returns:
+            Processes newly retired, to restart once their requests are done
+        """
+        now = time.monotonic()
+        if now - self._memory_checked < MEMORY_CHECK_INTERVAL:
+            return []
+        self._memory_checked = now
+        retired = []
+        for worker in self.workers.values():
+            worker.rss = process_memory(worker.process.pid)
+            if self.max_rss_mb is None or worker.rss is None:
+                continue
+            rss_mb = worker.rss / 2**20
+            if rss_mb > self.max_rss_mb * MEMORY_KILL_FACTOR:
+                logger.warning(
+                    f"Worker process {worker.key} uses {rss_mb:.0f} MB, stopping it"
+                )
+                worker.retiring = True
+                worker.process.kill()
+            elif rss_mb > self.max_rss_mb and not worker.retiring:
+                logger.warning(
+                    f"Worker process {worker.key} uses {rss_mb:.0f} MB, replacing"
+                    " it once its requests are done"
+                )
+                worker.retiring = True
+                retired.append(worker)
+        return retired
+
+    def stop_worker(self, worker: WorkerProcess):
+        """Ask a process to exit, it is replaced by `reap`."""
+        worker.retiring = True
+        worker.process.terminate()
+
+    def stop(self):
+        """Stop all processes."""
+        for worker in self.workers.values():
+            worker.process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for worker in self.workers.values():
+            worker.process.join(timeout=max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                worker.process.kill()
+        self.workers.clear()
+        self._restart_at.clear()
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the state of the worker processes.
+
+        Returns:
+            Dict with the processes, restarts so far and the memory limit
+        """
+        return {
+            "processes": self.processes,
+            "restarts": self.restarts,
+            "max_rss_mb": self.max_rss_mb,
+            "workers": [
+                w.status() for w in sorted(self.workers.values(), key=lambda w: w.index)
+            ],
+            "restarting": sorted(self._restart_at),
+        }
+
+
+class ControlCall:
+    """
+    A request sent to the control connection of one or more worker processes,
+    answered once they all replied.
+    """
+
+    def __init__(
+        self,
+        envelope: Optional[List[bytes]],
+        request_data: Dict[str, Any],
+        response_format: Any,
+        targets: List[str],
+    ):
+        """
+        Args:
+            envelope: Routing frames of the client, None if no one waits for
+                the reply
+            request_data: Decoded request
+            response_format: `ResponseFormat` of the reply
+            targets: Keys of the processes the request was sent to, the index
+                owner first
+        """
+        self.envelope = envelope
+        self.request_data = request_data
+        self.response_format = response_format
+        self.targets = targets
+        # Processes that haven't replied yet
+        self.waiting: Set[str] = set(targets)
+        self.replies: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def method(self) -> Optional[str]:
+        return self.request_data.get("method")
+
+    def ordered_replies(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Get the replies received, in the order of the targets."""
+        return [(key, self.replies[key]) for key in self.targets if key in self.replies]
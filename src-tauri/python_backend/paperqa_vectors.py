@@ -0,0 +1,622 @@
+"""
+PaperQA Vectors - Memory-mapped chunk embeddings of a PaperQA index.
+
+PaperQA keeps the embeddings of chunks inside the pickled documents of its
+index, as lists of Python floats, and scores them per search. This module
+keeps them in one contiguous float16 (or float32) file instead, mapped into
+memory, with the rows of each paper in a side SQLite table. Opening a store
+takes no time whatever its size, and instances and processes using the same
+index share its pages.
+
+The top chunks for a query are found with a blocked matrix-vector product and
+`argpartition`. Large stores are partitioned into IVF lists (k-means clusters
+of the chunks), and a search then only scores the lists closest to the query.
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILENAME = "nova_embeddings.bin"
+METADATA_FILENAME = "nova_embeddings.sqlite"
+IVF_FILENAME = "nova_embeddings_ivf.npz"
+# Files are rewritten under a new name, with the generation of the write
+# between stem and suffix, so that maps of the previous file stay valid
+STORE_FILE_PATTERN = re.compile(r"nova_embeddings(_ivf)?(\.\d+)?\.(bin|npz)$")
+
+DTYPES = ("float16", "float32")
+
+# Rows scored at once, bounds the memory used by a search
+BLOCK_ROWS = 16384
+
+# Stores with at least this many chunks get IVF lists, unless their number is set
+IVF_MIN_ROWS = 100_000
+# Lists scored per search, as a fraction of all lists
+IVF_PROBE_FRACTION = 0.05
+IVF_MIN_PROBES = 4
+# Chunks sampled to train the IVF centroids, and k-means iterations
+IVF_TRAINING_ROWS = 50_000
+IVF_ITERATIONS = 10
+# Retrain the IVF lists once this fraction of chunks was added after training
+IVF_RETRAIN_FRACTION = 0.2
+
+# Rewrite the embeddings file once fewer of its rows belong to a paper
+COMPACT_LIVE_FRACTION = 0.5
+
+
+class Hit(NamedTuple):
+    """A chunk found by `EmbeddingStore.search`."""
+
+    file_location: str
+    dockey: str
+    # Position of the chunk among the chunks of its paper
+    index: int
+    row: int
+    score: float
+
+
+class _View(NamedTuple):
+    """Snapshot of a store, valid until the next write."""
+
+    generation: int
+    path: Path
+    matrix: np.ndarray
+    live: np.ndarray
+    starts: np.ndarray
+    counts: np.ndarray
+    file_locations: List[str]
+    dockeys: List[str]
+    papers_by_dockey: Dict[str, int]
+    ivf: Optional[Dict[str, np.ndarray]]
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Scale vectors to unit length, so that dot products are cosine similarities."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the `k` highest scores, highest first."""
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def mmr(
+    scores: np.ndarray, vectors: np.ndarray, k: int, mmr_lambda: float
+) -> List[int]:
+    """
+    Select results by maximal marginal relevance, like PaperQA does.
+
+    Args:
+        scores: Similarity of each candidate to the query, highest first
+        vectors: Normalized embeddings of the candidates
+        k: Number of results to select
+        mmr_lambda: Weight of relevance against diversity, 1 for relevance only
+
+    Returns:
+        Indices of the selected candidates
+    """
+    if len(scores) <= k or mmr_lambda >= 1.0:
+        return list(range(min(k, len(scores))))
+    similarities = vectors @ vectors.T
+    selected = [0]
+    while len(selected) < k:
+        redundancy = similarities[:, selected].max(axis=1)
+        mmr_scores = mmr_lambda * scores - (1 - mmr_lambda) * redundancy
+        mmr_scores[selected] = -np.inf
+        selected.append(int(mmr_scores.argmax()))
+    return selected
+
+
+class EmbeddingStore:
+    """
+    Chunk embeddings of an index in a memory-mapped file.
+
+    Rows are appended paper by paper, so the chunks of a paper are contiguous
+    and in order. Removing a paper only drops its rows from the metadata, the
+    file is compacted once most of its rows are unused. Searches work on a
+    snapshot of the store, writes don't disturb searches in progress.
+
+    Compacting the file and training the IVF lists write new files, which the
+    metadata then points to. Mapped files can't be replaced or deleted on
+    Windows, so files no longer used are deleted once nothing maps them.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        dtype: str = "float16",
+        ivf_lists: Optional[int] = None,
+    ):
+        """
+        Open (or create) the store.
+
+        Args:
+            directory: Directory of the index the embeddings belong to
+            dtype: "float16" or "float32", a store of the other type is emptied
+            ivf_lists: Number of IVF lists, None to use about the square root
+                of the number of chunks for stores of at least IVF_MIN_ROWS
+                chunks, 0 to always score every chunk
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype {dtype!r}, expected one of {DTYPES}")
+        self.directory = Path(directory)
+        self.dtype = dtype
+        self.ivf_lists = ivf_lists
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._view: Optional[_View] = None
+        self._conn = sqlite3.connect(
+            str(self.directory / METADATA_FILENAME), check_same_thread=False
+        )
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS papers (
+                    file_location TEXT PRIMARY KEY,
+                    filehash TEXT NOT NULL,
+                    dockey TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    count INTEGER NOT NULL
+                )
+                """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+                """)
+        stored_dtype = self._meta("dtype")
+        if stored_dtype and stored_dtype != dtype:
+            logger.info(f"Embedding store changed from {stored_dtype} to {dtype}")
+            self.clear()
+        else:
+            self._drop_unused_files()
+
+    def _meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, **values: Any):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            [(key, str(value)) for key, value in values.items()],
+        )
+
+    def _bump(self, **values: Any) -> int:
+        """Record a write, so that the next search takes a new snapshot."""
+        generation = int(self._meta("generation", "0")) + 1
+        self._set_meta(generation=generation, **values)
+        return generation
+
+    def _file(self) -> Path:
+        """Path of the embeddings file."""
+        return self.directory / self._meta("file", EMBEDDINGS_FILENAME)
+
+    def _ivf_file(self) -> Optional[Path]:
+        """Path of the IVF lists, None if there are none."""
+        name = self._meta("ivf_file", IVF_FILENAME)
+        return self.directory / name if name else None
+
+    def _new_file(self, name: str) -> Path:
+        """Path for a rewrite of a store file, unique to the next generation."""
+        generation = int(self._meta("generation", "0")) + 1
+        stem, suffix = name.rsplit(".", 1)
+        return self.directory / f"{stem}.{generation}.{suffix}"
+
+    def _drop_unused_files(self):
+        """
+        Delete the store files the metadata no longer points to.
+
+        Files still mapped by a snapshot can't be deleted on Windows, they are
+        deleted after a later write or when the store is opened again.
+        """
+        with self._lock:
+            used = {self._file(), self._ivf_file()}
+            view = self._view
+            if view is not None:
+                used.add(view.path)
+        for path in self.directory.iterdir():
+            if path in used or not STORE_FILE_PATTERN.fullmatch(path.name):
+                continue
+            try:
+                path.unlink()
+            except OSError as e:
+                logger.debug(f"Could not delete unused store file {path}: {e}")
+
+    def papers(self) -> Dict[str, str]:
+        """
+        Get the papers in the store.
+
+        Returns:
+            Dict of the file location of each paper to its file hash in the index
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT file_location, filehash FROM papers")
+            return dict(rows.fetchall())
+
+    def add(
+        self,
+        file_location: str,
+        filehash: str,
+        dockey: str,
+        embeddings: Sequence[Sequence[float]],
+    ):
+        """
+        Add the chunks of a paper, replacing the ones it had.
+
+        Args:
+            file_location: Location of the paper in the index
+            filehash: Hash of the paper in the index
+            dockey: Key of the paper's document
+            embeddings: Embeddings of the paper's chunks, in order
+        """
+        vectors = normalize_rows(embeddings).astype(self.dtype)
+        if vectors.ndim != 2 or not len(vectors):
+            raise ValueError(f"No embeddings to add for {file_location}")
+        with self._lock, self._conn:
+            dim = int(self._meta("dim", "0"))
+            if dim and dim != vectors.shape[1]:
+                raise ValueError(
+                    f"Embeddings of {file_location} have {vectors.shape[1]}"
+                    f" dimensions, the store has {dim}"
+                )
+            rows = int(self._meta("rows", "0"))
+            row_bytes = vectors.shape[1] * vectors.itemsize
+            with open(self._file(), "ab") as f:
+                # Drop what an interrupted write left past the last row
+                f.truncate(rows * row_bytes)
+                f.write(vectors.tobytes())
+            self._conn.execute(
+                "INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?)",
+                (file_location, filehash, dockey, rows, len(vectors)),
+            )
+            self._bump(dim=vectors.shape[1], dtype=self.dtype, rows=rows + len(vectors))
+
+    def remove(self, file_locations: Iterable[str]):
+        """
+        Remove papers, and compact the file if most of it is unused.
+
+        Args:
+            file_locations: Locations of the papers in the index
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "DELETE FROM papers WHERE file_location = ?",
+                    [(location,) for location in file_locations],
+                )
+                self._bump()
+            rows = int(self._meta("rows", "0"))
+            (live,) = self._conn.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM papers"
+            ).fetchone()
+            if not rows or live >= COMPACT_LIVE_FRACTION * rows:
+                return
+            try:
+                self._compact(live)
+            except OSError as e:
+                # The papers are removed, their rows just take space
+                logger.warning(f"Could not compact embedding store: {e}")
+                return
+            # Snapshots of the old file are taken again, so it can be deleted
+            self._view = None
+        self._drop_unused_files()
+
+    def _compact(self, live: int):
+        """
+        Write the rows of the remaining papers to a new file and switch to it.
+
+        The papers' rows and the file are updated in one transaction once the
+        new file is written, so a failure leaves the store as it was.
+        """
+        dim = int(self._meta("dim", "0"))
+        papers = self._conn.execute(
+            "SELECT file_location, start, count FROM papers ORDER BY start"
+        ).fetchall()
+        matrix = self._map(self._file(), int(self._meta("rows", "0")), dim)
+        path = self._new_file(EMBEDDINGS_FILENAME)
+        starts = []
+        start = 0
+        try:
+            with open(path, "wb") as f:
+                for file_location, old_start, count in papers:
+                    f.write(np.ascontiguousarray(matrix[old_start : old_start + count]))
+                    starts.append((start, file_location))
+                    start += count
+            del matrix
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE papers SET start = ? WHERE file_location = ?", starts
+                )
+                # Row numbers changed, the IVF lists have to be trained again
+                self._bump(rows=live, file=path.name, ivf_file="")
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+        logger.info(f"Compacted embedding store {path} to {live} chunks")
+
+    def clear(self):
+        """Drop all embeddings."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM papers")
+                self._conn.execute("DELETE FROM meta WHERE key != 'generation'")
+                self._bump(file=self._new_file(EMBEDDINGS_FILENAME).name, ivf_file="")
+            self._view = None
+        self._drop_unused_files()
+
+    def close(self):
+        """Close the metadata database."""
+        with self._lock:
+            self._conn.close()
+
+    def _map(self, path: Path, rows: int, dim: int) -> np.ndarray:
+        """Map an embeddings file into memory."""
+        if not rows:
+            return np.empty((0, dim), dtype=self.dtype)
+        return np.memmap(path, dtype=self.dtype, mode="r", shape=(rows, dim))
+
+    def _snapshot(self) -> _View:
+        """Get the current snapshot, taking a new one after writes."""
+        with self._lock:
+            generation = int(self._meta("generation", "0"))
+            if self._view and self._view.generation == generation:
+                return self._view
+            rows = int(self._meta("rows", "0"))
+            dim = int(self._meta("dim", "0"))
+            path = self._file()
+            ivf_path = self._ivf_file()
+            papers = self._conn.execute(
+                "SELECT file_location, dockey, start, count FROM papers ORDER BY start"
+            ).fetchall()
+        starts = np.array([p[2] for p in papers], dtype=np.int64)
+        counts = np.array([p[3] for p in papers], dtype=np.int64)
+        live = np.zeros(rows, dtype=bool)
+        for start, count in zip(starts, counts):
+            live[start : start + count] = True
+        ivf = None
+        if ivf_path is not None and ivf_path.exists():
+            try:
+                with np.load(ivf_path) as data:
+                    ivf = {key: data[key] for key in data.files}
+            except (OSError, ValueError):
+                # Searches score every chunk until the lists are trained again
+                ivf = None
+        self._view = _View(
+            generation=generation,
+            path=path,
+            matrix=self._map(path, rows, dim),
+            live=live,
+            starts=starts,
+            counts=counts,
+            file_locations=[p[0] for p in papers],
+            dockeys=[p[1] for p in papers],
+            papers_by_dockey={p[1]: i for i, p in enumerate(papers)},
+            ivf=ivf,
+        )
+        return self._view
+
+    def paper_chunks(self, dockey: str) -> Optional[int]:
+        """Get the number of chunks stored for a document, None if it isn't stored."""
+        view = self._snapshot()
+        paper = view.papers_by_dockey.get(dockey)
+        return None if paper is None else int(view.counts[paper])
+
+    def vectors(self, rows: Sequence[int]) -> np.ndarray:
+        """Get the normalized embeddings of rows, as float32."""
+        return self._snapshot().matrix[np.asarray(rows)].astype(np.float32)
+
+    def search(
+        self,
+        embedding: Sequence[float],
+        k: int,
+        dockeys: Optional[Iterable[str]] = None,
+    ) -> List[Hit]:
+        """
+        Find the chunks most similar to a query.
+
+        Args:
+            embedding: Embedding of the query
+            k: Number of chunks to return
+            dockeys: Only search the chunks of these documents, the whole store
+                if None. Documents that aren't stored are ignored.
+
+        Returns:
+            The chunks, most similar first
+        """
+        view = self._snapshot()
+        query = normalize_rows(embedding)
+        if not len(view.matrix) or k <= 0 or query.shape[0] != view.matrix.shape[1]:
+            return []
+
+        if dockeys is not None:
+            papers = [
+                view.papers_by_dockey[d] for d in dockeys if d in view.papers_by_dockey
+            ]
+            if not papers:
+                return []
+            rows = np.concatenate(
+                [
+                    np.arange(view.starts[p], view.starts[p] + view.counts[p])
+                    for p in papers
+                ]
+            )
+        elif view.ivf is not None:
+            rows = self._ivf_candidates(view, query)
+        else:
+            rows = None
+
+        candidates, scores = self._score(view, query, k, rows)
+        order = top_k(scores, k)
+        hits = []
+        for row, score in zip(candidates[order], scores[order]):
+            paper = int(np.searchsorted(view.starts, row, side="right")) - 1
+            hits.append(
+                Hit(
+                    file_location=view.file_locations[paper],
+                    dockey=view.dockeys[paper],
+                    index=int(row - view.starts[paper]),
+                    row=int(row),
+                    score=float(score),
+                )
+            )
+        return hits
+
+    @staticmethod
+    def _score(
+        view: _View, query: np.ndarray, k: int, rows: Optional[np.ndarray]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score rows block by block, keeping the top `k` of each block.
+
+        Args:
+            view: Snapshot of the store
+            query: Normalized query embedding
+            k: Number of chunks to keep
+            rows: Sorted rows to score, all rows of papers if None
+
+        Returns:
+            Tuple of the candidate rows and their scores
+        """
+        total = len(view.matrix) if rows is None else len(rows)
+        candidates, scores = [], []
+        for start in range(0, total, BLOCK_ROWS):
+            if rows is None:
+                block_rows = np.arange(start, min(start + BLOCK_ROWS, total))
+                block = view.matrix[start : start + BLOCK_ROWS]
+                block_rows = block_rows[view.live[block_rows]]
+                block = block[view.live[start : start + BLOCK_ROWS]]
+            else:
+                block_rows = rows[start : start + BLOCK_ROWS]
+                block = view.matrix[block_rows]
+            block_scores = block.astype(np.float32) @ query
+            top = top_k(block_scores, k)
+            candidates.append(block_rows[top])
+            scores.append(block_scores[top])
+        if not candidates:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(candidates), np.concatenate(scores)
+
+    @staticmethod
+    def _ivf_candidates(view: _View, query: np.ndarray) -> np.ndarray:
+        """Rows of the IVF lists closest to the query, and rows added after training."""
+        ivf = view.ivf
+        centroids, offsets = ivf["centroids"], ivf["offsets"]
+        probes = max(IVF_MIN_PROBES, int(len(centroids) * IVF_PROBE_FRACTION))
+        lists = top_k(centroids @ query, probes)
+        rows = [ivf["rows"][offsets[i] : offsets[i + 1]] for i in lists]
+        # Rows added since the lists were trained aren't in any list
+        rows.append(np.arange(int(ivf["trained_rows"]), len(view.matrix)))
+        rows = np.sort(np.concatenate(rows))
+        return rows[view.live[rows]]
+
+    def ivf_lists_wanted(self) -> int:
+        """Number of IVF lists the store should have, 0 for none."""
+        live = int(self._snapshot().live.sum())
+        if self.ivf_lists is not None:
+            return min(self.ivf_lists, live)
+        return int(np.sqrt(live)) if live >= IVF_MIN_ROWS else 0
+
+    def update_ivf(self) -> bool:
+        """
+        Train the IVF lists if they are wanted and missing or stale.
+
+        Blocks for a while on large stores, run it in a thread.
+
+        Returns:
+            True if the lists were trained
+        """
+        lists = self.ivf_lists_wanted()
+        view = self._snapshot()
+        if not lists:
+            if view.ivf is not None:
+                with self._lock, self._conn:
+                    self._bump(ivf_file="")
+                self._drop_unused_files()
+            return False
+        if view.ivf is not None and len(view.ivf["centroids"]) == lists:
+            trained_rows = int(view.ivf["trained_rows"])
+            if len(view.matrix) - trained_rows <= IVF_RETRAIN_FRACTION * trained_rows:
+                return False
+
+        live_rows = np.flatnonzero(view.live)
+        rng = np.random.default_rng(0)
+        sample = np.sort(
+            rng.choice(live_rows, min(IVF_TRAINING_ROWS, len(live_rows)), replace=False)
+        )
+        vectors = view.matrix[sample].astype(np.float32)
+        lists = min(lists, len(vectors))
+        centroids = vectors[rng.choice(len(vectors), lists, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            labels = np.argmax(vectors @ centroids.T, axis=1)
+            for i in range(lists):
+                members = vectors[labels == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+
+        labels = np.concatenate(
+            [
+                np.argmax(
+                    view.matrix[live_rows[s : s + BLOCK_ROWS]].astype(np.float32)
+                    @ centroids.T,
+                    axis=1,
+                )
+                for s in range(0, len(live_rows), BLOCK_ROWS)
+            ]
+        )
+        order = np.argsort(labels, kind="stable")
+        with self._lock:
+            path = self._new_file(IVF_FILENAME)
+            try:
+                with open(path, "wb") as f:
+                    np.savez(
+                        f,
+                        centroids=centroids,
+                        rows=live_rows[order],
+                        offsets=np.searchsorted(labels[order], np.arange(lists + 1)),
+                        trained_rows=np.int64(len(view.matrix)),
+                    )
+                with self._conn:
+                    self._bump(ivf_file=path.name)
+            except BaseException:
+                path.unlink(missing_ok=True)
+                raise
+        self._drop_unused_files()
+        logger.info(f"Trained {lists} IVF lists over {len(live_rows)} chunks")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get store statistics.
+
+        Returns:
+            Dict with the number of papers and chunks, the size of the file,
+            the type and dimensions of the embeddings and the IVF lists
+        """
+        view = self._snapshot()
+        return {
+            "papers": len(view.file_locations),
+            "chunks": int(view.counts.sum()),
+            "rows": len(view.matrix),
+            "dim": view.matrix.shape[1],
+            "dtype": self.dtype,
+            "bytes": view.matrix.nbytes,
+            "ivf_lists": len(view.ivf["centroids"]) if view.ivf is not None else 0,
+        }